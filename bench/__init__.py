@@ -0,0 +1,6 @@
+# bench
+# Benchmark y generador de carga del servidor: dispositivos virtuales (HTTP y MQTT),
+# dashboards Socket.IO y comandos de LEDs contra run.py ejecutado en el mismo proceso.
+# Uso: python -m bench run --devices 50 --rate 2 --dashboards 5 --output results.json
+#      python -m bench startup --repeat 10 --output startup.json
+#      python -m bench compare baseline.json results.json
@@ -0,0 +1,183 @@
+# __main__.py
+# CLI del benchmark: 'run' ejecuta una carga y guarda los resultados en JSON,
+# 'startup' mide el arranque en frío del servidor y 'compare' compara dos resultados
+# y falla si alguna métrica empeora más del umbral.
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from .harness import REPO_DIR, load_server
+from .loadgen import PROTOCOLS, ActuatorStub, Dashboard, MqttTransport, VirtualDevice
+from .startup import STARTUP_APPS, run_startup_benchmark
+from .stats import LatencyRecorder, ProcessUsage, compare_results, environment_info, write_results
+
+def run_benchmark(args):
+    db_dir = tempfile.mkdtemp(prefix="flaskhs-bench-")
+    server = load_server(args.db or os.path.join(db_dir, "bench.db"))
+    actuator = ActuatorStub()
+    for i in range(args.actuators):
+        server.registry.register_device(f"bench-actuator-{i}", actuator.address, "bench")
+    mqtt = MqttTransport(server, args.mqtt_broker) if any(p.startswith("mqtt") for p in args.protocols) else None
+
+    stop, stop_load = threading.Event(), threading.Event() # Dashboards / dispositivos
+    send_latency, emit_latency, control_latency = LatencyRecorder(), LatencyRecorder(), LatencyRecorder()
+    dashboards = [Dashboard(i, server, stop, emit_latency, control_latency, args.control_interval)
+                  for i in range(args.dashboards)]
+    devices = [VirtualDevice(i, args.protocols[i % len(args.protocols)], server, mqtt, args.rate, args.sensors,
+                             stop_load, send_latency) for i in range(args.devices)]
+
+    written_before = server.database.get_ingest_stats()["written"]
+    usage = ProcessUsage().start()
+    started = time.monotonic()
+    for thread in dashboards + devices:
+        thread.start()
+    time.sleep(args.duration)
+    stop_devices = time.monotonic()
+    stop_load.set()
+    for device in devices:
+        device.join()
+    # Esperar a que el pipeline MQTT y la cola de ingesta terminen con lo enviado
+    while server.mqtt_pipeline.get_pipeline_stats()["queued"]:
+        time.sleep(0.01)
+    server.database.flush_ingest()
+    drained = time.monotonic()
+    time.sleep(2 * server.fanout.FANOUT_INTERVAL) # Último frame del fan-out
+    stop.set()
+    for dashboard in dashboards:
+        dashboard.join()
+    process = usage.stop()
+    time.sleep(min(1.0, args.control_interval or 0.0)) # Respuestas pendientes del despachador
+
+    ingest = server.database.get_ingest_stats()
+    written = ingest["written"] - written_before
+    sent_readings = sum(device.readings for device in devices)
+    results = {
+        "environment": environment_info(REPO_DIR),
+        "config": {
+            "devices": args.devices, "rate": args.rate, "sensors": args.sensors, "protocols": args.protocols,
+            "dashboards": args.dashboards, "control_interval": args.control_interval, "actuators": args.actuators,
+            "duration": args.duration, "mqtt_broker": args.mqtt_broker or "in-process",
+        },
+        "ingest": {
+            "messages": sum(device.messages for device in devices),
+            "readings": sent_readings,
+            "errors": sum(device.errors for device in devices),
+            "readings_per_second": round(sent_readings / (stop_devices - started), 1),
+            "send_latency": send_latency.summary(),
+            "dropped": ingest["dropped"],
+        },
+        "database": {
+            "rows_written": written,
+            "rows_per_second": round(written / (drained - started), 1),
+            "batches": ingest["batches"],
+            "pool": server.database.get_pool_stats(),
+        },
+        "fanout": {
+            "frames": sum(dashboard.frames for dashboard in dashboards),
+            "series_updates": sum(dashboard.updates for dashboard in dashboards),
+            "latency": emit_latency.summary(),
+            "server": server.fanout.get_fanout_stats(),
+        },
+        "control": {
+            "commands": sum(dashboard.commands for dashboard in dashboards),
+            "led_updates": sum(dashboard.led_updates for dashboard in dashboards),
+            "latency": control_latency.summary(),
+            "delivered": actuator.commands,
+            "dispatcher": server.dispatcher.get_dispatch_stats(),
+            "actuators": server.actuators.get_actuator_stats(),
+        },
+        "mqtt": server.mqtt_pipeline.get_pipeline_stats() if mqtt else None,
+        "process": process,
+    }
+    if mqtt:
+        mqtt.close()
+    actuator.close()
+    shutil.rmtree(db_dir, ignore_errors=True)
+    return results
+
+def _print_summary(results):
+    ingest, db, fanout, control = results["ingest"], results["database"], results["fanout"], results["control"]
+    print(f"Ingest:  {ingest['readings']} readings, {ingest['readings_per_second']} readings/s, "
+          f"{ingest['errors']} errors, send p50/p99 {ingest['send_latency']['p50_ms']}/{ingest['send_latency']['p99_ms']} ms")
+    print(f"DB:      {db['rows_written']} rows, {db['rows_per_second']} rows/s in {db['batches']} batches")
+    print(f"Fan-out: {fanout['frames']} frames, ingest-to-emit p50/p99 "
+          f"{fanout['latency']['p50_ms']}/{fanout['latency']['p99_ms']} ms")
+    print(f"Control: {control['commands']} commands, handler p50/p99 "
+          f"{control['latency']['p50_ms']}/{control['latency']['p99_ms']} ms, {control['delivered']} delivered")
+    print(f"Process: {results['process']['cpu_percent']}% CPU, {results['process']['rss_end_mb']} MB RSS")
+
+def _print_startup_summary(startup):
+    print(f"Interpreter: {startup['interpreter']['median_ms']} ms")
+    for kind in ("cold", "warm"):
+        phases = startup[kind]
+        print(f"{kind.capitalize():12} {phases['total']['median_ms']} ms total, import {phases['import']['median_ms']} ms, "
+              f"init_db {phases['init_db']['median_ms']} ms, {phases['modules']} modules")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Load generator and benchmark for the flaskHS server.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run a load test and write the results as JSON")
+    run_parser.add_argument("--devices", type=int, default=20, help="Virtual devices sending sensor data")
+    run_parser.add_argument("--rate", type=float, default=5.0, help="Messages per second per device (0 = as fast as possible)")
+    run_parser.add_argument("--sensors", type=int, default=4, help="Readings per message")
+    run_parser.add_argument("--protocols", default="http", help=f"Comma-separated mix of {', '.join(PROTOCOLS)}")
+    run_parser.add_argument("--mqtt-broker", help="host[:port] of a real broker (default: in-process stand-in)")
+    run_parser.add_argument("--dashboards", type=int, default=5, help="Socket.IO dashboard clients")
+    run_parser.add_argument("--control-interval", type=float, default=1.0, help="Seconds between control_led per dashboard (0 = never)")
+    run_parser.add_argument("--actuators", type=int, default=1, help="Registered devices that receive LED commands")
+    run_parser.add_argument("--duration", type=float, default=10.0, help="Seconds of load")
+    run_parser.add_argument("--db", help="Database file (default: a new temporary file)")
+    run_parser.add_argument("--output", "-o", help="Write the results JSON to this file")
+
+    startup_parser = commands.add_parser("startup", help="Measure server cold start (import + init_db) in fresh processes")
+    startup_parser.add_argument("--app", choices=sorted(STARTUP_APPS), default="http", help="http: run.py, mqtt: run-mqtt.py")
+    startup_parser.add_argument("--repeat", type=int, default=5, help="Samples per measurement (the median is reported)")
+    startup_parser.add_argument("--output", "-o", help="Write the results JSON to this file")
+
+    compare_parser = commands.add_parser("compare", help="Compare two results files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="Allowed regression in percent")
+
+    args = parser.parse_args(argv)
+    if args.command == "compare":
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.current, encoding="utf-8") as f:
+            current = json.load(f)
+        rows, regressions = compare_results(baseline, current, args.threshold)
+        for name, old, new, change in rows:
+            print(f"{name:32} {old!s:>12} {new!s:>12} {'' if change is None else f'{change:+.1f}%':>9}")
+        if regressions:
+            print(f"Regressions over {args.threshold}%: {', '.join(regressions)}")
+            return 1
+        return 0
+
+    if args.command == "startup":
+        results = {"environment": environment_info(REPO_DIR), "startup": run_startup_benchmark(args.app, args.repeat)}
+        _print_startup_summary(results["startup"])
+        if args.output:
+            write_results(results, args.output)
+            print(f"Results written to {args.output}")
+        return 0
+
+    args.protocols = [p.strip() for p in args.protocols.split(",") if p.strip()]
+    unknown = [p for p in args.protocols if p not in PROTOCOLS]
+    if unknown or not args.protocols:
+        parser.error(f"Unknown protocols: {', '.join(unknown) or '(none)'}")
+    results = run_benchmark(args)
+    _print_summary(results)
+    if args.output:
+        write_results(results, args.output)
+        print(f"Results written to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,40 @@
+# harness.py
+# Arranca el servidor de run.py dentro del proceso del benchmark, sobre una base de
+# datos temporal, con los mismos subsistemas que en producción (ingesta, fan-out,
+# registro de dispositivos, despachador de comandos, estado de actuadores y pipeline MQTT).
+
+import os
+import sys
+import types
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(REPO_DIR, "server")
+
+def load_server(db_path, default_device_url=None):
+    """
+    Importa los módulos del servidor usando 'db_path' como base de datos e inicializa
+    sus subsistemas. Debe llamarse una sola vez por proceso, antes de importar database.
+    """
+    if "database" in sys.modules:
+        raise RuntimeError("The server modules were already imported; run each benchmark in a new process")
+    os.environ["FLASKHS_DB_PATH"] = db_path
+    if SERVER_DIR not in sys.path:
+        sys.path.insert(0, SERVER_DIR)
+
+    import database
+    import run
+    import fanout
+    import registry
+    import dispatcher
+    import actuators
+    import mqtt_pipeline
+    import codec
+
+    database.init_db()
+    fanout.init_fanout(run.socketio)
+    dispatcher.init_dispatcher(run._report_command_result, default_device_url)
+    registry.start_registry()
+    actuators.init_actuators(run._send_actuator_state)
+    mqtt_pipeline.start_pipeline()
+    return types.SimpleNamespace(database=database, run=run, fanout=fanout, registry=registry,
+                                 dispatcher=dispatcher, actuators=actuators, mqtt_pipeline=mqtt_pipeline, codec=codec)
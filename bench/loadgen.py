@@ -0,0 +1,183 @@
+# loadgen.py
+# Generadores de carga: dispositivos virtuales que envían lecturas por HTTP o MQTT,
+# dashboards que reciben 'sensor_update' y envían 'control_led', y un actuador HTTP
+# local que recibe los comandos del despachador.
+
+import http.server
+import json
+import threading
+import time
+
+PROTOCOLS = ("http", "http-binary", "mqtt", "mqtt-binary")
+
+class ActuatorStub:
+    """
+    Servidor HTTP local que hace de microcontrolador: responde 200 a /api/control-led.
+    """
+    def __init__(self):
+        stub = self
+        self.commands = 0
+        self._lock = threading.Lock()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, como el pool del despachador
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with stub._lock:
+                    stub.commands += 1
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.address = f"127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, name="bench-actuator", daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class MqttTransport:
+    """
+    Entrega de mensajes MQTT de los dispositivos virtuales. Sin broker usa un sustituto
+    en proceso que llama directamente a mqtt_pipeline.enqueue_message (lo mismo que hace
+    el callback on_message de run-mqtt.py). Con 'broker' ("host[:port]") publica de verdad
+    y suscribe un cliente paho que alimenta el pipeline.
+    """
+    def __init__(self, server, broker=None, qos=1):
+        self._enqueue = server.mqtt_pipeline.enqueue_message
+        self._qos = qos
+        self._publisher = self._subscriber = None
+        if broker:
+            import paho.mqtt.client as mqtt
+            host, _, port = broker.partition(":")
+            port = int(port or 1883)
+            suffix = server.codec.MQTT_BINARY_SUFFIX
+            connected = threading.Event()
+            self._subscriber = mqtt.Client(client_id=f"flaskhs-bench-server-{id(self)}")
+            self._subscriber.on_message = lambda client, userdata, msg: self._enqueue(msg.topic, msg.payload)
+            self._subscriber.on_connect = lambda client, userdata, flags, rc: (
+                client.subscribe([("sensors/+/data", qos), ("sensors/+/data" + suffix, qos)]), connected.set())
+            self._subscriber.connect(host, port, 60)
+            self._subscriber.loop_start()
+            if not connected.wait(10):
+                raise RuntimeError(f"Could not connect to MQTT broker {broker}")
+            self._publisher = mqtt.Client(client_id=f"flaskhs-bench-devices-{id(self)}")
+            self._publisher.connect(host, port, 60)
+            self._publisher.loop_start()
+
+    def publish(self, topic, payload):
+        if self._publisher is None:
+            return self._enqueue(topic, payload)
+        return self._publisher.publish(topic, payload, qos=self._qos).rc == 0
+
+    def close(self):
+        for client in (self._publisher, self._subscriber):
+            if client is not None:
+                client.loop_stop()
+                client.disconnect()
+
+class VirtualDevice(threading.Thread):
+    """
+    Dispositivo simulado que envía 'rate' mensajes por segundo con 'sensors' lecturas cada uno.
+    """
+    def __init__(self, index, protocol, server, mqtt, rate, sensors, stop, latency):
+        super().__init__(name=f"bench-device-{index}", daemon=True)
+        self.name_ = f"bench-device-{index}"
+        self.protocol = protocol
+        self.server = server
+        self.mqtt = mqtt
+        self.rate = rate
+        self.sensor_types = list(server.codec.SENSOR_TYPES.values())[:sensors]
+        self.stop = stop
+        self.latency = latency
+        self.messages = self.readings = self.errors = 0
+
+    def _send(self, client, seq):
+        values = [(sensor_type, float(seq % 1000) + i / 10.0) for i, sensor_type in enumerate(self.sensor_types)]
+        codec = self.server.codec
+        if self.protocol == "http":
+            payload = {"device": self.name_, "sensors": [{"type": t, "value": v} for t, v in values]}
+            return client.post("/api/sensor", json=payload).status_code == 200
+        if self.protocol == "http-binary":
+            return client.post("/api/sensor", data=codec.encode_frame(self.name_, values),
+                               content_type=codec.BINARY_CONTENT_TYPE).status_code == 200
+        if self.protocol == "mqtt":
+            payload = json.dumps({"sensors": [{"type": t, "value": v} for t, v in values]}).encode()
+            return self.mqtt.publish(f"sensors/{self.name_}/data", payload)
+        return self.mqtt.publish(f"sensors/{self.name_}/data{codec.MQTT_BINARY_SUFFIX}", codec.encode_frame(None, values))
+
+    def run(self):
+        client = self.server.run.app.test_client()
+        interval = 1.0 / self.rate if self.rate else 0.0
+        next_send = time.monotonic()
+        seq = 0
+        while not self.stop.is_set():
+            started = time.monotonic()
+            ok = self._send(client, seq)
+            self.latency.add(time.monotonic() - started)
+            seq += 1
+            self.messages += 1
+            if ok:
+                self.readings += len(self.sensor_types)
+            else:
+                self.errors += 1
+            if interval:
+                next_send += interval
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    self.stop.wait(delay)
+                else:
+                    next_send = time.monotonic() # Atrasado: no acumular ráfagas
+
+class Dashboard(threading.Thread):
+    """
+    Cliente Socket.IO simulado: se suscribe a todas las series, mide la latencia desde el
+    timestamp de cada lectura hasta que la recibe y envía 'control_led' periódicamente.
+    """
+    POLL_INTERVAL = 0.002
+
+    def __init__(self, index, server, stop, emit_latency, control_latency, control_interval):
+        super().__init__(name=f"bench-dashboard-{index}", daemon=True)
+        self.server = server
+        self.stop = stop
+        self.emit_latency = emit_latency
+        self.control_latency = control_latency
+        self.control_interval = control_interval
+        self.frames = self.updates = self.led_updates = self.commands = 0
+        self.client = server.run.socketio.test_client(server.run.app)
+        self.client.get_received() # Descartar el estado inicial (LEDs y snapshot)
+        self.client.emit("subscribe", {"series": [{"device": "*", "type": "*"}], "max_rate": server.fanout.FANOUT_MAX_RATE})
+
+    def _drain(self):
+        now = time.time()
+        for message in self.client.get_received():
+            if message["name"] == "sensor_update":
+                self.frames += 1
+                for item in message["args"][0]:
+                    for sensor in item["sensors"]:
+                        self.updates += 1
+                        self.emit_latency.add(now - sensor["timestamp"])
+            elif message["name"] == "led_update":
+                self.led_updates += 1
+
+    def run(self):
+        next_command = time.monotonic() + self.control_interval if self.control_interval else None
+        state = 0
+        while not self.stop.is_set():
+            self._drain()
+            if next_command is not None and time.monotonic() >= next_command:
+                state ^= 1
+                started = time.monotonic()
+                self.client.emit("control_led", {"ledRed": state, "ledGreen": 1 - state})
+                self.control_latency.add(time.monotonic() - started)
+                self.commands += 1
+                next_command += self.control_interval
+            time.sleep(self.POLL_INTERVAL)
+        self._drain()
+        self.client.disconnect()
@@ -0,0 +1,78 @@
+# startup.py
+# Benchmark de arranque en frío: cada muestra es un proceso Python nuevo que importa la
+# aplicación del servidor (run.py o run-mqtt.py) e inicializa la base de datos. Se mide
+# sobre una base de datos nueva ("cold", con todas las migraciones) y sobre una ya
+# migrada ("warm", el caso de un reinicio), junto con el arranque del intérprete solo.
+
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from .harness import SERVER_DIR
+
+STARTUP_APPS = {"http": "run.py", "mqtt": "run-mqtt.py"}
+
+# Se ejecuta en el proceso hijo; imprime los tiempos de cada fase en JSON
+_CHILD_SCRIPT = """
+import importlib.util, json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {server_dir!r})
+spec = importlib.util.spec_from_file_location("server_app", {app_path!r})
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+imported = time.perf_counter()
+app.init_db()
+ready = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - started) * 1000, "init_db_ms": (ready - imported) * 1000,
+                  "modules": len(sys.modules)}}))
+"""
+
+def _run_child(code, env):
+    """
+    Ejecuta 'code' en un intérprete nuevo y retorna (milisegundos de pared, salida JSON o None).
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"Startup sample failed: {result.stderr.strip().splitlines()[-1:]}")
+    output = result.stdout.strip().splitlines()
+    return wall_ms, json.loads(output[-1]) if output else None
+
+def _summary(samples):
+    return {
+        "median_ms": round(statistics.median(samples), 1),
+        "min_ms": round(min(samples), 1),
+        "max_ms": round(max(samples), 1),
+    }
+
+def run_startup_benchmark(app="http", repeat=5):
+    """
+    Mide 'repeat' arranques de cada tipo y retorna la mediana, el mínimo y el máximo de
+    cada fase: total (pared, con el intérprete), import de la aplicación e init_db().
+    """
+    db_dir = tempfile.mkdtemp(prefix="flaskhs-startup-")
+    env = dict(os.environ, FLASKHS_LOG_LEVEL="ERROR")
+    child = _CHILD_SCRIPT.format(server_dir=SERVER_DIR, app_path=os.path.join(SERVER_DIR, STARTUP_APPS[app]))
+    interpreter = [_run_child("pass", env)[0] for _ in range(repeat)]
+    results = {"app": app, "repeat": repeat, "interpreter": _summary(interpreter)}
+    warm_db = os.path.join(db_dir, "warm.db")
+    for kind in ("cold", "warm"):
+        totals, imports, inits = [], [], []
+        for i in range(repeat):
+            db_path = os.path.join(db_dir, f"cold-{i}.db") if kind == "cold" else warm_db
+            if kind == "warm" and i == 0:
+                _run_child(child, dict(env, FLASKHS_DB_PATH=db_path)) # Crear y migrar la base de datos
+            wall_ms, phases = _run_child(child, dict(env, FLASKHS_DB_PATH=db_path))
+            totals.append(wall_ms)
+            imports.append(phases["import_ms"])
+            inits.append(phases["init_db_ms"])
+        results[kind] = {"total": _summary(totals), "import": _summary(imports), "init_db": _summary(inits),
+                         "modules": phases["modules"]}
+    shutil.rmtree(db_dir, ignore_errors=True)
+    return results
@@ -0,0 +1,143 @@
+# stats.py
+# Medidas del benchmark: latencias con percentiles, uso de CPU/memoria del proceso
+# y escritura/comparación de resultados en JSON.
+
+import json
+import os
+import platform
+import resource
+import subprocess
+import threading
+import time
+
+class LatencyRecorder:
+    """
+    Acumula muestras de latencia (segundos) desde varios hilos y calcula percentiles.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = []
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def extend(self, samples):
+        with self._lock:
+            self._samples.extend(samples)
+
+    def summary(self):
+        """
+        Retorna {"count", "p50_ms", "p90_ms", "p99_ms", "max_ms", "mean_ms"} (None sin muestras).
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return {"count": 0, "p50_ms": None, "p90_ms": None, "p99_ms": None, "max_ms": None, "mean_ms": None}
+        def pct(p):
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 3)
+        return {
+            "count": len(samples),
+            "p50_ms": pct(0.50),
+            "p90_ms": pct(0.90),
+            "p99_ms": pct(0.99),
+            "max_ms": round(samples[-1] * 1000, 3),
+            "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        }
+
+def _rss_bytes():
+    # RSS actual desde /proc (Linux/Termux); en otros sistemas, el máximo de getrusage
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if platform.system() == "Darwin" else maxrss * 1024
+
+class ProcessUsage:
+    """
+    Mide CPU (usuario + sistema) y RSS del proceso entre start() y stop().
+    """
+    def start(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self._cpu = usage.ru_utime + usage.ru_stime
+        self._wall = time.monotonic()
+        self._rss_start = _rss_bytes()
+        return self
+
+    def stop(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        wall = time.monotonic() - self._wall
+        cpu = usage.ru_utime + usage.ru_stime - self._cpu
+        return {
+            "cpu_seconds": round(cpu, 3),
+            "cpu_percent": round(100.0 * cpu / wall, 1) if wall else None,
+            "rss_start_mb": round(self._rss_start / 2**20, 1),
+            "rss_end_mb": round(_rss_bytes() / 2**20, 1),
+        }
+
+def _git_revision(path):
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=path, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def environment_info(repo_dir):
+    """
+    Datos del entorno que acompañan a los resultados para poder compararlos.
+    """
+    return {
+        "git_revision": _git_revision(repo_dir),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+def write_results(results, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+# Métricas comparadas entre dos resultados: (ruta en el JSON, True si más alto es mejor)
+COMPARED_METRICS = [
+    (("ingest", "readings_per_second"), True),
+    (("database", "rows_per_second"), True),
+    (("fanout", "latency", "p50_ms"), False),
+    (("fanout", "latency", "p99_ms"), False),
+    (("control", "latency", "p99_ms"), False),
+    (("process", "cpu_percent"), False),
+    (("process", "rss_end_mb"), False),
+    (("startup", "cold", "total", "median_ms"), False),
+    (("startup", "warm", "total", "median_ms"), False),
+    (("startup", "warm", "init_db", "median_ms"), False),
+]
+
+def _lookup(results, path):
+    for key in path:
+        if not isinstance(results, dict):
+            return None
+        results = results.get(key)
+    return results
+
+def compare_results(baseline, current, threshold):
+    """
+    Compara dos resultados y retorna (filas, regresiones). Una regresión es una métrica
+    que empeora más de 'threshold' por ciento respecto a la línea base.
+    """
+    rows = []
+    regressions = []
+    for path, higher_is_better in COMPARED_METRICS:
+        old, new = _lookup(baseline, path), _lookup(current, path)
+        name = ".".join(path)
+        if old is None and new is None:
+            continue # Métrica de otro tipo de benchmark (carga o arranque)
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or old == 0:
+            rows.append((name, old, new, None))
+            continue
+        change = 100.0 * (new - old) / abs(old)
+        rows.append((name, old, new, change))
+        if (change < -threshold) if higher_is_better else (change > threshold):
+            regressions.append(name)
+    return rows, regressions
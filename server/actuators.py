@@ -0,0 +1,277 @@
+# actuators.py
+# Estado en memoria y versionado de las salidas (LEDs u otros actuadores) de todos los
+# dispositivos. El dispositivo "*" es el estado común a todos (los botones del dashboard);
+# un dispositivo concreto puede tener su propio valor para una salida.
+#
+# Los comandos no escriben en la base de datos: se aplican en memoria y un hilo guarda
+# las salidas modificadas en lote. Los comandos a un mismo destino se agrupan: el primero
+# se aplica al instante y los que llegan durante ACTUATOR_DEBOUNCE se combinan (el último
+# valor de cada salida gana) en un único comando al final de la ventana. Si el estado no
+# cambia no se envía nada. Cada cambio lleva una versión creciente (milisegundos epoch
+# o el siguiente entero) con la que los clientes y los demás workers descartan estados viejos.
+
+import atexit
+import threading
+import time
+
+from database import ACTUATOR_ALL_DEVICES, get_actuator_states, upsert_actuator_states
+from logs import get_logger
+
+logger = get_logger("actuators")
+
+# --- CONFIGURACIÓN DE LOS ACTUADORES ---
+ACTUATOR_DEBOUNCE = 0.15        # Segundos en que se combinan los comandos a un mismo destino
+ACTUATOR_FLUSH_INTERVAL = 1.0   # Segundos entre escrituras en lote de las salidas modificadas
+ACTUATOR_MAX_OUTPUTS = 32       # Salidas máximas por comando
+ACTUATOR_MAX_NAME = 64          # Longitud máxima del nombre de una salida
+LED_OUTPUTS = ("ledRed", "ledGreen")
+
+_lock = threading.Lock()
+_state = {}          # device ("*" = todos) -> {output: [value, version]}
+_version = 0         # Última versión asignada
+_dirty = set()       # (device, output) pendientes de guardar
+_pending = {}        # destino (None = todos o tupla de dispositivos) -> {output: value}
+_pending_due = {}    # destino -> instante (monotonic) en que se aplican los comandos combinados
+_last_applied = {}   # destino -> instante (monotonic) del último comando aplicado
+_loaded = False
+_change_handler = None
+_thread = None
+_stop = threading.Event()
+_wake = threading.Event()
+_stats = {"commands": 0, "coalesced": 0, "suppressed": 0, "applied": 0, "persisted": 0}
+
+def _ensure_loaded():
+    """
+    Carga el estado guardado la primera vez que se usa. Se llama con _lock tomado.
+    """
+    global _loaded, _version
+    if _loaded:
+        return
+    for device, output, value, version in get_actuator_states():
+        _state.setdefault(device, {})[output] = [value, version]
+        _version = max(_version, version)
+    _loaded = True
+
+def _next_version():
+    # Se llama con _lock tomado. Basada en el reloj para que las versiones de varios
+    # workers sean comparables (el último en escribir gana)
+    global _version
+    _version = max(_version + 1, int(time.time() * 1000))
+    return _version
+
+def _effective(device):
+    """
+    Estado de un dispositivo: el común ("*") con sus valores propios encima. Se llama con _lock tomado.
+    """
+    state = {output: entry[0] for output, entry in _state.get(ACTUATOR_ALL_DEVICES, {}).items()}
+    if device != ACTUATOR_ALL_DEVICES:
+        state.update((output, entry[0]) for output, entry in _state.get(device, {}).items())
+    return state
+
+def validate_outputs(outputs):
+    """
+    Valida un comando {salida: valor numérico} y lo retorna normalizado. Lanza ValueError.
+    """
+    if not isinstance(outputs, dict) or not outputs:
+        raise ValueError("Expected at least one output, e.g. {'ledRed': 1}")
+    if len(outputs) > ACTUATOR_MAX_OUTPUTS:
+        raise ValueError(f"Too many outputs (max {ACTUATOR_MAX_OUTPUTS})")
+    normalized = {}
+    for output, value in outputs.items():
+        if not isinstance(output, str) or not output or len(output) > ACTUATOR_MAX_NAME:
+            raise ValueError(f"Invalid output name {output!r}")
+        if isinstance(value, bool):
+            value = int(value)
+        if not isinstance(value, (int, float)) or value != value:
+            raise ValueError(f"Output '{output}' must be a number")
+        normalized[output] = value
+    return normalized
+
+def _apply(target, outputs):
+    """
+    Aplica un comando (ya combinado) y notifica los dispositivos cuyo estado cambió.
+    """
+    changed = []
+    with _lock:
+        _ensure_loaded()
+        _last_applied[target] = time.monotonic()
+        version = None
+        devices = [ACTUATOR_ALL_DEVICES] if target is None else list(target)
+        for device in devices:
+            current = _effective(device)
+            diff = {output: value for output, value in outputs.items() if current.get(output) != value}
+            if target is None:
+                # Un comando a todos también sustituye los valores propios de cada dispositivo
+                for other, other_outputs in _state.items():
+                    for output in outputs:
+                        entry = other_outputs.get(output)
+                        if other != ACTUATOR_ALL_DEVICES and entry is not None and entry[0] != outputs[output]:
+                            diff.setdefault(output, outputs[output])
+            if not diff:
+                continue
+            if version is None:
+                version = _next_version()
+            device_outputs = _state.setdefault(device, {})
+            for output, value in diff.items():
+                device_outputs[output] = [value, version]
+                _dirty.add((device, output))
+                if target is None:
+                    for other, other_outputs in _state.items():
+                        if other != ACTUATOR_ALL_DEVICES and output in other_outputs:
+                            other_outputs[output] = [value, version]
+                            _dirty.add((other, output))
+            changed.append((device, _effective(device), version))
+        if not changed:
+            _stats["suppressed"] += 1
+            return False
+        _stats["applied"] += 1
+    for device, state, version in changed:
+        try:
+            if _change_handler is not None:
+                _change_handler(device, state, version)
+        except Exception as e:
+            logger.error("Error sending actuator state of %s: %s", device, e)
+    return True
+
+def set_outputs(outputs, devices=None):
+    """
+    Pide cambiar salidas {salida: valor} de 'devices' (None = todos los dispositivos).
+    El primer comando a un destino se aplica al instante; los siguientes dentro de
+    ACTUATOR_DEBOUNCE se combinan y se aplican juntos al final de la ventana.
+    """
+    outputs = validate_outputs(outputs)
+    target = None if devices is None else tuple(sorted(set(devices)))
+    now = time.monotonic()
+    with _lock:
+        _stats["commands"] += 1
+        pending = _pending.get(target)
+        if pending is None and now - _last_applied.get(target, float("-inf")) >= ACTUATOR_DEBOUNCE:
+            apply_now = True
+            _last_applied[target] = now # Los comandos concurrentes se combinan con este
+        else:
+            apply_now = False
+            _stats["coalesced"] += 1
+            if pending is None:
+                _pending[target] = pending = {}
+                _pending_due[target] = _last_applied.get(target, now) + ACTUATOR_DEBOUNCE
+            pending.update(outputs)
+    if apply_now:
+        _apply(target, outputs)
+    else:
+        _wake.set()
+
+def _apply_due(force=False):
+    now = time.monotonic()
+    with _lock:
+        due = [target for target, at in _pending_due.items() if force or at <= now]
+        commands = [(target, _pending.pop(target)) for target in due]
+        for target in due:
+            del _pending_due[target]
+    for target, outputs in commands:
+        _apply(target, outputs)
+
+def get_state(device=ACTUATOR_ALL_DEVICES):
+    """
+    Retorna (estado, versión) de un dispositivo ("*": el estado común) desde memoria.
+    """
+    with _lock:
+        _ensure_loaded()
+        versions = [entry[1] for entry in _state.get(ACTUATOR_ALL_DEVICES, {}).values()]
+        if device != ACTUATOR_ALL_DEVICES:
+            versions += [entry[1] for entry in _state.get(device, {}).values()]
+        return _effective(device), max(versions, default=0)
+
+def get_led_state():
+    """
+    Estado común de los LEDs con su versión, con el formato de 'led_update'.
+    """
+    state, version = get_state()
+    led_state = {output: state.get(output, 0) for output in LED_OUTPUTS}
+    led_state["version"] = version
+    return led_state
+
+def merge_states(rows):
+    """
+    Incorpora salidas [(device, output, value, version)] guardadas por otro proceso del
+    clúster si son más recientes que las de memoria. No las marca como modificadas.
+    """
+    global _version
+    with _lock:
+        _ensure_loaded()
+        for device, output, value, version in rows:
+            entry = _state.setdefault(device, {}).get(output)
+            if entry is None or version > entry[1]:
+                _state[device][output] = [value, version]
+            _version = max(_version, version)
+
+def flush_actuators():
+    """
+    Guarda en lote las salidas modificadas desde el último flush.
+    """
+    with _lock:
+        if not _dirty:
+            return True
+        keys = list(_dirty)
+        _dirty.clear()
+        rows = [(device, output) + tuple(_state[device][output]) for device, output in keys]
+    if upsert_actuator_states(rows):
+        with _lock:
+            _stats["persisted"] += len(rows)
+        return True
+    with _lock:
+        _dirty.update(keys) # Reintentar en el siguiente flush
+    return False
+
+def get_actuator_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["devices"] = len(_state)
+        stats["pending"] = len(_pending)
+        stats["dirty"] = len(_dirty)
+    return stats
+
+def _actuators_loop():
+    next_flush = time.monotonic() + ACTUATOR_FLUSH_INTERVAL
+    while not _stop.is_set():
+        with _lock:
+            next_due = min(_pending_due.values(), default=next_flush)
+        _wake.wait(max(0.0, min(next_due, next_flush) - time.monotonic()))
+        _wake.clear()
+        try:
+            _apply_due()
+            if time.monotonic() >= next_flush:
+                flush_actuators()
+                next_flush = time.monotonic() + ACTUATOR_FLUSH_INTERVAL
+        except Exception as e:
+            logger.error("Error in actuator loop: %s", e)
+
+def init_actuators(change_handler):
+    """
+    Carga el estado y arranca el hilo que aplica los comandos combinados y guarda los
+    cambios. change_handler(device, state, version) envía el nuevo estado de un
+    dispositivo ("*": todos) a los microcontroladores y a los clientes.
+    """
+    global _change_handler, _thread
+    _change_handler = change_handler
+    with _lock:
+        _ensure_loaded()
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_actuators_loop, name="actuators", daemon=True)
+    _thread.start()
+
+def stop_actuators():
+    """
+    Aplica los comandos pendientes, detiene el hilo y guarda el estado modificado.
+    """
+    global _thread
+    _stop.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join()
+        _thread = None
+    _apply_due(force=True)
+    flush_actuators()
+
+atexit.register(stop_actuators)
@@ -0,0 +1,289 @@
+# analytics.py
+# Estadísticas agregadas por serie (dispositivo, sensor) calculadas con NumPy sobre una
+# ventana de tiempo cargada por columnas: media, desviación, percentiles, media móvil,
+# tasa de cambio y correlación entre dos sensores. Los resultados se guardan en una
+# caché indexada por ventana que se invalida solo para las series y ventanas afectadas
+# por cada lectura nueva (listener de la ingesta).
+# NumPy se importa en el primer cálculo (import_numpy) y no al arrancar el servidor.
+
+import importlib.util
+import threading
+import time
+from collections import OrderedDict
+
+from database import add_ingest_listener, iter_series_values
+from logs import get_logger
+
+logger = get_logger("analytics")
+
+# --- CONFIGURACIÓN DE LAS ESTADÍSTICAS ---
+STATS_DEFAULT_PERCENTILES = (50, 90, 95, 99)
+STATS_DEFAULT_MA_WINDOW = 10      # Lecturas por media móvil
+STATS_DEFAULT_MA_POINTS = 200     # Puntos de la media móvil devueltos (submuestreo uniforme)
+STATS_MAX_MA_POINTS = 2000
+STATS_MAX_READINGS = 2000000      # Lecturas máximas cargadas por ventana (16 bytes cada una)
+STATS_CORRELATION_BUCKETS = 2000  # Buckets para alinear dos series si no se indica 'bucket'
+STATS_CACHE_MAX_ENTRIES = 256     # Resultados en caché (LRU)
+STATS_RELATIVE_MAX_AGE = 5.0      # Segundos que vale un resultado de ventana relativa ("últimos N s")
+
+np = None              # Módulo numpy tras import_numpy()
+_SERIES_DTYPE = None
+_numpy_missing = False
+
+_cache_lock = threading.Lock()
+_cache = OrderedDict()       # clave -> (resultado, instante de cálculo, ventana [start, end], series)
+_cache_by_series = {}        # (device, sensor_type) -> {claves que dependen de la serie}
+_computing = {}              # (device, sensor_type) -> [cálculos en curso, lecturas recibidas mientras tanto]
+_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_listening = False
+
+def import_numpy():
+    """
+    Importa NumPy la primera vez que se necesita. Retorna False si no está instalado
+    (es opcional: sin él /api/sensor/stats responde 503).
+    """
+    global np, _SERIES_DTYPE, _numpy_missing
+    if np is None and not _numpy_missing:
+        try:
+            import numpy
+        except ImportError:
+            _numpy_missing = True
+            return False
+        _SERIES_DTYPE = numpy.dtype([("ts", "i8"), ("value", "f8")])
+        np = numpy
+    return np is not None
+
+def numpy_available():
+    # Sin importarlo: basta con saber si está instalado
+    return np is not None or (not _numpy_missing and importlib.util.find_spec("numpy") is not None)
+
+# --- CARGA POR COLUMNAS ---
+
+def load_series(device_name, sensor_type, start, end):
+    """
+    Carga la serie en [start, end] como dos arrays: timestamps (s, float64) y valores.
+    Retorna (ts, values, truncated); si hay más de STATS_MAX_READINGS lecturas se
+    conservan las primeras y 'truncated' es True.
+    """
+    # Se lee una lectura de más para saber si la ventana quedó truncada
+    source = iter_series_values(device_name, sensor_type, start, end)
+    limited = (row for _, row in zip(range(STATS_MAX_READINGS + 1), source))
+    rows = np.fromiter(limited, dtype=_SERIES_DTYPE, count=-1)
+    source.close() # Devuelve la conexión al pool aunque queden filas
+    truncated = len(rows) > STATS_MAX_READINGS
+    if truncated:
+        rows = rows[:STATS_MAX_READINGS]
+    return rows["ts"] / 1000.0, rows["value"].copy(), truncated
+
+# --- CÁLCULOS VECTORIZADOS ---
+
+def _moving_average(ts, values, window, max_points):
+    if len(values) < window:
+        return []
+    cumulative = np.cumsum(np.concatenate(([0.0], values)))
+    averages = (cumulative[window:] - cumulative[:-window]) / window
+    times = ts[window - 1:]
+    if len(averages) > max_points:
+        idx = np.linspace(0, len(averages) - 1, max_points).round().astype(np.int64)
+        times, averages = times[idx], averages[idx]
+    return np.column_stack((times, averages)).tolist()
+
+def _rate_of_change(ts, values):
+    if len(values) < 2:
+        return None
+    dt = np.diff(ts)
+    valid = dt > 0
+    rates = np.diff(values)[valid] / dt[valid]
+    span = ts[-1] - ts[0]
+    return {
+        "overall": float((values[-1] - values[0]) / span) if span > 0 else None,
+        "mean": float(rates.mean()) if len(rates) else None,
+        "max_abs": float(np.abs(rates).max()) if len(rates) else None,
+    }
+
+def describe(ts, values, percentiles=STATS_DEFAULT_PERCENTILES, ma_window=STATS_DEFAULT_MA_WINDOW,
+             ma_points=STATS_DEFAULT_MA_POINTS):
+    """
+    Estadísticas de una serie ya cargada (arrays de timestamps y valores).
+    """
+    if not len(values):
+        return {"count": 0, "stats": None, "rate": None, "moving_average": {"window": ma_window, "points": []}}
+    pct = np.percentile(values, percentiles)
+    return {
+        "count": int(len(values)),
+        "stats": {
+            "mean": float(values.mean()),
+            "std": float(values.std()),
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "first_ts": float(ts[0]),
+            "last_ts": float(ts[-1]),
+            "percentiles": {f"{p:g}": float(v) for p, v in zip(percentiles, pct)},
+        },
+        "rate": _rate_of_change(ts, values),
+        "moving_average": {"window": ma_window, "points": _moving_average(ts, values, ma_window, ma_points)},
+    }
+
+def lttb(ts, values, threshold):
+    """
+    Largest-Triangle-Three-Buckets: índices de 'threshold' puntos que conservan la forma
+    visual de la serie (picos incluidos), siempre con el primero y el último. Cada bucket
+    aporta el punto que forma el triángulo de mayor área con el punto elegido en el
+    bucket anterior y la media del siguiente.
+    """
+    n = len(values)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64) # Límites de los threshold-2 buckets centrales
+    idx = np.empty(threshold, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_t = ts[hi:next_hi].mean()
+        avg_v = values[hi:next_hi].mean()
+        area = np.abs((ts[a] - avg_t) * (values[lo:hi] - values[a]) - (ts[a] - ts[lo:hi]) * (avg_v - values[a]))
+        a = lo + int(area.argmax())
+        idx[i + 1] = a
+    return idx
+
+def _bucket_means(ts, values, start, bucket, buckets):
+    idx = ((ts - start) // bucket).astype(np.int64)
+    keep = (idx >= 0) & (idx < buckets)
+    idx, values = idx[keep], values[keep]
+    counts = np.bincount(idx, minlength=buckets)
+    sums = np.bincount(idx, weights=values, minlength=buckets)
+    return sums, counts
+
+def correlate(ts_a, values_a, ts_b, values_b, start, end, bucket=None):
+    """
+    Correlación de Pearson entre dos series alineadas por buckets de 'bucket' segundos
+    (media por bucket; solo cuentan los buckets con lecturas de ambas series).
+    """
+    if bucket is None:
+        bucket = max(1.0, (end - start) / STATS_CORRELATION_BUCKETS)
+    buckets = int((end - start) // bucket) + 1
+    sums_a, counts_a = _bucket_means(ts_a, values_a, start, bucket, buckets)
+    sums_b, counts_b = _bucket_means(ts_b, values_b, start, bucket, buckets)
+    both = (counts_a > 0) & (counts_b > 0)
+    pairs = int(both.sum())
+    r = None
+    if pairs >= 2:
+        a = sums_a[both] / counts_a[both]
+        b = sums_b[both] / counts_b[both]
+        if a.std() > 0 and b.std() > 0:
+            r = float(np.corrcoef(a, b)[0, 1])
+    return {"bucket": bucket, "pairs": pairs, "r": r}
+
+# --- CACHÉ CON INVALIDACIÓN INCREMENTAL ---
+
+def _invalidate_from_readings(readings):
+    # Solo se descartan los resultados cuya ventana contiene alguna lectura nueva de su serie
+    with _cache_lock:
+        if not _cache_by_series and not _computing:
+            return
+        for device, sensor_type, _value, ts in readings:
+            computing = _computing.get((device, sensor_type))
+            if computing is not None:
+                computing[1] += 1
+            keys = _cache_by_series.get((device, sensor_type))
+            if not keys:
+                continue
+            for key in [key for key in keys if _cache[key][2][0] <= ts <= _cache[key][2][1]]:
+                _drop(key)
+                _cache_stats["invalidations"] += 1
+
+def _drop(key):
+    # Se llama con _cache_lock tomado
+    _result, _computed, _window, series = _cache.pop(key)
+    for item in series:
+        keys = _cache_by_series.get(item)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del _cache_by_series[item]
+
+def _cache_get(key, relative):
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and relative and time.monotonic() - entry[1] > STATS_RELATIVE_MAX_AGE:
+            # En una ventana relativa el borde izquierdo avanza aunque no lleguen lecturas
+            _drop(key)
+            entry = None
+        if entry is None:
+            _cache_stats["misses"] += 1
+            return None
+        _cache.move_to_end(key)
+        _cache_stats["hits"] += 1
+        return entry[0]
+
+def _cache_put(key, result, window, series):
+    with _cache_lock:
+        if key in _cache:
+            _drop(key)
+        _cache[key] = (result, time.monotonic(), window, series)
+        for item in series:
+            _cache_by_series.setdefault(item, set()).add(key)
+        while len(_cache) > STATS_CACHE_MAX_ENTRIES:
+            _drop(next(iter(_cache)))
+
+def get_cache_stats():
+    with _cache_lock:
+        stats = dict(_cache_stats)
+        stats["entries"] = len(_cache)
+    return stats
+
+def get_series_stats(device_name, sensor_type, start, end, percentiles=STATS_DEFAULT_PERCENTILES,
+                     ma_window=STATS_DEFAULT_MA_WINDOW, ma_points=STATS_DEFAULT_MA_POINTS,
+                     correlate_with=None, bucket=None, relative=None):
+    """
+    Estadísticas de una serie en [start, end] (epoch en segundos), opcionalmente con
+    la correlación con otra serie correlate_with=(device, sensor_type). Con 'relative'
+    (duración en segundos de una ventana "últimos N s") el resultado se cachea por
+    duración en lugar de por instantes exactos. Retorna (resultado, desde_caché).
+    """
+    global _listening
+    if not import_numpy():
+        raise RuntimeError("NumPy is not installed")
+    if not _listening:
+        add_ingest_listener(_invalidate_from_readings)
+        _listening = True
+
+    window_key = ("last", relative) if relative else (start, end)
+    key = (device_name, sensor_type, window_key, tuple(percentiles), ma_window, ma_points, correlate_with, bucket)
+    cached = _cache_get(key, bool(relative))
+    if cached is not None:
+        return cached, True
+
+    series = [(device_name, sensor_type)] + ([correlate_with] if correlate_with is not None else [])
+    with _cache_lock:
+        before = {}
+        for item in series:
+            computing = _computing.setdefault(item, [0, 0])
+            computing[0] += 1
+            before[item] = computing[1]
+    try:
+        ts, values, truncated = load_series(device_name, sensor_type, start, end)
+        result = describe(ts, values, percentiles, ma_window, ma_points)
+        result.update({"device": device_name, "type": sensor_type, "from": start, "to": end, "truncated": truncated})
+        if correlate_with is not None:
+            other_ts, other_values, other_truncated = load_series(correlate_with[0], correlate_with[1], start, end)
+            correlation = correlate(ts, values, other_ts, other_values, start, end, bucket)
+            correlation.update({"device": correlate_with[0], "type": correlate_with[1], "truncated": other_truncated})
+            result["correlation"] = correlation
+    finally:
+        with _cache_lock:
+            changed = False
+            for item in series:
+                computing = _computing[item]
+                changed = changed or computing[1] != before[item]
+                computing[0] -= 1
+                if not computing[0]:
+                    del _computing[item]
+    # Si llegaron lecturas de la serie durante el cálculo el resultado ya puede estar
+    # desactualizado: se entrega pero no se guarda. En las ventanas relativas cualquier
+    # lectura nueva cae dentro, así que se invalidan por serie.
+    if not changed:
+        _cache_put(key, result, (start, float("inf")) if relative else (start, end), series)
+    return result, False
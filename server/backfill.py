@@ -0,0 +1,185 @@
+# backfill.py
+# Histórico inicial de los gráficos del dashboard. Al conectarse o al cambiar de gráfico,
+# el cliente pide la serie de un tipo de sensor (todos sus dispositivos) en el rango
+# reciente y recibe como máximo BACKFILL_POINTS puntos por dispositivo, submuestreados
+# con LTTB (analytics.lttb) a partir de los datos crudos o del rollup adecuado.
+#
+# Cada serie se guarda en caché durante BACKFILL_CACHE_TTL segundos; entre tanto, las
+# lecturas nuevas (listener de la ingesta) se añaden al final sin volver a consultar la
+# base de datos. El payload es por columnas y compacto:
+#   {"type": ..., "range": 3600, "series": [{"device": ..., "t0": 1718000000.123,
+#    "dt": [0, 1000, 998, ...], "v": [1.2345, ...]}]}
+# 't0' es el primer timestamp (s) y 'dt' las diferencias en milisegundos entre puntos.
+
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+import analytics
+from database import add_ingest_listener, get_sensor_history, get_series_devices
+from logs import get_logger
+
+logger = get_logger("backfill")
+
+# --- CONFIGURACIÓN DEL HISTÓRICO INICIAL ---
+BACKFILL_POINTS = 500                         # Puntos por dispositivo tras el submuestreo
+BACKFILL_RANGES = (900, 3600, 21600, 86400)   # Rangos (s) que puede pedir un cliente
+BACKFILL_DEFAULT_RANGE = 3600
+BACKFILL_MAX_INPUT = 20000                    # Puntos leídos por serie como máximo (se elige el rollup para no superarlo)
+BACKFILL_MAX_DEVICES = 16                     # Dispositivos por gráfico
+BACKFILL_CACHE_TTL = 30.0                     # Segundos que se reutiliza una serie calculada
+BACKFILL_CACHE_MAX_ENTRIES = 512
+BACKFILL_MAX_TAIL = 500                       # Lecturas nuevas añadidas a una serie en caché antes de recalcularla
+BACKFILL_VALUE_DECIMALS = 4
+
+_lock = threading.Lock()
+_cache = OrderedDict()  # (device, sensor_type, rango) -> _Entry
+_cache_by_series = {}   # (device, sensor_type) -> {claves en caché de la serie}
+_stats = {"hits": 0, "misses": 0, "requests": 0, "invalidations": 0}
+_listening = False
+
+class _Entry:
+    __slots__ = ("ts", "values", "covered", "computed", "tail")
+
+    def __init__(self):
+        self.ts = self.values = None  # Serie submuestreada (None mientras se calcula)
+        self.covered = None           # Timestamp hasta el que la serie refleja la DB
+        self.computed = None          # Instante (monotonic) del cálculo
+        self.tail = []                # Lecturas (ts, value) recibidas desde que empezó el cálculo
+
+def parse_range(value):
+    """
+    Valida el rango pedido por el cliente (segundos); None usa el rango por defecto.
+    """
+    if value is None:
+        return BACKFILL_DEFAULT_RANGE
+    try:
+        seconds = int(value)
+    except (TypeError, ValueError):
+        seconds = None
+    if seconds not in BACKFILL_RANGES:
+        raise ValueError(f"'range' must be one of {', '.join(str(r) for r in BACKFILL_RANGES)} seconds")
+    return seconds
+
+def _downsample(ts, values):
+    if len(ts) <= BACKFILL_POINTS:
+        return ts, values
+    if analytics.import_numpy():
+        np = analytics.np
+        idx = analytics.lttb(np.asarray(ts, dtype=np.float64), np.asarray(values, dtype=np.float64), BACKFILL_POINTS)
+        return [ts[i] for i in idx], [values[i] for i in idx]
+    # Sin NumPy se submuestrea a intervalos regulares
+    step = len(ts) / BACKFILL_POINTS
+    idx = [int(i * step) for i in range(BACKFILL_POINTS - 1)] + [len(ts) - 1]
+    return [ts[i] for i in idx], [values[i] for i in idx]
+
+def _compute_series(device_name, sensor_type, start, end):
+    resolution, points = get_sensor_history(device_name, sensor_type, start, end, "auto", BACKFILL_MAX_INPUT)
+    ts = [point[0] for point in points]
+    values = [point[3] for point in points] # Media del bucket (o el valor, en datos crudos)
+    ts, values = _downsample(ts, values)
+    # Las lecturas crudas aún en la cola de ingesta no están en la DB: se cubre solo hasta
+    # la última leída (la DB guarda milisegundos, así que hasta el final de ese milisegundo)
+    # y el resto llega de la caché en memoria en las peticiones siguientes
+    covered = ts[-1] + 0.001 if resolution == "raw" and ts else end
+    return ts, values, covered
+
+def _append_readings(readings):
+    # Listener de ingesta: las lecturas nuevas se añaden a las series en caché
+    with _lock:
+        if not _cache_by_series:
+            return
+        for device_name, sensor_type, value, ts in readings:
+            keys = _cache_by_series.get((device_name, sensor_type))
+            if not keys:
+                continue
+            for key in list(keys):
+                entry = _cache[key]
+                if len(entry.tail) >= BACKFILL_MAX_TAIL or (entry.tail and ts < entry.tail[-1][0]):
+                    # Demasiadas lecturas o una atrasada: se recalcula en la próxima petición
+                    _drop(key)
+                    _stats["invalidations"] += 1
+                else:
+                    entry.tail.append((ts, value))
+
+def _drop(key):
+    # Se llama con _lock tomado
+    del _cache[key]
+    keys = _cache_by_series[key[:2]]
+    keys.discard(key)
+    if not keys:
+        del _cache_by_series[key[:2]]
+
+def get_series(device_name, sensor_type, range_seconds):
+    """
+    Serie submuestreada (ts, values) de los últimos 'range_seconds' segundos.
+    """
+    global _listening
+    if not _listening:
+        add_ingest_listener(_append_readings)
+        _listening = True
+    key = (device_name, sensor_type, range_seconds)
+    now = time.time()
+    start = now - range_seconds
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None and entry.computed is not None and time.monotonic() - entry.computed < BACKFILL_CACHE_TTL:
+            _cache.move_to_end(key)
+            _stats["hits"] += 1
+            first = bisect_left(entry.ts, start)
+            return entry.ts[first:] + [t for t, _ in entry.tail], entry.values[first:] + [v for _, v in entry.tail]
+        # Se registra antes de leer la DB para no perder las lecturas que lleguen mientras tanto
+        if entry is not None:
+            _drop(key)
+        entry = _cache[key] = _Entry()
+        _cache_by_series.setdefault(key[:2], set()).add(key)
+        _stats["misses"] += 1
+
+    ts, values, covered = _compute_series(device_name, sensor_type, start, now)
+    with _lock:
+        tail = [(t, v) for t, v in entry.tail if t > covered]
+        if _cache.get(key) is entry:
+            entry.ts, entry.values, entry.covered, entry.tail = ts, values, covered, tail
+            entry.computed = time.monotonic()
+            while len(_cache) > BACKFILL_CACHE_MAX_ENTRIES:
+                _drop(next(iter(_cache)))
+    return ts + [t for t, _ in tail], values + [v for _, v in tail]
+
+def _encode(device_name, ts, values):
+    deltas = []
+    previous = int(round(ts[0] * 1000))
+    for t in ts:
+        ms = int(round(t * 1000))
+        deltas.append(ms - previous)
+        previous = ms
+    return {
+        "device": device_name,
+        "t0": round(ts[0], 3),
+        "dt": deltas,
+        "v": [round(v, BACKFILL_VALUE_DECIMALS) for v in values],
+    }
+
+def get_backfill(sensor_type, range_seconds=BACKFILL_DEFAULT_RANGE):
+    """
+    Payload 'history_backfill' de un tipo de sensor: una serie submuestreada por
+    dispositivo con lecturas en el rango.
+    """
+    with _lock:
+        _stats["requests"] += 1
+    devices = get_series_devices(sensor_type, time.time() - range_seconds)
+    if len(devices) > BACKFILL_MAX_DEVICES:
+        logger.warning("Backfill for %s limited to %s of %s devices.", sensor_type, BACKFILL_MAX_DEVICES, len(devices))
+        devices = devices[:BACKFILL_MAX_DEVICES]
+    series = []
+    for device_name in devices:
+        ts, values = get_series(device_name, sensor_type, range_seconds)
+        if ts:
+            series.append(_encode(device_name, ts, values))
+    return {"type": sensor_type, "range": range_seconds, "series": series}
+
+def get_backfill_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["entries"] = len(_cache)
+    return stats
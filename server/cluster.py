@@ -0,0 +1,246 @@
+# cluster.py
+# Modo de despliegue multiproceso para producción (se lanza con: python start.py serve).
+#
+#   supervisor (este proceso) ── inicializa la DB, mantenimiento, proceso escritor único
+#   │                            (dbwriter.py) y, con local://, el broker de pubsub.py
+#   ├── worker 0 ─┐
+#   ├── worker 1  ├─ servidores eventlet/gevent escuchando en el mismo puerto con
+#   └── worker N ─┘  SO_REUSEPORT; comparten Socket.IO por la cola de mensajes y
+#                    envían todas sus escrituras al proceso escritor por IPC.
+#
+# El supervisor reinicia los workers que terminan inesperadamente y, al recibir
+# SIGTERM/SIGINT, detiene los workers (que vacían su cola de ingesta) antes que al escritor.
+# Este módulo solo importa la biblioteca estándar al cargarse: los workers deben aplicar
+# el monkey patching de eventlet/gevent antes de importar el servidor.
+
+import argparse
+import importlib.util
+import os
+import secrets
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# --- CONFIGURACIÓN DEL CLÚSTER ---
+CLUSTER_APPS = {"http": "run.py", "mqtt": "run-mqtt.py"}
+ASYNC_MODES = ("eventlet", "gevent", "threading")
+WORKER_RESTART_DELAY = 1.0       # Segundos mínimos entre reinicios de un mismo worker
+WORKER_SHUTDOWN_TIMEOUT = 10.0   # Segundos que se espera a que un worker se detenga antes de matarlo
+WORKER_LOST_WRITER_EXIT = 3      # Código de salida de un worker que perdió el proceso escritor
+MQTT_DEFAULT_SHARED_GROUP = "flaskhs" # Sin grupo compartido cada worker recibiría todos los mensajes MQTT
+
+logger = None
+
+def _raise_shutdown(signum, frame):
+    # SIGTERM se trata como Ctrl+C: los servidores de eventlet, gevent y Werkzeug ya paran con KeyboardInterrupt
+    raise KeyboardInterrupt()
+
+# --- WORKERS ---
+
+def _reuse_port_socket(host, port):
+    """
+    Socket de escucha con SO_REUSEPORT: cada worker abre el suyo en el mismo puerto
+    y el kernel reparte las conexiones nuevas entre ellos.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("SO_REUSEPORT is not available on this platform; multi-worker mode needs Linux or BSD")
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    return sock
+
+def _load_app(name):
+    # run-mqtt.py no es un nombre de módulo válido, así que se carga por ruta
+    path = os.path.join(SERVER_DIR, CLUSTER_APPS[name])
+    spec = importlib.util.spec_from_file_location(os.path.splitext(CLUSTER_APPS[name])[0].replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def _serve(async_mode, sock, app):
+    if async_mode == "eventlet":
+        import eventlet.wsgi
+        eventlet.wsgi.server(sock, app, log_output=False) # 'sock' ya es un socket verde tras el monkey patching
+    elif async_mode == "gevent":
+        from gevent import pywsgi
+        try:
+            from geventwebsocket.handler import WebSocketHandler
+        except ImportError:
+            raise RuntimeError("gevent mode needs the gevent-websocket package for WebSocket transport")
+        pywsgi.WSGIServer(sock, app, handler_class=WebSocketHandler, log=None).serve_forever()
+    else:
+        from werkzeug.serving import make_server
+        host, port = sock.getsockname()[:2]
+        make_server(host, port, app, threaded=True, fd=sock.fileno()).serve_forever()
+
+def run_worker(args):
+    """
+    Proceso worker: monkey patching, servidor web con SO_REUSEPORT, conexión con el
+    proceso escritor y servicios en segundo plano del servidor elegido.
+    """
+    global logger
+    if args.async_mode == "eventlet":
+        import eventlet
+        eventlet.monkey_patch()
+    elif args.async_mode == "gevent":
+        from gevent import monkey
+        monkey.patch_all()
+
+    from logs import get_logger
+    logger = get_logger(f"worker.{args.worker_id}")
+    sock = _reuse_port_socket(args.host, args.port)
+    server = _load_app(args.app)
+
+    import actuators
+    import dbwriter
+    import registry
+    from database import publish_external_readings
+
+    def on_writer_event(kind, payload):
+        if kind == "readings":
+            publish_external_readings(payload)
+        elif kind == "devices":
+            registry.merge_devices(payload)
+        elif kind == "actuators":
+            actuators.merge_states(payload)
+
+    def on_writer_lost():
+        # Sin proceso escritor no se puede guardar nada: salir y dejar que el supervisor decida
+        os._exit(WORKER_LOST_WRITER_EXIT)
+
+    dbwriter.connect_writer(args.writer, os.environ["FLASKHS_IPC_TOKEN"], args.worker_id, on_writer_event, on_writer_lost)
+    signal.signal(signal.SIGTERM, _raise_shutdown)
+    server.start_services()
+    logger.info("Worker %s (pid %s, %s) serving on %s:%s", args.worker_id, os.getpid(), args.async_mode, args.host, args.port)
+    try:
+        _serve(args.async_mode, sock, server.app)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Una segunda señal (Ctrl+C llega a todo el grupo y el supervisor reenvía SIGTERM)
+        # no debe interrumpir el vaciado de la cola de ingesta hacia el proceso escritor
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        server.stop_services()
+        dbwriter.disconnect_writer()
+    return 0
+
+# --- SUPERVISOR ---
+
+def _spawn_worker(args, worker_id, writer_address, env):
+    command = [sys.executable, os.path.abspath(__file__), "--worker-id", str(worker_id), "--writer", writer_address,
+               "--app", args.app, "--async-mode", args.async_mode, "--host", args.host, "--port", str(args.port)]
+    if worker_id != 0:
+        # Todos los workers reciben todas las lecturas (eco del escritor): las reglas de
+        # rules.py se evalúan solo en el worker 0 para no disparar cada acción N veces
+        env = dict(env, FLASKHS_RULES="0")
+    return subprocess.Popen(command, cwd=SERVER_DIR, env=env)
+
+def _stop_workers(workers):
+    for process in workers.values():
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+    for worker_id, process in workers.items():
+        try:
+            process.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            logger.warning("Worker %s did not stop in %ss, killing it.", worker_id, WORKER_SHUTDOWN_TIMEOUT)
+            process.kill()
+            process.wait()
+
+def supervise(args):
+    """
+    Proceso supervisor y escritor único: prepara la base de datos, arranca el servicio
+    de escritura y la cola de mensajes local si hace falta, y mantiene los workers vivos.
+    """
+    global logger
+    from logs import get_logger
+    logger = get_logger("cluster")
+    from database import init_db, start_maintenance, stop_maintenance, start_spool_replayer, stop_spool_replayer
+    import dbwriter
+    import pubsub
+
+    token = secrets.token_hex(16)
+    init_db() # Esquema y migraciones una sola vez, antes de que arranquen los workers
+    start_maintenance()
+    start_spool_replayer() # Lecturas guardadas en disco cuando la base de datos no estaba disponible
+    writer_address = dbwriter.start_writer_service(token)
+
+    message_queue = args.message_queue
+    if message_queue == pubsub.LOCAL_QUEUE_SCHEME or (not message_queue and args.workers > 1):
+        message_queue = pubsub.start_broker(token)
+
+    env = dict(os.environ)
+    env.update({
+        "FLASKHS_IPC_TOKEN": token,
+        "FLASKHS_ASYNC_MODE": args.async_mode,
+        "FLASKHS_MESSAGE_QUEUE": message_queue or "",
+        "FLASKHS_WEBSOCKET_ONLY": "1" if args.workers > 1 else "0",
+    })
+    if args.app == "mqtt" and args.workers > 1:
+        env.setdefault("FLASKHS_MQTT_SHARED_GROUP", MQTT_DEFAULT_SHARED_GROUP)
+
+    signal.signal(signal.SIGTERM, _raise_shutdown)
+    workers = {}
+    started = {}
+    try:
+        for worker_id in range(args.workers):
+            workers[worker_id] = _spawn_worker(args, worker_id, writer_address, env)
+            started[worker_id] = time.monotonic()
+        logger.info("Started %s %s worker(s) on %s:%s (message queue: %s)", args.workers, args.async_mode,
+                    args.host, args.port, message_queue or "none")
+        while True:
+            time.sleep(0.5)
+            for worker_id, process in list(workers.items()):
+                code = process.poll()
+                if code is None or time.monotonic() - started[worker_id] < WORKER_RESTART_DELAY:
+                    continue
+                logger.warning("Worker %s exited with code %s, restarting it.", worker_id, code)
+                workers[worker_id] = _spawn_worker(args, worker_id, writer_address, env)
+                started[worker_id] = time.monotonic()
+    except KeyboardInterrupt:
+        logger.info("Shutting down %s worker(s)...", len(workers))
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        _stop_workers(workers)
+        dbwriter.stop_writer_service()
+        stop_spool_replayer()
+        stop_maintenance()
+        logger.info("Database writer stopped: %s", dbwriter.get_writer_stats())
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Run the flaskHS server as several worker processes with a single database writer.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Web worker processes (default: CPU count)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--app", choices=sorted(CLUSTER_APPS), default="http", help="http: run.py, mqtt: run-mqtt.py")
+    parser.add_argument("--async-mode", choices=ASYNC_MODES, default="eventlet",
+                        help="Worker server; 'threading' uses Werkzeug and is meant for testing")
+    parser.add_argument("--message-queue", default="",
+                        help="Socket.IO message queue URL (redis://, amqp://, kafka://...) or local:// for the built-in broker "
+                             "(default with several workers)")
+    # Argumentos internos de los workers lanzados por el supervisor
+    parser.add_argument("--worker-id", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--writer", help=argparse.SUPPRESS)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.worker_id is not None:
+        return run_worker(args)
+    if args.workers < 1:
+        print("Error: --workers must be at least 1")
+        return 2
+    return supervise(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+# codec.py
+# Formato binario compacto para las lecturas de sensores, alternativo al JSON de
+# /api/sensor y MQTT. Un mensaje es una secuencia de frames, uno por dispositivo:
+#
+#   cabecera  <2sBBB   magic b"FH", versión, flags, longitud del nombre del dispositivo
+#   nombre    UTF-8    (longitud 0: el dispositivo se toma del tópico MQTT)
+#   base      <QH      timestamp base en ms (0 = momento de recepción), número de lecturas
+#   lecturas  <Bf      id del tipo de sensor, valor float32 (~7 cifras) (5 bytes)
+#             <BIf     id, desplazamiento en ms desde la base, valor   (9 bytes, con FLAG_OFFSETS)
+#
+# Todo en little-endian y sin relleno, como lo escribe un struct empaquetado en el ESP32.
+# El decodificador recorre el buffer con memoryview y struct.iter_unpack, sin copiarlo.
+
+import math
+import struct
+
+BINARY_CONTENT_TYPE = "application/x-flaskhs-sensor" # Content-Type en HTTP
+MQTT_BINARY_SUFFIX = "/bin"                          # Sufijo de tópico MQTT: sensors/<device>/data/bin
+
+FRAME_MAGIC = b"FH"
+FRAME_VERSION = 1
+FLAG_OFFSETS = 0x01  # Cada lectura lleva su desplazamiento en ms respecto al timestamp base
+
+# Ids de tipos de sensor. Solo se añaden ids nuevos al final: cambiar uno existente
+# rompe el firmware ya desplegado.
+SENSOR_TYPES = {
+    1: "ldr_ads1115_V",
+    2: "mic_ads1115_V",
+    3: "light_esp32_adc",
+    4: "mic_esp32_adc",
+    5: "temperature",
+    6: "humidity",
+    7: "light",
+    8: "sound",
+}
+SENSOR_TYPE_IDS = {name: type_id for type_id, name in SENSOR_TYPES.items()}
+
+_HEADER = struct.Struct("<2sBBB")
+_BASE = struct.Struct("<QH")
+_RECORD = struct.Struct("<Bf")
+_RECORD_OFFSET = struct.Struct("<BIf")
+
+def iter_frames(data):
+    """
+    Recorre los frames de un buffer binario y entrega (device, base_ts, flags, records),
+    con 'base_ts' en epoch segundos (None si el dispositivo no lo envió), 'device' None si
+    el frame no lo incluye y 'records' un memoryview sobre las lecturas del frame.
+    Lanza ValueError si el buffer está truncado o no es de este formato.
+    """
+    view = memoryview(data)
+    pos = 0
+    while pos < len(view):
+        if len(view) - pos < _HEADER.size:
+            raise ValueError("Truncated binary frame header")
+        magic, version, flags, device_len = _HEADER.unpack_from(view, pos)
+        if magic != FRAME_MAGIC or version != FRAME_VERSION:
+            raise ValueError("Not a binary sensor frame (bad magic or version)")
+        pos += _HEADER.size
+        if len(view) - pos < device_len + _BASE.size:
+            raise ValueError("Truncated binary frame")
+        try:
+            device = str(view[pos:pos + device_len], "utf-8") if device_len else None
+        except UnicodeDecodeError:
+            raise ValueError("Device name is not valid UTF-8")
+        pos += device_len
+        base_ms, count = _BASE.unpack_from(view, pos)
+        pos += _BASE.size
+        size = count * (_RECORD_OFFSET.size if flags & FLAG_OFFSETS else _RECORD.size)
+        if len(view) - pos < size:
+            raise ValueError("Truncated binary frame readings")
+        yield device, (base_ms / 1000.0 if base_ms else None), flags, view[pos:pos + size]
+        pos += size
+
+def frame_readings(device, base_ts, flags, records):
+    """
+    Convierte las lecturas de un frame en tuplas (device, sensor_type, value, ts).
+    'base_ts' debe venir ya resuelto (timestamp del dispositivo o de recepción).
+    Lanza ValueError si aparece un id de tipo de sensor desconocido o un valor no finito
+    (NaN o infinito en float32).
+    """
+    readings = []
+    if flags & FLAG_OFFSETS:
+        for type_id, offset_ms, value in _RECORD_OFFSET.iter_unpack(records):
+            sensor_type = SENSOR_TYPES.get(type_id)
+            if sensor_type is None:
+                raise ValueError(f"Unknown sensor type id {type_id}")
+            if not math.isfinite(value):
+                raise ValueError(f"Non-finite value for sensor '{sensor_type}'")
+            readings.append((device, sensor_type, value, base_ts + offset_ms / 1000.0))
+    else:
+        for type_id, value in _RECORD.iter_unpack(records):
+            sensor_type = SENSOR_TYPES.get(type_id)
+            if sensor_type is None:
+                raise ValueError(f"Unknown sensor type id {type_id}")
+            if not math.isfinite(value):
+                raise ValueError(f"Non-finite value for sensor '{sensor_type}'")
+            readings.append((device, sensor_type, value, base_ts))
+    return readings
+
+def decode_readings(data, received_at, device=None):
+    """
+    Decodifica un mensaje binario completo en una lista de lecturas
+    (device, sensor_type, value, ts). 'device' se usa en los frames sin nombre y
+    'received_at' en los frames sin timestamp base. Lanza ValueError si no es válido.
+    """
+    readings = []
+    for frame_device, base_ts, flags, records in iter_frames(data):
+        frame_device = frame_device or device
+        if not frame_device:
+            raise ValueError("Binary frame without device name")
+        readings.extend(frame_readings(frame_device, base_ts or received_at, flags, records))
+    return readings
+
+def encode_frame(device, readings, base_ts=None):
+    """
+    Codificador de referencia (para pruebas y simuladores). 'readings' es una lista de
+    (sensor_type, value) o (sensor_type, value, ts); con timestamps por lectura se
+    usa FLAG_OFFSETS con la base en el más antiguo. 'device' puede ser None o "".
+    """
+    name = (device or "").encode("utf-8")
+    if len(name) > 255:
+        raise ValueError("Device name longer than 255 bytes")
+    if len(readings) > 0xFFFF:
+        raise ValueError("Too many readings for one frame")
+    timestamps = [reading[2] for reading in readings if len(reading) > 2]
+    if timestamps and len(timestamps) != len(readings):
+        raise ValueError("Either all readings or none must have a timestamp")
+    flags = FLAG_OFFSETS if timestamps else 0
+    if timestamps:
+        base_ts = min(timestamps)
+    base_ms = int(round(base_ts * 1000)) if base_ts else 0
+    parts = [_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, flags, len(name)), name, _BASE.pack(base_ms, len(readings))]
+    for reading in readings:
+        type_id = SENSOR_TYPE_IDS.get(reading[0])
+        if type_id is None:
+            raise ValueError(f"Sensor type '{reading[0]}' has no binary id")
+        if flags & FLAG_OFFSETS:
+            parts.append(_RECORD_OFFSET.pack(type_id, int(round(reading[2] * 1000)) - base_ms, reading[1]))
+        else:
+            parts.append(_RECORD.pack(type_id, reading[1]))
+    return b"".join(parts)
@@ -1,144 +1,1813 @@
 import sqlite3
 import os
-from datetime import datetime
+import atexit
+import heapq
+import math
+import queue
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import spool
+from logs import get_logger
+from metrics import Gauge, DB_CONNECT_SECONDS, DB_EXECUTE_SECONDS, DB_COMMIT_SECONDS
+
+logger = get_logger("database")
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "../automation.db")
+DB_PATH = os.environ.get("FLASKHS_DB_PATH", os.path.join(BASE_DIR, "../automation.db"))
+
+# --- CONFIGURACIÓN DEL POOL DE CONEXIONES ---
+DB_POOL_MAX_CONNECTIONS = 8        # Conexiones simultáneas máximas; el resto espera a que se libere una
+DB_POOL_WAIT_TIMEOUT = 10.0        # Segundos máximos esperando una conexión libre
+DB_BUSY_TIMEOUT_MS = 5000          # PRAGMA busy_timeout: espera de SQLite ante un bloqueo
+DB_CACHE_SIZE_KB = 16384           # PRAGMA cache_size (en KiB) por conexión
+DB_MMAP_SIZE = 256 * 1024 * 1024   # PRAGMA mmap_size en bytes (0 lo desactiva)
+DB_CACHED_STATEMENTS = 256         # Sentencias preparadas reutilizadas por conexión
+DB_LOCK_RETRIES = 3                # Reintentos adicionales ante "database is locked"
+DB_LOCK_RETRY_DELAY = 0.05         # Espera base (segundos) entre reintentos, con backoff exponencial
+
+# --- CONFIGURACIÓN DE LA COLA DE INGESTA (write-behind) ---
+# Las lecturas de sensores se encolan en memoria y un único hilo escritor las
+# vuelca a SQLite con executemany, una transacción por lote.
+INGEST_QUEUE_MAXSIZE = 10000     # Lecturas pendientes máximas antes de aplicar backpressure
+INGEST_BATCH_SIZE = 500          # Lecturas máximas por transacción
+INGEST_BATCH_MAX_AGE = 0.5       # Segundos máximos que se espera para completar un lote
+INGEST_OVERFLOW_POLICY = "block" # "block": esperar hasta INGEST_PUT_TIMEOUT y luego descartar; "drop": descartar al instante
+INGEST_PUT_TIMEOUT = 0.25        # Segundos de espera con la cola llena en modo "block"
+INGEST_SHUTDOWN_TIMEOUT = 5.0    # Segundos máximos para vaciar la cola al apagar el servidor
+INGEST_MIN_TIMESTAMP = 946684800 # 2000-01-01: descarta relojes de dispositivos sin sincronizar
+INGEST_MAX_FUTURE_SKEW = 300     # Segundos que un timestamp puede adelantarse al reloj del servidor
+
+# --- CONFIGURACIÓN DEL SPOOL DE INGESTA ---
+# Las lecturas que no se pueden escribir (base de datos bloqueada, llena, en migración o
+# con la cola llena) se guardan en un log en disco (spool.py) y un hilo las reproduce en
+# SQLite cuando vuelve a estar disponible. Con FLASKHS_SPOOL=always todas las lecturas
+# van primero al spool y ese hilo es el que escribe, en transacciones más grandes.
+SPOOL_MODE = os.environ.get("FLASKHS_SPOOL", "fallback") # "fallback", "always" u "off"
+SPOOL_DIR = os.environ.get("FLASKHS_SPOOL_DIR", DB_PATH + "-spool")
+SPOOL_REPLAY_BATCH = 5000        # Lecturas máximas por transacción al reproducir el spool
+SPOOL_REPLAY_INTERVAL = 0.5      # Segundos entre comprobaciones del spool
+SPOOL_RETRY_MAX_DELAY = 30.0     # Espera máxima (backoff exponencial) tras un fallo al reproducirlo
+
+# --- CONFIGURACIÓN DE ROLLUPS E HISTÓRICO ---
+# Agregados (min, max, avg, count, last) por (dispositivo, sensor) mantenidos en la ingesta.
+# Nombre de la resolución -> ancho del bucket en segundos, de la más fina a la más gruesa.
+ROLLUP_RESOLUTIONS = {"1m": 60, "1h": 3600, "1d": 86400}
+HISTORY_DEFAULT_POINTS = 500     # Puntos objetivo por defecto para /api/sensor/history
+HISTORY_RAW_INTERVAL = 1.0       # Intervalo estimado (s) entre lecturas crudas, para decidir si usar datos crudos
+
+EXPORT_CHUNK_SIZE = 1000         # Filas leídas por consulta al exportar (memoria constante)
+
+# --- CONFIGURACIÓN DE PARTICIONES Y RETENCIÓN ---
+# Ancho de cada partición cruda: 86400 (diaria) o 604800 (semanal). La vista 'sensor_data'
+# admite como máximo ~500 particiones (límite de SELECT compuestos de SQLite).
+RAW_PARTITION_SECONDS = 86400
+RAW_PARTITION_ORIGIN = 345600    # 1970-01-05 (lunes): las particiones semanales empiezan en lunes
+# Días de retención por nivel: datos crudos y cada resolución de rollup
+RETENTION_DAYS = {"raw": 7, "1m": 30, "1h": 365, "1d": 3650}
+# Excepciones por tipo de sensor, p. ej. {"mic_ads1115_V": {"raw": 2, "1m": 7}}
+RETENTION_DAYS_BY_TYPE = {}
+MAINTENANCE_INTERVAL = 3600      # Segundos entre pasadas del hilo de mantenimiento
+MAINTENANCE_VACUUM_PAGES = 2000  # Páginas liberadas por pasada de incremental_vacuum
+MIGRATION_CHUNK_SIZE = 5000      # Filas movidas por transacción al migrar particiones v1 al esquema v2
+MIGRATION_PAUSE = 0.05           # Pausa (s) entre bloques de la migración para no acaparar el bloqueo de escritura
+
+# --- CONFIGURACIÓN DE LA CACHÉ DE LECTURAS RECIENTES ---
+CACHE_SERIES_CAPACITY = 128          # Lecturas recientes guardadas por (dispositivo, sensor)
+CACHE_MAX_BYTES = 8 * 1024 * 1024    # Memoria máxima de los buffers; al superarla se expulsan las series inactivas (LRU)
+
+# --- POOL DE CONEXIONES ---
+
+_pool_lock = threading.Condition()
+_pool_idle = []      # Conexiones libres (LIFO para reutilizar las que tienen sentencias en caché)
+_pool_open = 0       # Conexiones abiertas (libres + en uso)
+_pool_local = threading.local() # Conexión en uso por el hilo/greenlet actual (para llamadas anidadas)
+_pool_stats = {
+    "opened": 0,        # Conexiones creadas desde el arranque
+    "checkouts": 0,     # Préstamos de conexión servidos
+    "waits": 0,         # Préstamos que tuvieron que esperar una conexión libre
+    "wait_ms_total": 0.0,
+    "wait_ms_max": 0.0,
+    "timeouts": 0,      # Préstamos que agotaron DB_POOL_WAIT_TIMEOUT
+    "lock_retries": 0,  # Reintentos por "database is locked"
+    "lock_failures": 0, # Sentencias que siguieron bloqueadas tras agotar los reintentos
+}
+
+def _open_connection():
+    """
+    Abre y configura una conexión nueva: WAL, synchronous=NORMAL, busy_timeout,
+    cache_size y mmap_size. check_same_thread=False permite que la conexión pase
+    de un hilo/greenlet a otro a través del pool.
+    """
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False,
+                           timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                           cached_statements=DB_CACHED_STATEMENTS)
+    conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT_MS)}")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{int(DB_CACHE_SIZE_KB)}")
+    conn.execute(f"PRAGMA mmap_size = {int(DB_MMAP_SIZE)}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+def _checkout_connection():
+    global _pool_open
+    start = time.perf_counter()
+    waited = False
+    with _pool_lock:
+        while True:
+            while _pool_idle:
+                conn, path = _pool_idle.pop()
+                if path == DB_PATH:
+                    break
+                # DB_PATH cambió: descartar conexiones a la base anterior
+                conn.close()
+                _pool_open -= 1
+            else:
+                conn = None
+            if conn is not None:
+                break
+            if _pool_open < DB_POOL_MAX_CONNECTIONS:
+                _pool_open += 1
+                break
+            waited = True
+            remaining = DB_POOL_WAIT_TIMEOUT - (time.perf_counter() - start)
+            if remaining <= 0 or not _pool_lock.wait(remaining):
+                if not _pool_idle and _pool_open >= DB_POOL_MAX_CONNECTIONS:
+                    _pool_stats["timeouts"] += 1
+                    raise sqlite3.OperationalError(f"timed out waiting for a database connection ({DB_POOL_MAX_CONNECTIONS} in use)")
+
+        _pool_stats["checkouts"] += 1
+        if waited:
+            wait_ms = (time.perf_counter() - start) * 1000
+            _pool_stats["waits"] += 1
+            _pool_stats["wait_ms_total"] += wait_ms
+            _pool_stats["wait_ms_max"] = max(_pool_stats["wait_ms_max"], wait_ms)
+
+    if conn is None:
+        try:
+            conn = _open_connection()
+        except sqlite3.Error:
+            with _pool_lock:
+                _pool_open -= 1
+                _pool_lock.notify()
+            raise
+        with _pool_lock:
+            _pool_stats["opened"] += 1
+    DB_CONNECT_SECONDS.since(start)
+    return conn
+
+def _checkin_connection(conn, broken=False):
+    global _pool_open
+    with _pool_lock:
+        if broken:
+            conn.close()
+            _pool_open -= 1
+        else:
+            _pool_idle.append((conn, DB_PATH))
+        _pool_lock.notify()
+
+class _PooledConnection:
+    """
+    Préstamo de una conexión del pool para usar con 'with'. Al salir hace commit
+    (o rollback si hubo una excepción) y devuelve la conexión al pool. Las llamadas
+    anidadas en el mismo hilo/greenlet reutilizan la conexión ya prestada.
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.owner = False
+
+    def __enter__(self):
+        held = getattr(_pool_local, "conn", None)
+        if held is not None:
+            self.conn = held
+            return held
+        try:
+            self.conn = _checkout_connection()
+        except sqlite3.Error as e:
+            logger.error("Error connecting to database at %s: %s", DB_PATH, e)
+            return None
+        self.owner = True
+        _pool_local.conn = self.conn
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.conn is None:
+            return False
+        broken = False
+        try:
+            if exc_type is None:
+                start = time.perf_counter()
+                self.conn.commit()
+                DB_COMMIT_SECONDS.since(start)
+            else:
+                self.conn.rollback()
+        except sqlite3.Error as e:
+            logger.error("Error finishing database transaction: %s", e)
+            broken = True
+        if self.owner:
+            _pool_local.conn = None
+            _checkin_connection(self.conn, broken)
+        return False
 
 def get_connection():
     """
-    Establece una conexión a la base de datos SQLite.
-    check_same_thread=False es necesario para el uso con Flask-SocketIO y Eventlet.
+    Presta una conexión a la base de datos SQLite desde el pool.
+    Debe usarse como 'with get_connection() as conn:'; 'conn' es None si no se
+    pudo obtener una conexión.
     """
-    try:
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        return conn
-    except sqlite3.Error as e:
-        print(f"Error connecting to database at {DB_PATH}: {e}")
-        return None
+    return _PooledConnection()
+
+def close_all_connections():
+    """
+    Cierra las conexiones libres del pool (las prestadas se cierran al devolverse
+    si el pool ya no las reconoce).
+    """
+    global _pool_open
+    with _pool_lock:
+        while _pool_idle:
+            conn, _ = _pool_idle.pop()
+            conn.close()
+            _pool_open -= 1
+
+def get_pool_stats():
+    """
+    Retorna estadísticas del pool de conexiones para dimensionarlo.
+    """
+    with _pool_lock:
+        stats = dict(_pool_stats)
+        stats["open"] = _pool_open
+        stats["idle"] = len(_pool_idle)
+        stats["in_use"] = _pool_open - len(_pool_idle)
+        stats["max"] = DB_POOL_MAX_CONNECTIONS
+    return stats
+
+def _is_locked_error(e):
+    return "locked" in str(e) or "busy" in str(e)
+
+def _execute(c, sql, params=(), many=False):
+    """
+    Ejecuta una sentencia reintentando con backoff exponencial si SQLite reporta
+    que la base está bloqueada más allá de busy_timeout.
+    """
+    start = time.perf_counter()
+    operation = "executemany" if many else "execute"
+    for attempt in range(DB_LOCK_RETRIES + 1):
+        try:
+            cursor = c.executemany(sql, params) if many else c.execute(sql, params)
+            DB_EXECUTE_SECONDS.since(start, (operation,))
+            return cursor
+        except sqlite3.OperationalError as e:
+            if not _is_locked_error(e):
+                raise
+            if attempt == DB_LOCK_RETRIES:
+                with _pool_lock:
+                    _pool_stats["lock_failures"] += 1
+                raise
+            with _pool_lock:
+                _pool_stats["lock_retries"] += 1
+            time.sleep(DB_LOCK_RETRY_DELAY * (2 ** attempt))
+
+atexit.register(close_all_connections)
+
+# --- MIGRACIONES DEL ESQUEMA ---
+# La versión del esquema se guarda en PRAGMA user_version. init_db() solo ejecuta las
+# migraciones posteriores a esa versión: en un arranque con la base de datos al día
+# no se ejecuta ningún DDL. Cada migración debe poder repetirse sin efectos (IF NOT
+# EXISTS...), porque si el proceso muere antes de guardar la versión se vuelve a
+# ejecutar. Las migraciones nuevas se añaden siempre al final de _MIGRATIONS.
+
+def _migrate_base_schema(conn):
+    """
+    Esquema anterior a las migraciones: estado de los LEDs, datos de sensores
+    particionados, dispositivos y rollups. En una base de datos de una versión anterior
+    (user_version 0) solo crea lo que falte.
+    """
+    c = conn.cursor()
+    # Solo tiene efecto en una base de datos nueva (sin tablas); permite el
+    # vacuum incremental del hilo de mantenimiento
+    c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS led_state (
+            id INTEGER PRIMARY KEY,
+            red INTEGER DEFAULT 0,
+            green INTEGER DEFAULT 0
+        )
+    """)
+    c.execute("INSERT OR IGNORE INTO led_state (id, red, green) VALUES (1, 0, 0)")
+    conn.commit()
+    create_sensor_table(conn)
+    create_devices_table(conn)
+    create_rollup_tables(conn)
+
+def _migrate_actuator_state(conn):
+    create_actuator_table(conn)
+
+_MIGRATIONS = (
+    (1, "base schema", _migrate_base_schema),
+    (2, "actuator state", _migrate_actuator_state),
+)
+SCHEMA_VERSION = _MIGRATIONS[-1][0]
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
 
 def init_db():
     """
-    Inicializa la base de datos, creando las tablas necesarias si no existen.
-    También inserta el estado inicial de los LEDs si la tabla está vacía.
+    Inicializa la base de datos aplicando las migraciones pendientes del esquema.
+    Retorna True si el esquema quedó en SCHEMA_VERSION.
     """
     with get_connection() as conn:
         if conn is None:
-            print("Failed to get database connection during initialization.")
+            logger.error("Failed to get database connection during initialization.")
+            return False
+        try:
+            version = get_schema_version(conn)
+        except sqlite3.Error as e:
+            logger.error("Error reading database schema version: %s", e)
+            return False
+        if version >= SCHEMA_VERSION:
+            if version > SCHEMA_VERSION:
+                logger.warning("Database schema version %s is newer than this server (%s).", version, SCHEMA_VERSION)
+            return True
+        for number, description, migrate in _MIGRATIONS:
+            if number <= version:
+                continue
+            try:
+                migrate(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                logger.error("Error migrating database schema to version %s (%s): %s", number, description, e)
+                return False
+            logger.info("Database schema migrated to version %s (%s).", number, description)
+        return True
+
+def create_sensor_table(conn):
+    """
+    Prepara el almacenamiento particionado de 'sensor_data': los diccionarios de
+    dispositivos y tipos, el registro de particiones, la partición actual y la
+    vista 'sensor_data' que las une. Si existe una tabla 'sensor_data' de una
+    versión anterior, se registra como partición v1 para migrarla en segundo plano.
+    Lanza sqlite3.Error si falla.
+    """
+    c = conn.cursor()
+    _create_dictionary_tables(c)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS sensor_partitions (
+            name TEXT PRIMARY KEY,
+            start INTEGER NOT NULL,
+            end INTEGER NOT NULL,
+            format INTEGER NOT NULL DEFAULT 1
+        )
+    """)
+    columns = [row[1] for row in c.execute("PRAGMA table_info(sensor_partitions)")]
+    if "format" not in columns:
+        # Registro creado antes del esquema v2: todas sus particiones son v1
+        c.execute("ALTER TABLE sensor_partitions ADD COLUMN format INTEGER NOT NULL DEFAULT 1")
+    conn.commit()
+    row = c.execute("SELECT type FROM sqlite_master WHERE name = 'sensor_data'").fetchone()
+    if row and row[0] == "table":
+        _migrate_legacy_sensor_table(conn)
+    _invalidate_partitions()
+    _ensure_partitions(conn, [time.time()])
+    with conn:
+        _rebuild_sensor_view(conn)
+    logger.info("Table 'sensor_data' checked/created and indexed.")
+
+def create_devices_table(conn):
+    """
+    Crea la tabla 'devices' para registrar los microcontroladores.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS devices (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            ip TEXT NOT NULL,
+            type TEXT NOT NULL,
+            last_seen DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+    logger.info("Table 'devices' checked/created.")
+
+
+# --- ALMACENAMIENTO PARTICIONADO POR TIEMPO ---
+# Las lecturas crudas se guardan en una tabla por periodo registrada en
+# 'sensor_partitions' con su rango [start, end). La vista 'sensor_data' une todas
+# las particiones para las consultas existentes, y la retención elimina
+# particiones completas con DROP TABLE en lugar de un DELETE masivo.
+#
+# Esquema v2 ('sensor_data_v2_pYYYYMMDD'): dispositivo y tipo de sensor como ids
+# enteros de los diccionarios 'sensor_devices' y 'sensor_types', timestamp 'ts'
+# en epoch milisegundos y clave primaria (device_id, sensor_type_id, ts) en una
+# tabla WITHOUT ROWID. Las particiones v1 (columnas de texto, versiones anteriores)
+# se migran en segundo plano a una gemela v2 con el mismo rango; mientras dura la
+# migración un rango puede tener las dos tablas y las lecturas las combinan.
+
+SENSOR_FORMAT_V1 = 1
+SENSOR_FORMAT_V2 = 2
+
+_partitions_lock = threading.Lock()
+_partitions = None  # Caché de [(name, start, end, format)] ordenada por rango; None obliga a releer el registro
+_partitions_schema = None # PRAGMA schema_version con el que se leyó la caché
+
+_dictionary_lock = threading.Lock()
+_dictionary = {"sensor_devices": {}, "sensor_types": {}} # nombre -> id ya confirmados en la base de datos
+
+def _partition_start(ts):
+    width = RAW_PARTITION_SECONDS
+    return int((ts - RAW_PARTITION_ORIGIN) // width) * width + RAW_PARTITION_ORIGIN
+
+def _to_ms(ts):
+    return int(round(ts * 1000))
+
+def _invalidate_partitions():
+    global _partitions
+    with _partitions_lock:
+        _partitions = None
+
+def _get_partitions(conn):
+    """
+    Retorna la lista de particiones [(name, start, end, format)] ordenada por (start, format).
+    La caché se relee cuando cambia el esquema de la base de datos (CREATE/DROP de
+    particiones hechos por otro proceso, p. ej. el escritor del supervisor en modo cluster).
+    """
+    global _partitions, _partitions_schema
+    schema = _execute(conn, "PRAGMA schema_version").fetchone()[0]
+    with _partitions_lock:
+        if _partitions is None or schema != _partitions_schema:
+            _partitions = [tuple(row) for row in _execute(conn, """
+                SELECT name, start, end, format FROM sensor_partitions ORDER BY start, format
+            """).fetchall()]
+            _partitions_schema = schema
+        return _partitions
+
+def _partition_ranges(conn, start=None, end=None, descending=False):
+    """
+    Agrupa por rango las particiones que se solapan con [start, end] (epoch en segundos).
+    Retorna [(start, end, [(name, format), ...])]; los rangos no se solapan entre sí.
+    """
+    ranges = []
+    for name, p_start, p_end, fmt in _get_partitions(conn):
+        if (start is not None and p_end <= start) or (end is not None and p_start > end):
+            continue
+        if ranges and ranges[-1][0] == p_start:
+            ranges[-1][2].append((name, fmt))
+        else:
+            ranges.append((p_start, p_end, [(name, fmt)]))
+    return ranges[::-1] if descending else ranges
+
+def _partition_for(conn, ts):
+    """
+    Nombre de la partición v2 donde debe escribirse una lectura con timestamp 'ts',
+    o None si aún no existe.
+    """
+    for name, p_start, p_end, fmt in _get_partitions(conn):
+        if fmt == SENSOR_FORMAT_V2 and p_start <= ts < p_end:
+            return name
+    return None
+
+def _create_dictionary_tables(c):
+    c.execute("CREATE TABLE IF NOT EXISTS sensor_devices (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    c.execute("CREATE TABLE IF NOT EXISTS sensor_types (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+
+def _intern(conn, table, names):
+    """
+    Retorna {nombre: id} para 'names' en el diccionario 'table', insertando los
+    nombres nuevos (en orden alfabético) en una transacción propia.
+    """
+    cache = _dictionary[table]
+    with _dictionary_lock:
+        missing = sorted({name for name in names if name not in cache})
+    if missing:
+        with conn:
+            _execute(conn, f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", [(name,) for name in missing], many=True)
+        placeholders = ",".join("?" * len(missing))
+        rows = _execute(conn, f"SELECT name, id FROM {table} WHERE name IN ({placeholders})", missing).fetchall()
+        with _dictionary_lock:
+            cache.update(rows)
+    with _dictionary_lock:
+        return {name: cache[name] for name in names}
+
+def _lookup_ids(conn, table, names):
+    """
+    Como _intern pero sin escribir: retorna {nombre: id} solo para los nombres de
+    'names' que ya están en el diccionario 'table'. Es la única búsqueda permitida en
+    los caminos de lectura (las escrituras son del escritor y de la migración).
+    """
+    cache = _dictionary[table]
+    with _dictionary_lock:
+        missing = sorted({name for name in names if name not in cache})
+    if missing:
+        placeholders = ",".join("?" * len(missing))
+        rows = _execute(conn, f"SELECT name, id FROM {table} WHERE name IN ({placeholders})", missing).fetchall()
+        with _dictionary_lock:
+            cache.update(rows)
+    with _dictionary_lock:
+        return {name: cache[name] for name in names if name in cache}
+
+def _partition_view_select(name, fmt):
+    """
+    SELECT que presenta una partición con las columnas de la vista 'sensor_data':
+    device_name, sensor_type, value, timestamp (texto) y ts (epoch ms).
+    """
+    if fmt == SENSOR_FORMAT_V2:
+        return f"""SELECT d.name AS device_name, t.name AS sensor_type, p.value AS value,
+                   strftime('%Y-%m-%d %H:%M:%f', p.ts / 1000.0, 'unixepoch') AS timestamp, p.ts AS ts
+                   FROM {name} p JOIN sensor_devices d ON d.id = p.device_id JOIN sensor_types t ON t.id = p.sensor_type_id"""
+    return f"""SELECT device_name, sensor_type, value, timestamp,
+               CAST(ROUND((julianday(timestamp) - 2440587.5) * 86400000) AS INTEGER) AS ts FROM {name}"""
+
+def _rebuild_sensor_view(conn):
+    """
+    Recrea la vista 'sensor_data' como UNION ALL de todas las particiones registradas.
+    """
+    parts = conn.execute("SELECT name, format FROM sensor_partitions ORDER BY start, format").fetchall()
+    conn.execute("DROP VIEW IF EXISTS sensor_data")
+    if not parts:
+        return
+    union = " UNION ALL ".join(_partition_view_select(name, fmt) for name, fmt in parts)
+    conn.execute(f"CREATE VIEW sensor_data AS {union}")
+
+def _ensure_partitions(conn, timestamps):
+    """
+    Crea (en una transacción propia) las particiones v2 necesarias para escribir
+    lecturas con los 'timestamps' dados y actualiza la vista 'sensor_data'. Si el
+    rango ya tiene una partición v1, la v2 se crea con su mismo rango.
+    """
+    missing = set()
+    for ts in timestamps:
+        if _partition_for(conn, ts) is not None:
+            continue
+        covering = [(p_start, p_end) for _, p_start, p_end, _ in _get_partitions(conn) if p_start <= ts < p_end]
+        if covering:
+            missing.add(covering[0])
+        else:
+            start = _partition_start(ts)
+            missing.add((start, start + RAW_PARTITION_SECONDS))
+    if not missing:
+        return
+    with conn:
+        for start, end in sorted(missing):
+            suffix = "legacy" if start == 0 else "p" + datetime.fromtimestamp(start, timezone.utc).strftime("%Y%m%d")
+            name = f"sensor_data_v2_{suffix}"
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {name} (
+                    device_id INTEGER NOT NULL,
+                    sensor_type_id INTEGER NOT NULL,
+                    ts INTEGER NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (device_id, sensor_type_id, ts)
+                ) WITHOUT ROWID
+            """)
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_type_ts ON {name} (sensor_type_id, ts)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_ts ON {name} (ts)")
+            _execute(conn, "INSERT OR IGNORE INTO sensor_partitions (name, start, end, format) VALUES (?, ?, ?, ?)",
+                     (name, start, end, SENSOR_FORMAT_V2))
+        _rebuild_sensor_view(conn)
+    _invalidate_partitions()
+
+def _migrate_legacy_sensor_table(conn):
+    """
+    Registra la tabla 'sensor_data' monolítica de versiones anteriores como la
+    partición v1 'sensor_data_legacy', con rango hasta el final del periodo actual.
+    Su contenido se pasa al esquema v2 en segundo plano (migrate_sensor_partitions)
+    y el rango completo se elimina cuando expira su último dato.
+    """
+    end = _partition_start(time.time()) + RAW_PARTITION_SECONDS
+    with conn:
+        conn.execute("ALTER TABLE sensor_data RENAME TO sensor_data_legacy")
+        conn.execute("""
+            INSERT OR REPLACE INTO sensor_partitions (name, start, end, format)
+            VALUES ('sensor_data_legacy', 0, ?, ?)
+        """, (end, SENSOR_FORMAT_V1))
+    _invalidate_partitions()
+    logger.info("Legacy 'sensor_data' table registered as partition 'sensor_data_legacy'.")
+
+def _select_latest(c, name, fmt, sensor_type, limit):
+    """
+    Últimas 'limit' lecturas de un tipo de sensor en una partición: [(ts_ms, device_name, value)].
+    """
+    if fmt == SENSOR_FORMAT_V2:
+        return _execute(c, f"""
+            SELECT p.ts, d.name, p.value FROM {name} p JOIN sensor_devices d ON d.id = p.device_id
+            WHERE p.sensor_type_id = (SELECT id FROM sensor_types WHERE name = ?)
+            ORDER BY p.ts DESC LIMIT ?
+        """, (sensor_type, limit)).fetchall()
+    rows = _execute(c, f"""
+        SELECT timestamp, device_name, value FROM {name}
+        WHERE sensor_type = ?
+        ORDER BY timestamp DESC LIMIT ?
+    """, (sensor_type, limit)).fetchall()
+    return [(_to_ms(parse_timestamp(ts)), device_name, value) for ts, device_name, value in rows]
+
+def _select_series(c, name, fmt, device_name, sensor_type, start, end):
+    """
+    Lecturas de una serie en [start, end] (epoch en segundos) en una partición: [(ts_ms, value)].
+    """
+    if fmt == SENSOR_FORMAT_V2:
+        return _execute(c, f"""
+            SELECT ts, value FROM {name}
+            WHERE device_id = (SELECT id FROM sensor_devices WHERE name = ?)
+              AND sensor_type_id = (SELECT id FROM sensor_types WHERE name = ?)
+              AND ts >= ? AND ts <= ?
+            ORDER BY ts
+        """, (device_name, sensor_type, _to_ms(start), _to_ms(end))).fetchall()
+    rows = _execute(c, f"""
+        SELECT timestamp, value FROM {name}
+        WHERE device_name = ? AND sensor_type = ? AND timestamp >= ? AND timestamp <= ?
+        ORDER BY timestamp
+    """, (device_name, sensor_type, format_timestamp(start), format_timestamp(end))).fetchall()
+    return [(_to_ms(parse_timestamp(ts)), value) for ts, value in rows]
+
+_MAX_ID = 2 ** 63 - 1 # Mayor id posible en SQLite
+
+def _sort_id(ids, name):
+    """
+    Posición de un nombre en la clave de exportación: (0, id) si está en el diccionario
+    o (1, nombre) si no (filas v1 aún sin migrar, cursores con nombres desconocidos),
+    que se ordenan detrás de todos los ids.
+    """
+    return (0, ids[name]) if name in ids else (1, name)
+
+def _iter_partition(name, fmt, device_name, sensor_type, start, end, after, chunk_size):
+    """
+    Recorre una partición en bloques con paginación por clave. Entrega tuplas
+    (clave, fila) con clave = (ts_ms, _sort_id(dispositivo), _sort_id(tipo)) y
+    fila = (ts_ms, device_name, sensor_type, value, timestamp), ordenadas por clave.
+    """
+    if fmt == SENSOR_FORMAT_V2:
+        conditions = ["(p.ts, p.device_id, p.sensor_type_id) > (?, ?, ?)"]
+        params = []
+        if device_name is not None:
+            conditions.append("p.device_id = (SELECT id FROM sensor_devices WHERE name = ?)")
+            params.append(device_name)
+        if sensor_type is not None:
+            conditions.append("p.sensor_type_id = (SELECT id FROM sensor_types WHERE name = ?)")
+            params.append(sensor_type)
+        if start is not None:
+            conditions.append("p.ts >= ?")
+            params.append(_to_ms(start))
+        if end is not None:
+            conditions.append("p.ts <= ?")
+            params.append(_to_ms(end))
+        if after is None:
+            key = (-1, -1, -1)
+        else:
+            # Un nombre sin id en el cursor va detrás de todas las filas v2 de su posición
+            ts, (device_unknown, device_id), (type_unknown, type_id) = after
+            key = (ts, _MAX_ID, _MAX_ID) if device_unknown else (ts, device_id, _MAX_ID if type_unknown else type_id)
+        while True:
+            with get_connection() as conn:
+                if conn is None: return
+                rows = _execute(conn, f"""
+                    SELECT p.ts, p.device_id, p.sensor_type_id, d.name, t.name, p.value FROM {name} p
+                    JOIN sensor_devices d ON d.id = p.device_id JOIN sensor_types t ON t.id = p.sensor_type_id
+                    WHERE {" AND ".join(conditions)}
+                    ORDER BY p.ts, p.device_id, p.sensor_type_id LIMIT ?
+                """, (*key, *params, chunk_size)).fetchall()
+            for ts, device_id, sensor_type_id, d, t, value in rows:
+                yield (ts, (0, device_id), (0, sensor_type_id)), (ts, d, t, value, format_timestamp(ts / 1000))
+            if len(rows) < chunk_size:
+                return
+            key = rows[-1][:3]
+
+    # Partición v1 (en migración): se pagina por (timestamp, id) y se normaliza cada fila
+    conditions = ["(timestamp, id) > (?, ?)"]
+    params = []
+    if device_name is not None:
+        conditions.append("device_name = ?")
+        params.append(device_name)
+    if sensor_type is not None:
+        conditions.append("sensor_type = ?")
+        params.append(sensor_type)
+    if start is not None:
+        conditions.append("timestamp >= ?")
+        params.append(format_timestamp(start))
+    if end is not None:
+        conditions.append("timestamp <= ?")
+        params.append(format_timestamp(end))
+    # Al reanudar se parte del inicio del segundo del cursor (los timestamps v1 pueden no tener milisegundos)
+    cursor = (format_timestamp(after[0] / 1000)[:19], 0) if after else ("", 0)
+    while True:
+        with get_connection() as conn:
+            if conn is None: return
+            rows = _execute(conn, f"""
+                SELECT id, timestamp, device_name, sensor_type, value FROM {name}
+                WHERE {" AND ".join(conditions)}
+                ORDER BY timestamp, id LIMIT ?
+            """, (*cursor, *params, chunk_size)).fetchall()
+            devices = _lookup_ids(conn, "sensor_devices", {row[2] for row in rows})
+            types = _lookup_ids(conn, "sensor_types", {row[3] for row in rows})
+        for _, timestamp, d, t, value in rows:
+            ts = _to_ms(parse_timestamp(timestamp))
+            key = (ts, _sort_id(devices, d), _sort_id(types, t))
+            if after is None or key > after:
+                yield key, (ts, d, t, value, format_timestamp(ts / 1000))
+        if len(rows) < chunk_size:
             return
+        cursor = (rows[-1][1], rows[-1][0])
 
-        c = conn.cursor()
+def migrate_sensor_partitions(chunk_size=None, pause=None):
+    """
+    Migración en línea de las particiones v1 al esquema v2: mueve bloques de
+    'chunk_size' filas (copia + borrado en la misma transacción, así las lecturas
+    nunca ven duplicados) y elimina cada tabla v1 al vaciarse. Entre bloques se
+    libera el bloqueo de escritura durante 'pause' segundos.
+    Retorna True al terminar o False si se interrumpe por un error.
+    """
+    chunk_size = chunk_size or MIGRATION_CHUNK_SIZE
+    pause = MIGRATION_PAUSE if pause is None else pause
+    moved = 0
+    while not _maintenance_stop.is_set():
+        with get_connection() as conn:
+            if conn is None: return False
+            try:
+                pending = [(name, p_start) for name, p_start, _, fmt in _get_partitions(conn) if fmt == SENSOR_FORMAT_V1]
+                if not pending:
+                    if moved:
+                        logger.info("Sensor data migration to schema v2 finished (%s rows).", moved)
+                    return True
+                name, p_start = pending[0]
+                _ensure_partitions(conn, [p_start])
+                target = _partition_for(conn, p_start)
+                rows = _execute(conn, f"""
+                    SELECT id, device_name, sensor_type, value, timestamp FROM {name}
+                    ORDER BY id LIMIT ?
+                """, (chunk_size,)).fetchall()
+                if not rows:
+                    with conn:
+                        conn.execute(f"DROP TABLE IF EXISTS {name}")
+                        conn.execute("DELETE FROM sensor_partitions WHERE name = ?", (name,))
+                        _rebuild_sensor_view(conn)
+                    _invalidate_partitions()
+                    continue
+                devices = _intern(conn, "sensor_devices", {row[1] for row in rows})
+                types = _intern(conn, "sensor_types", {row[2] for row in rows})
+                with conn:
+                    _execute(conn, f"""
+                        INSERT OR IGNORE INTO {target} (device_id, sensor_type_id, ts, value)
+                        VALUES (?, ?, ?, ?)
+                    """, [(devices[d], types[t], _to_ms(parse_timestamp(ts)), value)
+                          for _, d, t, value, ts in rows], many=True)
+                    _execute(conn, f"DELETE FROM {name} WHERE id <= ?", (rows[-1][0],))
+                moved += len(rows)
+            except (sqlite3.Error, ValueError) as e:
+                logger.error("Error migrating sensor data to schema v2: %s", e)
+                return False
+        time.sleep(pause)
+    return False
+
+def _retention_days(sensor_type, tier):
+    return RETENTION_DAYS_BY_TYPE.get(sensor_type, {}).get(tier, RETENTION_DAYS[tier])
+
+def apply_retention(now=None):
+    """
+    Aplica la política de retención: elimina con DROP TABLE las particiones crudas
+    cuyo rango ha expirado para todos los tipos de sensor, borra las lecturas de los
+    tipos con retención más corta dentro de las particiones que se conservan, y
+    recorta las tablas de rollup.
+    """
+    now = time.time() if now is None else now
+    raw_days = [RETENTION_DAYS["raw"]] + [
+        overrides["raw"] for overrides in RETENTION_DAYS_BY_TYPE.values() if "raw" in overrides]
+    oldest_cutoff = now - max(raw_days) * 86400
+    dropped = 0
+    with get_connection() as conn:
+        if conn is None: return
         try:
-            # Tabla led_state
-            c.execute("""
-                CREATE TABLE IF NOT EXISTS led_state (
-                    id INTEGER PRIMARY KEY,
-                    red INTEGER DEFAULT 0,
-                    green INTEGER DEFAULT 0
-                )
-            """)
-            c.execute("INSERT OR IGNORE INTO led_state (id, red, green) VALUES (1, 0, 0)")
-            conn.commit()
-            print("Table 'led_state' checked/created and initialized.")
+            # Mantener siempre la partición actual para que la vista 'sensor_data' exista
+            _ensure_partitions(conn, [now])
+            expired = [name for name, _, p_end, _ in _get_partitions(conn) if p_end <= oldest_cutoff]
+            if expired:
+                with conn:
+                    for name in expired:
+                        conn.execute(f"DROP TABLE IF EXISTS {name}")
+                        conn.execute("DELETE FROM sensor_partitions WHERE name = ?", (name,))
+                    _rebuild_sensor_view(conn)
+                _invalidate_partitions()
+                dropped = len(expired)
+
+            # Tipos con retención cruda más corta que la más larga: DELETE acotado por índice
+            types = {row[0] for row in _execute(conn, "SELECT DISTINCT sensor_type FROM sensor_rollup_1d")}
+            for sensor_type in types | set(RETENTION_DAYS_BY_TYPE):
+                cutoff = now - _retention_days(sensor_type, "raw") * 86400
+                if cutoff <= oldest_cutoff:
+                    continue
+                with conn:
+                    for _, _, tables in _partition_ranges(conn, end=cutoff):
+                        for name, fmt in tables:
+                            if fmt == SENSOR_FORMAT_V2:
+                                _execute(conn, f"""
+                                    DELETE FROM {name}
+                                    WHERE sensor_type_id = (SELECT id FROM sensor_types WHERE name = ?) AND ts < ?
+                                """, (sensor_type, _to_ms(cutoff)))
+                            else:
+                                _execute(conn, f"DELETE FROM {name} WHERE sensor_type = ? AND timestamp < ?",
+                                         (sensor_type, format_timestamp(cutoff)))
+
+            with conn:
+                for resolution in ROLLUP_RESOLUTIONS:
+                    overrides = [t for t, o in RETENTION_DAYS_BY_TYPE.items() if resolution in o]
+                    cutoff = now - RETENTION_DAYS[resolution] * 86400
+                    placeholders = ",".join("?" * len(overrides))
+                    _execute(conn, f"""
+                        DELETE FROM sensor_rollup_{resolution}
+                        WHERE bucket < ? AND sensor_type NOT IN ({placeholders})
+                    """, (cutoff, *overrides))
+                    for sensor_type in overrides:
+                        _execute(conn, f"DELETE FROM sensor_rollup_{resolution} WHERE sensor_type = ? AND bucket < ?",
+                                 (sensor_type, now - RETENTION_DAYS_BY_TYPE[sensor_type][resolution] * 86400))
         except sqlite3.Error as e:
-            print(f"Error creating/initializing 'led_state' table: {e}")
+            logger.error("Error applying retention policy: %s", e)
+            return
+    if dropped:
+        logger.info("Retention: dropped %s expired sensor partition(s).", dropped)
 
-        # Crear otras tablas
-        create_sensor_table(conn)
-        create_devices_table(conn) # Función para crear la tabla de dispositivos
+# --- MANTENIMIENTO EN SEGUNDO PLANO ---
 
-def create_sensor_table(conn):
+_maintenance_thread = None
+_maintenance_stop = threading.Event()
+
+def run_maintenance():
     """
-    Crea la tabla 'sensor_data' si no existe y añade un índice para optimización.
+    Una pasada de mantenimiento: retención y vacuum incremental (si la base de
+    datos usa auto_vacuum=INCREMENTAL) para devolver al disco las páginas liberadas.
+    """
+    apply_retention()
+    with get_connection() as conn:
+        if conn is None: return
+        try:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                conn.execute(f"PRAGMA incremental_vacuum({int(MAINTENANCE_VACUUM_PAGES)})").fetchall()
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+        except sqlite3.Error as e:
+            logger.error("Error running database maintenance: %s", e)
+
+def _maintenance_loop():
+    # Primero se completa la migración al esquema v2 (si hay particiones v1 pendientes)
+    migrate_sensor_partitions()
+    while not _maintenance_stop.wait(MAINTENANCE_INTERVAL):
+        run_maintenance()
+
+def start_maintenance():
+    """
+    Arranca el hilo de mantenimiento, que migra las particiones v1 pendientes y
+    después ejecuta run_maintenance() cada MAINTENANCE_INTERVAL segundos.
+    """
+    global _maintenance_thread
+    if _maintenance_thread is not None and _maintenance_thread.is_alive():
+        return
+    _maintenance_stop.clear()
+    _maintenance_thread = threading.Thread(target=_maintenance_loop, name="db-maintenance", daemon=True)
+    _maintenance_thread.start()
+
+def stop_maintenance():
+    _maintenance_stop.set()
+
+def create_rollup_tables(conn):
+    """
+    Crea una tabla de rollup por resolución ('sensor_rollup_1m', '_1h', '_1d').
+    Se guarda la suma en lugar del promedio para poder acumular lotes incrementalmente.
     """
     c = conn.cursor()
-    try:
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS sensor_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+    for resolution in ROLLUP_RESOLUTIONS:
+        c.execute(f"""
+            CREATE TABLE IF NOT EXISTS sensor_rollup_{resolution} (
                 device_name TEXT NOT NULL,
                 sensor_type TEXT NOT NULL,
-                value REAL NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        # Añadir índice para optimizar consultas de datos de sensores
-        c.execute("""
-            CREATE INDEX IF NOT EXISTS idx_sensor_data_type_timestamp
-            ON sensor_data (sensor_type, timestamp DESC);
+                bucket INTEGER NOT NULL,
+                min REAL NOT NULL,
+                max REAL NOT NULL,
+                sum REAL NOT NULL,
+                count INTEGER NOT NULL,
+                last REAL NOT NULL,
+                last_ts REAL NOT NULL,
+                PRIMARY KEY (device_name, sensor_type, bucket)
+            ) WITHOUT ROWID
         """)
-        conn.commit()
-        print("Table 'sensor_data' checked/created and indexed.")
-    except sqlite3.Error as e:
-        print(f"Error creating 'sensor_data' table or index: {e}")
+    conn.commit()
+    logger.info("Rollup tables checked/created.")
 
-def create_devices_table(conn):
+# --- CACHÉ EN MEMORIA DE LECTURAS RECIENTES ---
+
+class _SeriesRing:
     """
-    Crea la tabla 'devices' para registrar los microcontroladores.
+    Buffer circular de tamaño fijo con las lecturas más recientes de una serie
+    (dispositivo, sensor), respaldado por dos array('d') de timestamps y valores.
+    'complete_after' es el timestamp a partir del cual el buffer contiene todas
+    las lecturas de la serie (sube al sobrescribir o al descartar lecturas atrasadas).
     """
-    c = conn.cursor()
+    __slots__ = ("ts", "values", "head", "size", "complete_after")
+
+    def __init__(self, capacity, first_ts):
+        self.ts = array("d", bytes(8 * capacity))
+        self.values = array("d", bytes(8 * capacity))
+        self.head = 0  # Posición donde se escribirá la próxima lectura
+        self.size = 0
+        self.complete_after = first_ts
+
+    def push(self, value, ts):
+        capacity = len(self.ts)
+        if self.size:
+            newest = self.ts[self.head - 1]
+            if ts < newest:
+                # Lectura atrasada (p. ej. reenvío de un lote): no se guarda y el
+                # buffer deja de garantizar completitud hasta ese instante.
+                self.complete_after = max(self.complete_after, math.nextafter(ts, math.inf))
+                return
+        if self.size == capacity:
+            # Se sobrescribe la más antigua: la completitud empieza en la siguiente
+            self.complete_after = max(self.complete_after, self.ts[(self.head + 1) % capacity])
+        else:
+            self.size += 1
+        self.ts[self.head] = ts
+        self.values[self.head] = value
+        self.head = (self.head + 1) % capacity
+
+    def newest(self, n):
+        """
+        Retorna hasta 'n' lecturas (ts, value), de la más reciente a la más antigua.
+        """
+        capacity = len(self.ts)
+        idx = self.head
+        out = []
+        for _ in range(min(n, self.size)):
+            idx = (idx - 1) % capacity
+            out.append((self.ts[idx], self.values[idx]))
+        return out
+
+_cache_lock = threading.Lock()
+_cache_series = OrderedDict()   # (device_name, sensor_type) -> _SeriesRing, en orden LRU
+_cache_by_type = {}             # sensor_type -> {device_name: _SeriesRing}
+_cache_type_floor = {}          # sensor_type -> timestamp hasta el que la caché puede estar incompleta
+_cache_started = time.time()    # Lecturas anteriores al arranque solo están en la base de datos
+_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+def _cache_max_series():
+    return max(1, CACHE_MAX_BYTES // (16 * CACHE_SERIES_CAPACITY))
+
+def _cache_readings(readings):
+    """
+    Añade lecturas (device_name, sensor_type, value, ts) a la caché, expulsando
+    las series inactivas más antiguas si se supera CACHE_MAX_BYTES.
+    """
+    with _cache_lock:
+        for device_name, sensor_type, value, ts in readings:
+            key = (device_name, sensor_type)
+            ring = _cache_series.get(key)
+            if ring is None:
+                ring = _SeriesRing(CACHE_SERIES_CAPACITY, ts)
+                _cache_series[key] = ring
+                _cache_by_type.setdefault(sensor_type, {})[device_name] = ring
+            else:
+                _cache_series.move_to_end(key)
+            ring.push(value, ts)
+
+        max_series = _cache_max_series()
+        while len(_cache_series) > max_series:
+            (device_name, sensor_type), ring = _cache_series.popitem(last=False)
+            del _cache_by_type[sensor_type][device_name]
+            if ring.size:
+                newest = ring.ts[ring.head - 1]
+                _cache_type_floor[sensor_type] = max(_cache_type_floor.get(sensor_type, 0.0), newest)
+            _cache_stats["evictions"] += 1
+
+def _cached_latest(sensor_type, limit):
+    """
+    Intenta responder get_latest_sensor_data desde la caché. Retorna None si la
+    caché no puede garantizar que las 'limit' lecturas más recientes están en memoria.
+    """
+    with _cache_lock:
+        rings = _cache_by_type.get(sensor_type)
+        if not rings:
+            return None
+        candidates = heapq.nlargest(limit, (
+            (ts, device_name, value)
+            for device_name, ring in rings.items()
+            for ts, value in ring.newest(limit)
+        ))
+        if len(candidates) < limit:
+            return None
+        kth = candidates[-1][0]
+        if kth < max(_cache_started, _cache_type_floor.get(sensor_type, 0.0)):
+            return None
+        if any(ring.complete_after > kth for ring in rings.values()):
+            return None
+    return [(device_name, value, format_timestamp(ts)) for ts, device_name, value in candidates]
+
+def get_sensor_snapshot():
+    """
+    Retorna la última lectura en memoria de cada (dispositivo, sensor), agrupada
+    por dispositivo con el formato de 'sensor_update'.
+    """
+    by_device = {}
+    with _cache_lock:
+        for (device_name, sensor_type), ring in _cache_series.items():
+            if not ring.size:
+                continue
+            idx = ring.head - 1
+            by_device.setdefault(device_name, []).append(
+                {"type": sensor_type, "value": ring.values[idx], "timestamp": ring.ts[idx]})
+    return [{"device": device_name, "sensors": sensors} for device_name, sensors in by_device.items()]
+
+def get_cache_stats():
+    """
+    Retorna los contadores de aciertos/fallos de la caché y su ocupación.
+    """
+    with _cache_lock:
+        stats = dict(_cache_stats)
+        stats["series"] = len(_cache_series)
+        stats["max_series"] = _cache_max_series()
+        stats["bytes"] = len(_cache_series) * 16 * CACHE_SERIES_CAPACITY
+    return stats
+
+# --- PROCESO ESCRITOR DEDICADO (modo multiproceso) ---
+# En cluster.py solo el proceso escritor abre transacciones de escritura: los workers
+# web instalan un forwarder que envía cada escritura por IPC y la base de datos nunca
+# ve dos escritores a la vez (sin errores "database is locked" entre procesos).
+
+_write_forwarder = None # Función forwarder(operation, args) -> bool, o None para escribir aquí
+FORWARDED_WRITES = ("write_sensor_batch", "insert_sensor_data_batch", "update_led_state", "register_device", "upsert_devices",
+                    "upsert_actuator_states")
+
+def set_write_forwarder(forwarder):
+    """
+    Envía todas las escrituras de este proceso a forwarder(operation, args), que retorna
+    False si no se pudo entregar. Con None se vuelve a escribir en la base de datos local.
+    """
+    global _write_forwarder
+    _write_forwarder = forwarder
+
+def apply_forwarded_write(operation, args):
+    """
+    Ejecuta en el proceso escritor una escritura recibida de un worker.
+    """
+    if operation not in FORWARDED_WRITES:
+        raise ValueError(f"Unknown write operation '{operation}'")
+    return globals()[operation](*args)
+
+def publish_external_readings(readings):
+    """
+    Entrega a la caché y a los listeners de ingesta lecturas aceptadas por otro
+    proceso del clúster (sin escribirlas de nuevo).
+    """
+    _notify_ingest(readings)
+
+# --- INGESTA WRITE-BEHIND DE DATOS DE SENSORES ---
+
+_INGEST_STOP = object() # Centinela que indica al hilo escritor que debe terminar
+
+_ingest_queue = queue.Queue(maxsize=INGEST_QUEUE_MAXSIZE)
+_ingest_writer = None
+_ingest_writer_lock = threading.Lock()
+_ingest_stats_lock = threading.Lock()
+_ingest_stats = {
+    "enqueued": 0,   # Lecturas aceptadas en la cola
+    "written": 0,    # Lecturas escritas en la base de datos
+    "dropped": 0,    # Lecturas descartadas por cola llena
+    "failed": 0,     # Lecturas perdidas por errores de escritura
+    "forwarded": 0,  # Lecturas enviadas al proceso escritor (modo multiproceso)
+    "spooled": 0,    # Lecturas guardadas en el spool en disco
+    "replayed": 0,   # Lecturas del spool escritas en la base de datos
+    "batches": 0,    # Transacciones realizadas por el hilo escritor
+}
+
+_ingest_listeners = [] # Funciones llamadas con cada grupo de lecturas aceptadas
+
+def add_ingest_listener(listener):
+    """
+    Registra una función que recibe cada lista de lecturas aceptadas
+    [(device_name, sensor_type, value, ts)], tanto de la cola de ingesta como de
+    los lotes. Se llama en el hilo que ingesta, así que debe ser rápida.
+    """
+    if listener not in _ingest_listeners:
+        _ingest_listeners.append(listener)
+
+def _notify_ingest(readings):
+    _cache_readings(readings)
+    for listener in _ingest_listeners:
+        try:
+            listener(readings)
+        except Exception as e:
+            logger.error("Error in ingest listener %s: %s", getattr(listener, '__name__', listener), e)
+
+def _count_ingest(key, amount=1):
+    """
+    Suma 'amount' al contador 'key' y retorna su nuevo valor.
+    """
+    with _ingest_stats_lock:
+        _ingest_stats[key] += amount
+        return _ingest_stats[key]
+
+def validate_reading(device_name, sensor_type, value, ts):
+    """
+    Comprueba una lectura (device_name, sensor_type, value, ts) y la retorna con el valor
+    y el timestamp como float. Lanza ValueError si los nombres no son texto no vacío, el
+    valor o el timestamp no son números finitos o el timestamp está fuera de
+    [INGEST_MIN_TIMESTAMP, ahora + INGEST_MAX_FUTURE_SKEW].
+    """
+    if not isinstance(device_name, str) or not device_name:
+        raise ValueError(f"Invalid device name {device_name!r}")
+    if not isinstance(sensor_type, str) or not sensor_type:
+        raise ValueError(f"Invalid sensor type {sensor_type!r}")
     try:
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS devices (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE,
-                ip TEXT NOT NULL,
-                type TEXT NOT NULL,
-                last_seen DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
-        print("Table 'devices' checked/created.")
-    except sqlite3.Error as e:
-        print(f"Error creating 'devices' table: {e}")
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f"Invalid value for sensor '{sensor_type}': {value!r}")
+        if isinstance(ts, bool) or not isinstance(ts, (int, float)) or not math.isfinite(ts):
+            raise ValueError(f"Invalid timestamp for sensor '{sensor_type}': {ts!r}")
+        if ts < INGEST_MIN_TIMESTAMP or ts > time.time() + INGEST_MAX_FUTURE_SKEW:
+            raise ValueError(f"Timestamp out of range for sensor '{sensor_type}': {ts!r}")
+        return device_name, sensor_type, float(value), float(ts)
+    except OverflowError: # Entero demasiado grande para un float
+        raise ValueError(f"Value out of range for sensor '{sensor_type}'") from None
+
+def format_timestamp(ts):
+    """
+    Convierte un timestamp epoch (segundos, UTC) al formato de texto usado en la
+    columna 'timestamp' ('YYYY-MM-DD HH:MM:SS.fff', compatible con CURRENT_TIMESTAMP).
+    """
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+def parse_timestamp(value):
+    """
+    Convierte un timestamp enviado por un dispositivo a epoch en segundos (UTC).
+    Acepta epoch en segundos o milisegundos (números) o texto ISO 8601; las fechas
+    sin zona horaria se interpretan como UTC. Lanza ValueError si no es válido.
+    """
+    if isinstance(value, bool):
+        raise ValueError("timestamp must be a number or an ISO 8601 string")
+    if isinstance(value, (int, float)):
+        ts = float(value)
+        if ts > 1e11: # Epoch en milisegundos
+            ts /= 1000.0
+        return ts
+    if isinstance(value, str):
+        dt = datetime.fromisoformat(value.strip())
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp()
+    raise ValueError("timestamp must be a number or an ISO 8601 string")
+
+def _update_rollups(conn, batch):
+    """
+    Agrega un lote de lecturas por (dispositivo, sensor, bucket) y lo acumula en
+    las tablas de rollup con un UPSERT por resolución.
+    """
+    for resolution, width in ROLLUP_RESOLUTIONS.items():
+        buckets = {}
+        for device_name, sensor_type, value, ts in batch:
+            key = (device_name, sensor_type, int(ts // width) * width)
+            agg = buckets.get(key)
+            if agg is None:
+                buckets[key] = [value, value, value, 1, value, ts]
+                continue
+            if value < agg[0]: agg[0] = value
+            if value > agg[1]: agg[1] = value
+            agg[2] += value
+            agg[3] += 1
+            if ts >= agg[5]:
+                agg[4] = value
+                agg[5] = ts
+        _execute(conn, f"""
+            INSERT INTO sensor_rollup_{resolution}
+                (device_name, sensor_type, bucket, min, max, sum, count, last, last_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (device_name, sensor_type, bucket) DO UPDATE SET
+                min = MIN(min, excluded.min),
+                max = MAX(max, excluded.max),
+                sum = sum + excluded.sum,
+                count = count + excluded.count,
+                last = CASE WHEN excluded.last_ts >= last_ts THEN excluded.last ELSE last END,
+                last_ts = MAX(last_ts, excluded.last_ts)
+        """, [key + tuple(agg) for key, agg in buckets.items()], many=True)
+
+def _correct_rollups(conn, corrections):
+    """
+    Ajusta los rollups de lecturas que reemplazan a otra ya escrita con un valor distinto
+    [(device_name, sensor_type, value, ts, valor anterior)]: la suma (y la media) y 'last'
+    quedan exactos; min/max solo se amplían, no se recalculan si el valor sustituido era el extremo.
+    """
+    for resolution, width in ROLLUP_RESOLUTIONS.items():
+        _execute(conn, f"""
+            UPDATE sensor_rollup_{resolution} SET
+                sum = sum + ?,
+                min = MIN(min, ?),
+                max = MAX(max, ?),
+                last = CASE WHEN last_ts = ? THEN ? ELSE last END
+            WHERE device_name = ? AND sensor_type = ? AND bucket = ?
+        """, [(value - old, value, value, ts, value, device_name, sensor_type, int(ts // width) * width)
+              for device_name, sensor_type, value, ts, old in corrections], many=True)
+
+def _existing_values(conn, by_start):
+    """
+    Valores ya escritos en las particiones v2 para las claves de un lote agrupado por
+    partición: {(device_id, sensor_type_id, ts_ms): value}. Una consulta por serie y partición.
+    """
+    found = {}
+    for start, rows in by_start.items():
+        spans = {}
+        for device_id, type_id, ts, _ in rows:
+            span = spans.get((device_id, type_id))
+            spans[(device_id, type_id)] = (ts, ts) if span is None else (min(span[0], ts), max(span[1], ts))
+        table = _partition_for(conn, start)
+        for (device_id, type_id), (lo, hi) in spans.items():
+            for ts, value in _execute(conn, f"""
+                SELECT ts, value FROM {table} WHERE device_id = ? AND sensor_type_id = ? AND ts >= ? AND ts <= ?
+            """, (device_id, type_id, lo, hi)):
+                found[(device_id, type_id, ts)] = value
+    return found
 
+def _write_sensor_batch(conn, batch):
+    """
+    Escribe un lote de lecturas (device_name, sensor_type, value, ts) en sus
+    particiones en una sola transacción, actualizando también los rollups.
+    Una lectura repetida (misma serie y milisegundo) reemplaza a la anterior y no se
+    vuelve a contar en los rollups, así reescribir un lote (reintentos de los clientes,
+    spool) no los desvía de los datos crudos.
+    """
+    devices = _intern(conn, "sensor_devices", {reading[0] for reading in batch})
+    types = _intern(conn, "sensor_types", {reading[1] for reading in batch})
+    latest = {} # Última lectura del lote por clave
+    for device_name, sensor_type, value, ts in batch:
+        reading = (device_name, sensor_type, float(value), ts)
+        latest[(devices[device_name], types[sensor_type], _to_ms(ts))] = reading
+    by_start = {}
+    for key, reading in latest.items():
+        by_start.setdefault(_partition_start(reading[3]), []).append(key + (reading[2],))
+    _ensure_partitions(conn, by_start)
+    with conn:
+        previous = _existing_values(conn, by_start)
+        for start, rows in by_start.items():
+            _execute(conn, f"""
+                INSERT OR REPLACE INTO {_partition_for(conn, start)} (device_id, sensor_type_id, ts, value)
+                VALUES (?, ?, ?, ?)
+            """, rows, many=True)
+        new_readings, corrections = [], []
+        for key, reading in latest.items():
+            old = previous.get(key)
+            if old is None:
+                new_readings.append(reading)
+            elif old != reading[2]:
+                corrections.append(reading + (old,))
+        _update_rollups(conn, new_readings)
+        if corrections:
+            _correct_rollups(conn, corrections)
 
-def insert_sensor_data(device_name, sensor_type, value):
+def write_sensor_batch(batch):
     """
-    Inserta un nuevo registro de datos de sensor en la tabla 'sensor_data'.
+    Escribe un lote de lecturas en esta base de datos (sin notificar a los listeners).
+    Lanza sqlite3.Error si falla.
     """
     with get_connection() as conn:
-        if conn is None: return
-        c = conn.cursor()
+        if conn is None:
+            raise sqlite3.Error(f"no database connection available at {DB_PATH}")
+        _write_sensor_batch(conn, batch)
+
+def _ingest_writer_loop():
+    """
+    Bucle del hilo escritor: agrupa lecturas de la cola hasta INGEST_BATCH_SIZE o
+    INGEST_BATCH_MAX_AGE y las escribe con executemany en una única transacción.
+    """
+    stopping = False
+    while not stopping:
+        item = _ingest_queue.get()
+        if item is _INGEST_STOP:
+            _ingest_queue.task_done()
+            break
+
+        batch = [item]
+        deadline = time.monotonic() + INGEST_BATCH_MAX_AGE
+        while len(batch) < INGEST_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            try:
+                item = _ingest_queue.get(timeout=remaining) if remaining > 0 else _ingest_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _INGEST_STOP:
+                _ingest_queue.task_done()
+                stopping = True
+                # Al apagar, vaciar lo que quede en la cola en el último lote
+                while True:
+                    try:
+                        batch.append(_ingest_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                break
+            batch.append(item)
+
         try:
-            c.execute("""
-                INSERT INTO sensor_data (device_name, sensor_type, value)
-                VALUES (?, ?, ?)
-            """, (device_name, sensor_type, value))
-            conn.commit()
+            _write_ingest_batch(batch)
+            _count_ingest("batches")
+        except sqlite3.OperationalError as e:
+            _spool_or_fail(batch, e)
+        except Exception as e:
+            # Una lectura que no se puede escribir hace fallar todo el lote: se reintenta
+            # lectura a lectura para no perder las demás (ni el hilo escritor)
+            logger.error("Error writing batch of %s sensor readings, retrying one by one: %s", len(batch), e)
+            _write_ingest_rows(batch)
+        finally:
+            for _ in batch:
+                _ingest_queue.task_done()
+
+def _write_ingest_batch(batch):
+    if _write_forwarder is not None:
+        if not _write_forwarder("write_sensor_batch", (batch,)):
+            raise sqlite3.OperationalError("database writer process unavailable")
+        _count_ingest("forwarded", len(batch))
+    else:
+        write_sensor_batch(batch)
+        _count_ingest("written", len(batch))
+
+def _write_ingest_rows(batch):
+    """
+    Escribe un lote que falló lectura a lectura: se descartan solo las lecturas que no se
+    pueden escribir, y las que fallan por no estar disponible la base de datos van al spool.
+    """
+    unavailable = []
+    error = None
+    for reading in batch:
+        try:
+            _write_ingest_batch([reading])
+        except sqlite3.OperationalError as e:
+            unavailable.append(reading)
+            error = e
+        except Exception as e:
+            _count_ingest("failed")
+            logger.error("Discarding sensor reading %s: %s", reading, e)
+    if unavailable:
+        _spool_or_fail(unavailable, error)
+
+def _spool_or_fail(batch, error):
+    if spool_sensor_batch(batch):
+        logger.warning("Error writing batch of %s sensor readings, spooled for replay: %s", len(batch), error)
+    else:
+        _count_ingest("failed", len(batch))
+        logger.error("Error writing batch of %s sensor readings: %s", len(batch), error)
+
+def insert_sensor_data_batch(readings):
+    """
+    Inserta de forma síncrona una lista de lecturas (device_name, sensor_type, value, ts)
+    en una única transacción, sin pasar por la cola de ingesta. Si la escritura falla
+    se guardan en el spool para reproducirlas después.
+    Retorna True si se escribieron o guardaron todas; si no, no se escribe ninguna.
+    Lanza ValueError si alguna lectura no es válida (validate_reading).
+    """
+    if not readings:
+        return True
+    readings = [validate_reading(*reading) for reading in readings]
+    if _write_forwarder is not None:
+        # Modo multiproceso: se confirma la entrega al proceso escritor, no la escritura
+        if not _write_forwarder("insert_sensor_data_batch", (readings,)):
+            return False
+        _notify_ingest(readings)
+        return True
+    with get_connection() as conn:
+        try:
+            if conn is None:
+                raise sqlite3.Error(f"no database connection available at {DB_PATH}")
+            _write_sensor_batch(conn, readings)
         except sqlite3.Error as e:
-            print(f"Error inserting sensor data for {device_name} ({sensor_type}, {value}): {e}")
+            if not spool_sensor_batch(readings):
+                logger.error("Error inserting batch of %s sensor readings: %s", len(readings), e)
+                return False
+            logger.warning("Error inserting batch of %s sensor readings, spooled for replay: %s", len(readings), e)
+    _notify_ingest(readings)
+    return True
+
+def start_ingest_writer():
+    """
+    Arranca el hilo escritor de la cola de ingesta si no está en marcha.
+    Se invoca automáticamente al encolar la primera lectura.
+    """
+    global _ingest_writer
+    with _ingest_writer_lock:
+        if _ingest_writer is not None and _ingest_writer.is_alive():
+            return
+        _ingest_writer = threading.Thread(target=_ingest_writer_loop, name="sensor-ingest-writer", daemon=True)
+        _ingest_writer.start()
+
+def stop_ingest_writer(timeout=INGEST_SHUTDOWN_TIMEOUT):
+    """
+    Vacía la cola de ingesta y detiene el hilo escritor. Se registra con atexit
+    para no perder lecturas pendientes al apagar el servidor.
+    """
+    global _ingest_writer
+    with _ingest_writer_lock:
+        writer = _ingest_writer
+        _ingest_writer = None
+    if writer is None or not writer.is_alive():
+        return
+    try:
+        _ingest_queue.put(_INGEST_STOP, timeout=timeout)
+    except queue.Full:
+        logger.warning("Ingest queue still full at shutdown; pending sensor readings may be lost.")
+        return
+    writer.join(timeout)
+
+def flush_ingest(timeout=INGEST_SHUTDOWN_TIMEOUT):
+    """
+    Espera a que todas las lecturas encoladas hayan sido escritas (o descartadas por error).
+    Retorna True si la cola quedó vacía antes de 'timeout' segundos.
+    """
+    deadline = time.monotonic() + timeout
+    while _ingest_queue.unfinished_tasks:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+# --- SPOOL EN DISCO DE LA INGESTA ---
+
+_spool_replayer = None
+_spool_stop = threading.Event()
+_spool_wake = threading.Event()
+
+def spool_sensor_batch(readings):
+    """
+    Guarda un lote de lecturas en el spool en disco para escribirlo más tarde. Solo el
+    proceso que escribe en la base de datos tiene spool (no los workers de cluster.py).
+    Retorna False si el spool está desactivado o no se pudo guardar.
+    """
+    if SPOOL_MODE == "off" or _write_forwarder is not None:
+        return False
+    if not spool.open_spool(SPOOL_DIR) or not spool.append(readings):
+        return False
+    _count_ingest("spooled", len(readings))
+    if _spool_replayer is None:
+        start_spool_replayer()
+    if SPOOL_MODE == "always":
+        _spool_wake.set()
+    return True
+
+def replay_spool():
+    """
+    Escribe en la base de datos las lecturas pendientes del spool, SPOOL_REPLAY_BATCH
+    por transacción, avanzando el checkpoint tras cada una. Retorna False si la base de
+    datos no está disponible (las lecturas siguen en el spool y se reintentan). Un lote
+    que falla por otro motivo se escribe lectura a lectura y las que no se pueden
+    escribir pasan a la cuarentena del spool, para que no bloqueen las siguientes.
+    """
+    while True:
+        readings, position = spool.read_pending(SPOOL_REPLAY_BATCH)
+        replayed = len(readings)
+        if readings:
+            try:
+                write_sensor_batch(readings)
+            except sqlite3.OperationalError as e:
+                logger.warning("Could not replay %s spooled sensor readings, will retry: %s", len(readings), e)
+                return False
+            except Exception as e:
+                logger.error("Error replaying %s spooled sensor readings, retrying one by one: %s", len(readings), e)
+                rejected = _replay_one_by_one(readings)
+                if rejected is None:
+                    return False
+                replayed -= len(rejected)
+                _quarantine_readings(rejected)
+        if position is None:
+            return True
+        try:
+            spool.commit(position, replayed)
+        except OSError as e:
+            logger.error("Error updating ingest spool checkpoint: %s", e)
+            return False
+        _count_ingest("replayed", replayed)
+
+def _replay_one_by_one(readings):
+    """
+    Escribe lectura a lectura un lote del spool que falló. Retorna las lecturas que la
+    base de datos rechazó, o None si dejó de estar disponible a mitad del lote.
+    """
+    rejected = []
+    for reading in readings:
+        try:
+            write_sensor_batch([reading])
+        except sqlite3.OperationalError as e:
+            logger.warning("Could not replay spooled sensor readings, will retry: %s", e)
+            return None
+        except Exception as e:
+            logger.error("Quarantining spooled sensor reading %s: %s", reading, e)
+            rejected.append(reading)
+    return rejected
+
+def _quarantine_readings(readings):
+    if not readings:
+        return
+    if not spool.quarantine(readings):
+        logger.error("Discarding %s spooled sensor readings that could not be quarantined: %s", len(readings), readings)
+    _count_ingest("failed", len(readings))
+
+def _spool_replayer_loop():
+    delay = SPOOL_REPLAY_INTERVAL
+    while not _spool_stop.is_set():
+        _spool_wake.wait(delay)
+        _spool_wake.clear()
+        if _spool_stop.is_set():
+            break
+        if spool.pending_bytes() == 0:
+            delay = SPOOL_REPLAY_INTERVAL
+            continue
+        # Tras un fallo se espera cada vez más para no competir con una base de datos bloqueada
+        delay = SPOOL_REPLAY_INTERVAL if replay_spool() else min(delay * 2, SPOOL_RETRY_MAX_DELAY)
+
+def start_spool_replayer():
+    """
+    Abre el spool y arranca el hilo que lo reproduce en la base de datos, incluidas las
+    lecturas que quedaron pendientes de una ejecución anterior. Solo debe llamarse en el
+    proceso que escribe en la base de datos.
+    """
+    global _spool_replayer
+    if SPOOL_MODE == "off" or not spool.open_spool(SPOOL_DIR):
+        return
+    with _ingest_writer_lock:
+        if _spool_replayer is not None and _spool_replayer.is_alive():
+            return
+        _spool_stop.clear()
+        _spool_replayer = threading.Thread(target=_spool_replayer_loop, name="ingest-spool-replayer", daemon=True)
+        _spool_replayer.start()
+    _spool_wake.set()
+
+def stop_spool_replayer(timeout=INGEST_SHUTDOWN_TIMEOUT):
+    """
+    Detiene el hilo del spool tras un último intento de vaciarlo. Lo que no se pudo
+    escribir queda en disco para la próxima ejecución.
+    """
+    global _spool_replayer
+    with _ingest_writer_lock:
+        replayer = _spool_replayer
+        _spool_replayer = None
+    if replayer is None:
+        return
+    _spool_stop.set()
+    _spool_wake.set()
+    replayer.join(timeout)
+    replay_spool()
+    spool.close_spool()
+
+def get_ingest_stats():
+    """
+    Retorna los contadores de la cola de ingesta junto con su ocupación actual.
+    """
+    with _ingest_stats_lock:
+        stats = dict(_ingest_stats)
+    stats["queued"] = _ingest_queue.qsize()
+    return stats
+
+atexit.register(stop_spool_replayer)
+atexit.register(stop_ingest_writer) # atexit ejecuta en orden inverso: primero se vacía la cola
+
+# Estado de la ingesta y del pool, leído al generar /metrics
+Gauge("flaskhs_ingest_readings_total", "Sensor readings by ingest outcome", ("result",), metric_type="counter",
+      callback=lambda: {(key,): value for key, value in get_ingest_stats().items() if key not in ("queued", "batches")})
+Gauge("flaskhs_ingest_batches_total", "Write transactions made by the ingest writer", metric_type="counter",
+      callback=lambda: get_ingest_stats()["batches"])
+Gauge("flaskhs_ingest_queue_size", "Sensor readings waiting in the ingest queue", callback=lambda: _ingest_queue.qsize())
+Gauge("flaskhs_ingest_spool_bytes", "Bytes of sensor readings waiting in the ingest spool", callback=spool.pending_bytes)
+Gauge("flaskhs_db_pool_connections", "Pooled database connections", ("state",),
+      callback=lambda: {("in_use",): get_pool_stats()["in_use"], ("idle",): get_pool_stats()["idle"]})
+
+def insert_sensor_data(device_name, sensor_type, value, timestamp=None):
+    """
+    Encola un registro de datos de sensor para su escritura en la tabla 'sensor_data'.
+    La escritura real la realiza el hilo escritor en lotes; 'timestamp' (epoch en
+    segundos) por defecto es el momento de recepción. Con SPOOL_MODE "always" la
+    lectura va al spool, y con la cola llena también se intenta guardar en él.
+    Retorna False si la lectura se descartó. Lanza ValueError si no es válida
+    (validate_reading): se rechaza antes de encolarla para que no haga fallar su lote.
+    """
+    reading = validate_reading(device_name, sensor_type, value, time.time() if timestamp is None else timestamp)
+    if SPOOL_MODE == "always" and spool_sensor_batch((reading,)):
+        _notify_ingest((reading,))
+        return True
+    if _ingest_writer is None or not _ingest_writer.is_alive():
+        start_ingest_writer()
+    try:
+        if INGEST_OVERFLOW_POLICY == "block":
+            _ingest_queue.put(reading, timeout=INGEST_PUT_TIMEOUT)
+        else:
+            _ingest_queue.put_nowait(reading)
+    except queue.Full:
+        if spool_sensor_batch((reading,)):
+            _notify_ingest((reading,))
+            return True
+        dropped = _count_ingest("dropped")
+        # El límite de frecuencia de logs.py resume los avisos repetidos
+        logger.warning("Ingest queue full, dropping sensor data for %s (%s); dropped so far: %s", device_name, sensor_type, dropped)
+        return False
+    _count_ingest("enqueued")
+    _notify_ingest((reading,))
+    return True
 
 def get_latest_sensor_data(sensor_type, limit=5):
     """
     Obtiene los últimos datos de un tipo de sensor específico.
+    Se sirve desde la caché en memoria cuando contiene las lecturas necesarias.
     """
+    cached = _cached_latest(sensor_type, limit)
+    with _cache_lock:
+        _cache_stats["hits" if cached is not None else "misses"] += 1
+    if cached is not None:
+        return cached
+
     with get_connection() as conn:
         if conn is None: return []
         c = conn.cursor()
         try:
-            c.execute("""
-                SELECT device_name, value, timestamp FROM sensor_data
-                WHERE sensor_type = ?
-                ORDER BY timestamp DESC LIMIT ?
-            """, (sensor_type, limit))
-            return c.fetchall()
+            # Los rangos no se solapan: se recorren del más reciente al más antiguo
+            rows = []
+            for _, _, tables in _partition_ranges(conn, descending=True):
+                found = []
+                for name, fmt in tables:
+                    found.extend(_select_latest(c, name, fmt, sensor_type, limit - len(rows)))
+                found.sort(reverse=True)
+                rows.extend(found[:limit - len(rows)])
+                if len(rows) >= limit:
+                    break
+            return [(device_name, value, format_timestamp(ts / 1000)) for ts, device_name, value in rows]
         except sqlite3.Error as e:
-            print(f"Error getting latest sensor data for {sensor_type}: {e}")
+            logger.error("Error getting latest sensor data for %s: %s", sensor_type, e)
             return []
 
+def choose_history_resolution(start, end, max_points=HISTORY_DEFAULT_POINTS):
+    """
+    Elige la resolución para un rango [start, end]: la más fina ('raw', '1m', '1h',
+    '1d') cuyo número estimado de puntos no supera 'max_points'. Si ninguna cumple,
+    se usa la más gruesa.
+    """
+    span = max(end - start, 0)
+    if span / HISTORY_RAW_INTERVAL <= max_points:
+        return "raw"
+    for resolution, width in ROLLUP_RESOLUTIONS.items():
+        if span / width <= max_points:
+            return resolution
+    return resolution
+
+def get_sensor_history(device_name, sensor_type, start, end, resolution="auto", max_points=HISTORY_DEFAULT_POINTS):
+    """
+    Obtiene la serie histórica de un (dispositivo, sensor) entre 'start' y 'end'
+    (epoch en segundos). Con resolution="auto" se elige el rollup adecuado según
+    'max_points'. Retorna (resolución usada, lista de puntos); cada punto es una
+    tupla (t, min, max, avg, count, last), con t el inicio del bucket.
+    """
+    if resolution == "auto":
+        resolution = choose_history_resolution(start, end, max_points)
+    if resolution != "raw" and resolution not in ROLLUP_RESOLUTIONS:
+        raise ValueError(f"Unknown resolution '{resolution}'")
+
+    with get_connection() as conn:
+        if conn is None: return resolution, []
+        c = conn.cursor()
+        try:
+            if resolution == "raw":
+                points = []
+                for _, _, tables in _partition_ranges(conn, start, end):
+                    found = []
+                    for name, fmt in tables:
+                        found.extend(_select_series(c, name, fmt, device_name, sensor_type, start, end))
+                    found.sort()
+                    points.extend((ts / 1000, v, v, v, 1, v) for ts, v in found)
+                return resolution, points
+
+            width = ROLLUP_RESOLUTIONS[resolution]
+            _execute(c, f"""
+                SELECT bucket, min, max, sum / count, count, last FROM sensor_rollup_{resolution}
+                WHERE device_name = ? AND sensor_type = ? AND bucket >= ? AND bucket <= ?
+                ORDER BY bucket
+            """, (device_name, sensor_type, int(start // width) * width, end))
+            return resolution, c.fetchall()
+        except sqlite3.Error as e:
+            logger.error("Error getting sensor history for %s (%s): %s", device_name, sensor_type, e)
+            return resolution, []
+
+def get_series_devices(sensor_type, start):
+    """
+    Dispositivos con lecturas de 'sensor_type' desde 'start' (epoch en segundos), según
+    el rollup horario y la caché en memoria.
+    """
+    devices = set()
+    with _cache_lock:
+        devices.update(name for name, ring in _cache_by_type.get(sensor_type, {}).items()
+                       if ring.size and ring.ts[ring.head - 1] >= start)
+    with get_connection() as conn:
+        if conn is None: return sorted(devices)
+        try:
+            rows = _execute(conn.cursor(), "SELECT DISTINCT device_name FROM sensor_rollup_1h WHERE sensor_type = ? AND bucket >= ?",
+                            (sensor_type, int(start // 3600) * 3600))
+            devices.update(row[0] for row in rows)
+        except sqlite3.Error as e:
+            logger.error("Error listing devices for %s: %s", sensor_type, e)
+    return sorted(devices)
+
+def rebuild_rollups(chunk_size=10000):
+    """
+    Recalcula las tablas de rollup a partir de 'sensor_data', en bloques.
+    Útil para bases de datos con datos anteriores a los rollups; debe ejecutarse
+    con la ingesta detenida para no contar dos veces las lecturas nuevas.
+    """
+    with get_connection() as conn:
+        if conn is None: return
+        try:
+            with conn:
+                for resolution in ROLLUP_RESOLUTIONS:
+                    _execute(conn, f"DELETE FROM sensor_rollup_{resolution}")
+            chunk = []
+            for ts, d, t, v, _ in iter_sensor_data(chunk_size=chunk_size):
+                chunk.append((d, t, v, ts / 1000))
+                if len(chunk) >= chunk_size:
+                    with conn:
+                        _update_rollups(conn, chunk)
+                    chunk = []
+            if chunk:
+                with conn:
+                    _update_rollups(conn, chunk)
+            logger.info("Rollup tables rebuilt.")
+        except sqlite3.Error as e:
+            logger.error("Error rebuilding rollup tables: %s", e)
+
+def iter_sensor_data(device_name=None, sensor_type=None, start=None, end=None, after=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Generador que recorre las lecturas en orden ascendente de (ts, device_id,
+    sensor_type_id) con paginación por clave, leyendo 'chunk_size' filas por
+    consulta. Filtra por dispositivo, tipo de sensor y rango [start, end] (epoch
+    en segundos). 'after' es un cursor (ts_ms, device_name, sensor_type) para
+    reanudar tras la última fila entregada; sus nombres se buscan sin escribir en los
+    diccionarios, y uno desconocido se sitúa detrás de todos los conocidos de ese ts.
+    Entrega tuplas (ts_ms, device_name, sensor_type, value, timestamp). La conexión
+    se devuelve al pool entre bloques, por lo que un consumidor lento no la retiene.
+    """
+    with get_connection() as conn:
+        if conn is None: return
+        try:
+            after_key = None
+            range_start = start
+            if after is not None:
+                ts, cursor_device, cursor_type = after
+                after_key = (ts,
+                             _sort_id(_lookup_ids(conn, "sensor_devices", [cursor_device]), cursor_device),
+                             _sort_id(_lookup_ids(conn, "sensor_types", [cursor_type]), cursor_type))
+                range_start = ts / 1000 if start is None else max(start, ts / 1000)
+            ranges = _partition_ranges(conn, range_start, end)
+        except sqlite3.Error as e:
+            logger.error("Error exporting sensor data: %s", e)
+            return
+
+    # Los rangos no se solapan; dentro de un rango en migración se combinan las tablas v1 y v2
+    for _, _, tables in ranges:
+        streams = [_iter_partition(name, fmt, device_name, sensor_type, start, end, after_key, chunk_size)
+                   for name, fmt in tables]
+        try:
+            for _, row in (streams[0] if len(streams) == 1 else heapq.merge(*streams)):
+                yield row
+        except sqlite3.Error as e:
+            # La partición pudo eliminarse por retención o migración durante la exportación
+            logger.error("Error exporting sensor data: %s", e)
+
+def iter_series_values(device_name, sensor_type, start, end):
+    """
+    Generador de (ts_ms, value) de una serie en [start, end] (epoch en segundos), en orden
+    de tiempo y directamente desde el cursor, sin construir listas intermedias: pensado
+    para cargar una ventana en arrays por columnas (np.fromiter en analytics.py).
+    Mantiene la conexión mientras se consume, así que el consumidor debe ser rápido.
+    """
+    with get_connection() as conn:
+        if conn is None: return
+        try:
+            for _, _, tables in _partition_ranges(conn, start, end):
+                streams = []
+                for name, fmt in tables:
+                    if fmt == SENSOR_FORMAT_V2:
+                        streams.append(_execute(conn.cursor(), f"""
+                            SELECT ts, value FROM {name}
+                            WHERE device_id = (SELECT id FROM sensor_devices WHERE name = ?)
+                              AND sensor_type_id = (SELECT id FROM sensor_types WHERE name = ?)
+                              AND ts >= ? AND ts <= ?
+                            ORDER BY ts
+                        """, (device_name, sensor_type, _to_ms(start), _to_ms(end))))
+                    else:
+                        streams.append(_select_series(conn.cursor(), name, fmt, device_name, sensor_type, start, end))
+                yield from (streams[0] if len(streams) == 1 else heapq.merge(*streams))
+        except sqlite3.Error as e:
+            logger.error("Error reading series %s (%s): %s", device_name, sensor_type, e)
+
 def get_all_sensor_data():
     """
     Obtiene todos los datos de sensores, ordenados por marca de tiempo.
+    Carga toda la tabla en memoria: para volcados grandes usar iter_sensor_data().
     """
     with get_connection() as conn:
         if conn is None: return []
         c = conn.cursor()
         try:
-            c.execute("SELECT * FROM sensor_data ORDER BY timestamp DESC")
+            _execute(c, "SELECT device_name, sensor_type, value, timestamp FROM sensor_data ORDER BY ts DESC")
             return c.fetchall()
         except sqlite3.Error as e:
-            print(f"Error getting all sensor data: {e}")
+            logger.error("Error getting all sensor data: %s", e)
             return []
 
 def get_led_state():
@@ -149,53 +1818,151 @@ def get_led_state():
         if conn is None: return {"ledRed": 0, "ledGreen": 0} # Retornar estado por defecto en caso de error
         c = conn.cursor()
         try:
-            c.execute("SELECT red, green FROM led_state WHERE id = 1")
+            _execute(c, "SELECT red, green FROM led_state WHERE id = 1")
             row = c.fetchone()
             if row:
                 return {"ledRed": row[0], "ledGreen": row[1]}
-            else:
-                # Si por alguna razón no hay fila, intentar inicializarla o retornar default
-                print("LED state not found, re-initializing.")
-                init_db() # Re-inicializar para asegurar que la fila exista
-                return {"ledRed": 0, "ledGreen": 0}
+            logger.warning("LED state row not found; call init_db() at startup.")
+            return {"ledRed": 0, "ledGreen": 0}
         except sqlite3.Error as e:
-            print(f"Error getting LED state: {e}")
+            logger.error("Error getting LED state: %s", e)
             return {"ledRed": 0, "ledGreen": 0} # Retornar estado por defecto en caso de error
 
 def update_led_state(new_state):
     """
     Actualiza el estado de los LEDs en la base de datos.
     """
+    if _write_forwarder is not None:
+        _write_forwarder("update_led_state", (new_state,))
+        return
     with get_connection() as conn:
         if conn is None: return
         c = conn.cursor()
         try:
-            c.execute("""
+            _execute(c, """
                 UPDATE led_state
                 SET red = ?, green = ?
                 WHERE id = 1
             """, (new_state["ledRed"], new_state["ledGreen"]))
             conn.commit()
         except sqlite3.Error as e:
-            print(f"Error updating LED state to {new_state}: {e}")
+            logger.error("Error updating LED state to %s: %s", new_state, e)
+
+# --- ESTADO DE LOS ACTUADORES ---
+# Una fila por (dispositivo, salida); el dispositivo "*" es el estado común a todos (el
+# de los botones del dashboard). El estado vive en memoria en actuators.py y aquí solo
+# se guarda en lote; led_state se mantiene sincronizada por compatibilidad.
+
+ACTUATOR_ALL_DEVICES = "*"
+
+def create_actuator_table(conn):
+    """
+    Crea la tabla 'actuator_state' y la inicializa con el estado de 'led_state'.
+    """
+    _execute(conn, """
+        CREATE TABLE IF NOT EXISTS actuator_state (
+            device TEXT NOT NULL,
+            output TEXT NOT NULL,
+            value NUMERIC NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (device, output)
+        ) WITHOUT ROWID
+    """)
+    _execute(conn, """
+        INSERT OR IGNORE INTO actuator_state (device, output, value, version)
+        SELECT ?, 'ledRed', red, 0 FROM led_state WHERE id = 1
+        UNION ALL
+        SELECT ?, 'ledGreen', green, 0 FROM led_state WHERE id = 1
+    """, (ACTUATOR_ALL_DEVICES, ACTUATOR_ALL_DEVICES))
+    conn.commit()
+    logger.info("Table 'actuator_state' checked/created.")
+
+def get_actuator_states():
+    """
+    Retorna el estado guardado de todas las salidas: [(device, output, value, version)].
+    """
+    with get_connection() as conn:
+        if conn is None: return []
+        try:
+            return _execute(conn.cursor(), "SELECT device, output, value, version FROM actuator_state").fetchall()
+        except sqlite3.Error as e:
+            logger.error("Error loading actuator state: %s", e)
+            return []
+
+def upsert_actuator_states(rows):
+    """
+    Guarda en una transacción las salidas [(device, output, value, version)]; una fila
+    solo sustituye a la guardada si su versión es mayor. Retorna True si se guardaron.
+    """
+    if not rows:
+        return True
+    if _write_forwarder is not None:
+        return _write_forwarder("upsert_actuator_states", (rows,))
+    with get_connection() as conn:
+        if conn is None: return False
+        c = conn.cursor()
+        try:
+            _execute(c, """
+                INSERT INTO actuator_state (device, output, value, version) VALUES (?, ?, ?, ?)
+                ON CONFLICT(device, output) DO UPDATE SET value = excluded.value, version = excluded.version
+                WHERE excluded.version > actuator_state.version
+            """, rows, many=True)
+            legacy = {output: value for device, output, value, _ in rows
+                      if device == ACTUATOR_ALL_DEVICES and output in ("ledRed", "ledGreen")}
+            if legacy:
+                _execute(c, """
+                    UPDATE led_state SET red = COALESCE(?, red), green = COALESCE(?, green) WHERE id = 1
+                """, (legacy.get("ledRed"), legacy.get("ledGreen")))
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error("Error saving %s actuator states: %s", len(rows), e)
+            return False
+
+_DEVICE_UPSERT_SQL = """
+    INSERT INTO devices (name, ip, type, last_seen) VALUES (?, ?, ?, ?)
+    ON CONFLICT(name) DO UPDATE SET ip = excluded.ip, type = excluded.type, last_seen = excluded.last_seen
+"""
 
 def register_device(name, ip, device_type):
     """
     Registra o actualiza un dispositivo en la tabla 'devices'.
-    Utiliza INSERT OR REPLACE para actualizar si el dispositivo ya existe por nombre.
+    Usa un UPSERT sobre 'name' para conservar el 'id' del dispositivo existente.
     """
+    if _write_forwarder is not None:
+        _write_forwarder("register_device", (name, ip, device_type))
+        return
     with get_connection() as conn:
         if conn is None: return
         c = conn.cursor()
         try:
-            c.execute("""
-                INSERT OR REPLACE INTO devices (name, ip, type, last_seen)
-                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-            """, (name, ip, device_type))
+            _execute(c, _DEVICE_UPSERT_SQL, (name, ip, device_type, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())))
+            conn.commit()
+            logger.info("Device '%s' registered/updated with IP '%s' and type '%s'.", name, ip, device_type)
+        except sqlite3.Error as e:
+            logger.error("Error registering/updating device '%s': %s", name, e)
+
+def upsert_devices(devices):
+    """
+    Guarda en una sola transacción una lista de dispositivos [(name, ip, type, last_seen)],
+    con 'last_seen' como texto 'YYYY-MM-DD HH:MM:SS' en UTC. Retorna True si se guardaron.
+    """
+    if not devices:
+        return True
+    if _write_forwarder is not None:
+        return _write_forwarder("upsert_devices", (devices,))
+    with get_connection() as conn:
+        if conn is None: return False
+        c = conn.cursor()
+        try:
+            _execute(c, _DEVICE_UPSERT_SQL, devices, many=True)
             conn.commit()
-            print(f"Device '{name}' registered/updated with IP '{ip}' and type '{device_type}'.")
+            return True
         except sqlite3.Error as e:
-            print(f"Error registering/updating device '{name}': {e}")
+            conn.rollback()
+            logger.error("Error saving %s devices: %s", len(devices), e)
+            return False
 
 def get_all_devices():
     """
@@ -205,8 +1972,8 @@ def get_all_devices():
         if conn is None: return []
         c = conn.cursor()
         try:
-            c.execute("SELECT name, ip, type, last_seen FROM devices ORDER BY last_seen DESC")
+            _execute(c, "SELECT name, ip, type, last_seen FROM devices ORDER BY last_seen DESC")
             return c.fetchall()
         except sqlite3.Error as e:
-            print(f"Error getting all devices: {e}")
+            logger.error("Error getting all devices: %s", e)
             return []
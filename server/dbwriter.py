@@ -0,0 +1,295 @@
+# dbwriter.py
+# Proceso escritor único del modo multiproceso (cluster.py). Los workers web envían
+# por IPC cada escritura (lotes de lecturas de su cola de ingesta, estado de LEDs,
+# dispositivos) y un solo hilo del proceso escritor las aplica en orden, combinando
+# en una transacción los lotes de lecturas que llegan seguidos de varios workers.
+# Las lecturas, dispositivos y estados de actuadores escritos se reenvían a los demás
+# workers para que su caché, fan-out y estado en memoria vean los datos de todo el clúster.
+# Si la base de datos no acepta un lote de lecturas, se guarda en el spool en disco de
+# este proceso (database.spool_sensor_batch) y se escribe más tarde.
+
+import queue
+import socket
+import sqlite3
+import threading
+import time
+
+import ipc
+from database import apply_forwarded_write, set_write_forwarder, spool_sensor_batch, write_sensor_batch
+from logs import get_logger
+
+logger = get_logger("dbwriter")
+
+# --- CONFIGURACIÓN DEL PROCESO ESCRITOR ---
+WRITER_QUEUE_MAXSIZE = 1000      # Escrituras pendientes; con la cola llena los workers esperan (backpressure por TCP)
+WRITER_MERGE_READINGS = 5000     # Lecturas máximas combinadas en una transacción
+WRITER_SHUTDOWN_TIMEOUT = 10.0   # Segundos máximos para aplicar las escrituras pendientes al apagar
+
+_STOP = object()
+
+_write_queue = queue.Queue(maxsize=WRITER_QUEUE_MAXSIZE) # (worker, operación, args)
+_workers = {}           # worker_id -> Channel
+_workers_lock = threading.Lock()
+_receivers = []        # Hilos que reciben las escrituras de cada worker
+_writer_thread = None
+_server_socket = None
+_stats_lock = threading.Lock()
+_stats = {
+    "writes": 0,        # Escrituras recibidas de los workers
+    "readings": 0,      # Lecturas escritas
+    "transactions": 0,  # Transacciones de lecturas (tras combinar lotes)
+    "failed": 0,        # Escrituras que fallaron
+    "spooled": 0,       # Lecturas guardadas en el spool tras un fallo de escritura
+}
+
+def _count(key, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+
+def get_writer_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["queued"] = _write_queue.qsize()
+    with _workers_lock:
+        stats["workers"] = len(_workers)
+    return stats
+
+# --- LADO DEL PROCESO ESCRITOR ---
+
+def _broadcast(origin, kind, payload):
+    """
+    Envía un evento a todos los workers salvo al que originó la escritura.
+    """
+    with _workers_lock:
+        targets = [(worker_id, channel) for worker_id, channel in _workers.items() if worker_id != origin]
+    for worker_id, channel in targets:
+        try:
+            channel.send((kind, payload))
+        except OSError as e:
+            logger.warning("Could not send %s to worker %s: %s", kind, worker_id, e)
+
+def _write_readings(parts):
+    """
+    Escribe en una transacción los lotes [(worker, lecturas)] y reenvía a cada
+    worker las lecturas de los demás.
+    """
+    batch = [reading for _origin, readings in parts for reading in readings]
+    try:
+        write_sensor_batch(batch)
+        _count("readings", len(batch))
+        _count("transactions")
+    except sqlite3.OperationalError as e:
+        _spool_readings(batch, e)
+    except Exception as e: # Un lote con una lectura inválida no puede terminar el hilo escritor
+        logger.error("Error writing %s sensor readings from workers, retrying one by one: %s", len(batch), e)
+        _write_readings_one_by_one(batch)
+    with _workers_lock:
+        targets = list(_workers.items())
+    for worker_id, channel in targets:
+        others = [reading for origin, readings in parts if origin != worker_id for reading in readings]
+        if others:
+            try:
+                channel.send(("readings", others))
+            except OSError as e:
+                logger.warning("Could not send readings to worker %s: %s", worker_id, e)
+
+def _write_readings_one_by_one(batch):
+    """
+    Escribe lectura a lectura un lote que falló: se descartan solo las que no se pueden
+    escribir, y las que fallan por no estar disponible la base de datos van al spool.
+    """
+    unavailable = []
+    error = None
+    for reading in batch:
+        try:
+            write_sensor_batch([reading])
+            _count("readings")
+        except sqlite3.OperationalError as e:
+            unavailable.append(reading)
+            error = e
+        except Exception as e:
+            _count("failed")
+            logger.error("Discarding sensor reading %s from workers: %s", reading, e)
+    if unavailable:
+        _spool_readings(unavailable, error)
+
+def _spool_readings(batch, error):
+    if spool_sensor_batch(batch):
+        _count("spooled", len(batch))
+        logger.warning("Error writing %s sensor readings from workers, spooled for replay: %s", len(batch), error)
+    else:
+        _count("failed")
+        logger.error("Error writing %s sensor readings from workers: %s", len(batch), error)
+
+def _apply(origin, operation, args):
+    try:
+        result = apply_forwarded_write(operation, args)
+    except Exception as e:
+        _count("failed")
+        logger.error("Error applying %s from worker %s: %s", operation, origin, e)
+        return
+    if result is False:
+        _count("failed")
+    if operation == "insert_sensor_data_batch" and result:
+        _count("readings", len(args[0]))
+        _broadcast(origin, "readings", args[0])
+    elif operation == "upsert_devices" and result:
+        _broadcast(origin, "devices", args[0])
+    elif operation == "upsert_actuator_states" and result:
+        _broadcast(origin, "actuators", args[0])
+    elif operation == "register_device":
+        name, ip, device_type = args
+        _broadcast(origin, "devices", [(name, ip, device_type, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()))])
+
+def _writer_loop():
+    held = None # Escritura leída al combinar lotes que no era un lote de lecturas
+    while True:
+        item = held if held is not None else _write_queue.get()
+        held = None
+        if item is _STOP:
+            break
+        origin, operation, args = item
+        if operation != "write_sensor_batch":
+            _apply(origin, operation, args)
+            continue
+        parts = [(origin, args[0])]
+        total = len(args[0])
+        while total < WRITER_MERGE_READINGS:
+            try:
+                item = _write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP or item[1] != "write_sensor_batch":
+                held = item
+                break
+            parts.append((item[0], item[2][0]))
+            total += len(item[2][0])
+        _write_readings(parts)
+
+def _receive_loop(channel):
+    try:
+        worker_id = channel.recv()
+    except (EOFError, OSError):
+        channel.close()
+        return
+    with _workers_lock:
+        _workers[worker_id] = channel
+    logger.info("Worker %s connected to the database writer.", worker_id)
+    try:
+        while True:
+            operation, args = channel.recv()
+            _count("writes")
+            _write_queue.put((worker_id, operation, args))
+    except (EOFError, OSError):
+        pass
+    with _workers_lock:
+        if _workers.get(worker_id) is channel:
+            del _workers[worker_id]
+    channel.close()
+    logger.info("Worker %s disconnected from the database writer.", worker_id)
+
+def _accept_loop(server, token):
+    while True:
+        try:
+            channel = ipc.accept(server, token)
+        except OSError:
+            return # Socket de escucha cerrado
+        if channel is None:
+            logger.warning("Rejected database writer connection with an invalid token.")
+            continue
+        receiver = threading.Thread(target=_receive_loop, args=(channel,), name="dbwriter-recv", daemon=True)
+        receiver.start()
+        _receivers[:] = [thread for thread in _receivers if thread.is_alive()] + [receiver]
+
+def start_writer_service(token, port=0):
+    """
+    Arranca en este proceso el servicio de escritura: escucha conexiones de los workers
+    y aplica sus escrituras en un único hilo. Retorna la dirección "host:puerto".
+    """
+    global _writer_thread, _server_socket
+    _server_socket, address = ipc.listen(port)
+    _writer_thread = threading.Thread(target=_writer_loop, name="dbwriter", daemon=True)
+    _writer_thread.start()
+    threading.Thread(target=_accept_loop, args=(_server_socket, token), name="dbwriter-accept", daemon=True).start()
+    logger.info("Database writer listening on %s", ipc.format_address(address))
+    return ipc.format_address(address)
+
+def stop_writer_service(timeout=WRITER_SHUTDOWN_TIMEOUT):
+    """
+    Deja de aceptar workers y aplica las escrituras pendientes. Llamar después de
+    detener los workers para no perder los lotes que envían al apagarse.
+    """
+    global _writer_thread
+    if _server_socket is not None:
+        try:
+            _server_socket.shutdown(socket.SHUT_RDWR) # Despierta el accept() bloqueado
+        except OSError:
+            pass
+        _server_socket.close()
+    if _writer_thread is None:
+        return
+    deadline = time.monotonic() + timeout
+    for receiver in list(_receivers):
+        # Lo que un worker envió antes de cerrar su conexión se encola antes del centinela
+        receiver.join(max(0.0, deadline - time.monotonic()))
+    try:
+        _write_queue.put(_STOP, timeout=timeout)
+    except queue.Full:
+        logger.warning("Database writer queue still full at shutdown; pending writes may be lost.")
+        return
+    _writer_thread.join(timeout)
+    _writer_thread = None
+
+# --- LADO DE LOS WORKERS ---
+
+_channel = None
+_closing = False
+
+def _forward(operation, args):
+    channel = _channel
+    if channel is None:
+        return False
+    try:
+        channel.send((operation, args))
+        return True
+    except OSError as e:
+        logger.error("Could not send %s to the database writer: %s", operation, e)
+        return False
+
+def _event_loop(channel, event_handler, on_lost):
+    try:
+        while True:
+            kind, payload = channel.recv()
+            try:
+                event_handler(kind, payload)
+            except Exception as e:
+                logger.error("Error handling %s from the database writer: %s", kind, e)
+    except (EOFError, OSError) as e:
+        if not _closing:
+            logger.error("Lost connection to the database writer: %s", e)
+            on_lost()
+
+def connect_writer(address, token, worker_id, event_handler, on_lost):
+    """
+    Conecta este worker con el proceso escritor: a partir de aquí todas las escrituras
+    de database.py se envían por IPC. event_handler(kind, payload) recibe las lecturas
+    ("readings"), dispositivos ("devices") y salidas ("actuators") escritos por otros
+    workers; on_lost() se llama si el proceso escritor desaparece.
+    """
+    global _channel
+    channel = ipc.connect(ipc.parse_address(address), token)
+    channel.send(worker_id)
+    _channel = channel
+    set_write_forwarder(_forward)
+    threading.Thread(target=_event_loop, args=(channel, event_handler, on_lost),
+                     name="dbwriter-events", daemon=True).start()
+
+def disconnect_writer():
+    """
+    Cierra la conexión con el proceso escritor (tras vaciar la cola de ingesta).
+    """
+    global _channel, _closing
+    _closing = True
+    channel, _channel = _channel, None
+    if channel is not None:
+        channel.close()
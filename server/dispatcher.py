@@ -0,0 +1,185 @@
+# dispatcher.py
+# Envío de comandos HTTP a los microcontroladores del registro de dispositivos.
+# Cada dispositivo tiene su propia cola y su propio hilo de envío, así un dispositivo
+# inalcanzable solo retrasa sus propios comandos. Todas las peticiones comparten un
+# requests.Session con conexiones keep-alive, y los resultados se entregan a una
+# función (en los servidores, un 'server_message' de Socket.IO). requests se importa
+# al enviar el primer comando, no al arrancar el servidor.
+
+import queue
+import threading
+import time
+
+from registry import get_devices
+from logs import get_logger
+from metrics import DISPATCH_COMMANDS, DISPATCH_SECONDS
+
+logger = get_logger("dispatcher")
+
+# --- CONFIGURACIÓN DEL DESPACHADOR ---
+DISPATCH_CONNECT_TIMEOUT = 2.0   # Segundos para abrir la conexión con el dispositivo
+DISPATCH_READ_TIMEOUT = 3.0      # Segundos para recibir la respuesta
+DISPATCH_RETRIES = 3             # Reintentos tras el primer intento fallido
+DISPATCH_BACKOFF = 0.5           # Espera inicial entre reintentos (se duplica en cada uno)
+DISPATCH_BACKOFF_MAX = 4.0       # Espera máxima entre reintentos
+DISPATCH_POOL_SIZE = 16          # Conexiones keep-alive por host en el pool
+DISPATCH_QUEUE_MAXSIZE = 32      # Comandos pendientes por dispositivo antes de rechazar
+DISPATCH_WORKER_IDLE = 60.0      # Segundos sin comandos tras los que se cierra el hilo de un dispositivo
+
+_session = None
+_session_lock = threading.Lock()
+_workers = {}        # nombre del dispositivo -> _DeviceWorker
+_workers_lock = threading.Lock()
+_result_handler = None
+_default_url = None
+_stats = {"queued": 0, "sent": 0, "failed": 0, "retries": 0, "rejected": 0}
+_stats_lock = threading.Lock()
+
+def _count(key, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+
+def _get_session():
+    """
+    Devuelve el requests.Session compartido, creándolo con un pool de conexiones
+    keep-alive del tamaño configurado.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=DISPATCH_POOL_SIZE, pool_maxsize=DISPATCH_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+def _device_url(ip):
+    ip = ip.strip().rstrip("/")
+    return ip if ip.startswith(("http://", "https://")) else f"http://{ip}"
+
+def _registered_devices():
+    """
+    Lista [(name, url)] de los dispositivos registrados, leída del registro en memoria.
+    """
+    return [(name, _device_url(ip)) for name, ip, _type, _last_seen in get_devices() if ip]
+
+def _report(device, ok, text):
+    if _result_handler is None:
+        return
+    try:
+        _result_handler(device, ok, text)
+    except Exception as e:
+        logger.error("Error reporting command result for %s: %s", device, e)
+
+class _DeviceWorker:
+    """
+    Cola y hilo de envío de un dispositivo. Los comandos se envían en orden; el hilo
+    termina solo tras DISPATCH_WORKER_IDLE segundos sin trabajo.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.queue = queue.Queue(maxsize=DISPATCH_QUEUE_MAXSIZE)
+        self.thread = threading.Thread(target=self._run, name=f"dispatch-{name}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                url, payload = self.queue.get(timeout=DISPATCH_WORKER_IDLE)
+            except queue.Empty:
+                with _workers_lock:
+                    # Solo cerrar si nadie encoló mientras esperábamos el lock
+                    if self.queue.empty():
+                        _workers.pop(self.name, None)
+                        return
+                continue
+            self._send(url, payload)
+
+    def _send(self, url, payload):
+        session = _get_session()
+        from requests.exceptions import RequestException # Ya importado por _get_session()
+        start = time.perf_counter()
+        delay = DISPATCH_BACKOFF
+        for attempt in range(DISPATCH_RETRIES + 1):
+            try:
+                response = session.post(url, json=payload, timeout=(DISPATCH_CONNECT_TIMEOUT, DISPATCH_READ_TIMEOUT))
+                if response.status_code < 500:
+                    response.close()
+                    if response.ok:
+                        self._finish("sent", start)
+                        _report(self.name, True, f"Command delivered to {self.name}.")
+                    else:
+                        # Errores 4xx: el dispositivo rechazó el comando, reintentar no ayuda
+                        self._finish("failed", start)
+                        _report(self.name, False, f"{self.name} rejected command (HTTP {response.status_code}).")
+                    return
+                error = f"HTTP {response.status_code}"
+                response.close()
+            except RequestException as e:
+                error = e.__class__.__name__
+            if attempt < DISPATCH_RETRIES:
+                _count("retries")
+                DISPATCH_COMMANDS.inc(labels=("retry",))
+                time.sleep(delay)
+                delay = min(delay * 2, DISPATCH_BACKOFF_MAX)
+        self._finish("failed", start)
+        logger.error("Failed to send command to %s at %s after %s attempts: %s", self.name, url, DISPATCH_RETRIES + 1, error)
+        _report(self.name, False, f"Failed to contact {self.name} after {DISPATCH_RETRIES + 1} attempts ({error}).")
+
+    def _finish(self, result, start):
+        _count(result)
+        DISPATCH_COMMANDS.inc(labels=(result,))
+        DISPATCH_SECONDS.since(start, (result,))
+
+def dispatch_command(path, payload, devices=None):
+    """
+    Encola un comando POST 'path' con el payload JSON para los dispositivos indicados
+    (nombres), o para todos los registrados si 'devices' es None. Sin dispositivos
+    registrados se usa la URL por defecto de init_dispatcher. Retorna la lista de
+    dispositivos a los que se encoló el comando; no espera a las respuestas.
+    """
+    targets = _registered_devices()
+    if devices is not None:
+        wanted = set(devices)
+        targets = [(name, url) for name, url in targets if name in wanted]
+    elif not targets and _default_url:
+        targets = [("default", _default_url)]
+
+    queued = []
+    for name, url in targets:
+        with _workers_lock:
+            worker = _workers.get(name)
+            if worker is None:
+                worker = _workers[name] = _DeviceWorker(name)
+            try:
+                worker.queue.put_nowait((f"{url}{path}", payload))
+            except queue.Full:
+                _count("rejected")
+                DISPATCH_COMMANDS.inc(labels=("rejected",))
+                _report(name, False, f"Too many pending commands for {name}, command discarded.")
+                continue
+        _count("queued")
+        queued.append(name)
+    return queued
+
+def get_dispatch_stats():
+    """
+    Retorna contadores del despachador y los comandos pendientes por dispositivo.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    with _workers_lock:
+        stats["pending"] = {name: worker.queue.qsize() for name, worker in _workers.items()}
+    return stats
+
+def init_dispatcher(result_handler=None, default_url=None):
+    """
+    Configura la función que recibe (device, ok, text) con el resultado de cada comando
+    y la URL a usar cuando no hay dispositivos registrados.
+    """
+    global _result_handler, _default_url
+    _result_handler = result_handler
+    _default_url = _device_url(default_url) if default_url else None
@@ -0,0 +1,119 @@
+# export.py
+# Exportación en streaming de 'sensor_data' a CSV o NDJSON, con memoria constante.
+# Se usa desde el endpoint /api/sensor/export (run.py) y como CLI para volcados offline:
+#   python export.py --format csv --device ESP32_Node1 --from 2025-01-01 > dump.csv
+
+import argparse
+import csv
+import io
+import json
+import sys
+
+from database import iter_sensor_data, parse_timestamp
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+EXPORT_COLUMNS = ("ts", "device", "type", "value", "timestamp")
+EXPORT_FLUSH_BYTES = 64 * 1024 # Tamaño aproximado de cada bloque entregado al cliente
+
+def encode_cursor(row):
+    """
+    Cursor de reanudación a partir de la última fila recibida: "<ts>,<device>,<type>",
+    con 'ts' en epoch milisegundos.
+    """
+    return f"{row[0]},{row[1]},{row[2]}"
+
+def decode_cursor(cursor):
+    """
+    Convierte un cursor "<ts>,<device>,<type>" en la tupla que espera iter_sensor_data.
+    El tipo de sensor es lo que sigue a la última coma. Lanza ValueError si el formato no es válido.
+    """
+    ts, _, rest = cursor.partition(",")
+    device_name, _, sensor_type = rest.rpartition(",")
+    if not device_name or not sensor_type:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return int(ts), device_name, sensor_type
+
+def parse_time_arg(value):
+    """
+    Acepta epoch (s/ms) o ISO 8601 en parámetros de consulta y argumentos de la CLI.
+    """
+    if value is None or value == "":
+        return None
+    try:
+        return parse_timestamp(float(value))
+    except ValueError:
+        return parse_timestamp(value)
+
+def _chunked(lines):
+    """
+    Agrupa líneas en bloques de ~EXPORT_FLUSH_BYTES para reducir el número de escrituras.
+    """
+    buffer = []
+    size = 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= EXPORT_FLUSH_BYTES:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+def _csv_lines(rows, header=True):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    if header:
+        writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        writer.writerow(row)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    # La cabecera sola se entrega aunque no haya filas
+    if out.tell():
+        yield out.getvalue()
+
+def _ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row)), separators=(",", ":")) + "\n"
+
+def stream_export(fmt, device_name=None, sensor_type=None, start=None, end=None, cursor=None, header=True):
+    """
+    Generador de bloques de texto con los datos exportados en 'fmt' ("csv" o "ndjson").
+    'cursor' permite reanudar una exportación interrumpida (ver encode_cursor).
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{fmt}'")
+    after = decode_cursor(cursor) if cursor else None
+    rows = iter_sensor_data(device_name, sensor_type, start, end, after)
+    lines = _csv_lines(rows, header) if fmt == "csv" else _ndjson_lines(rows)
+    return _chunked(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export sensor data as CSV or NDJSON.")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="csv")
+    parser.add_argument("--device", help="Filter by device name")
+    parser.add_argument("--type", dest="sensor_type", help="Filter by sensor type")
+    parser.add_argument("--from", dest="start", help="Start time (epoch or ISO 8601, UTC)")
+    parser.add_argument("--to", dest="end", help="End time (epoch or ISO 8601, UTC)")
+    parser.add_argument("--cursor", help="Resume after this '<ts>,<device>,<type>' cursor")
+    parser.add_argument("--no-header", action="store_true", help="Omit the CSV header (useful when resuming)")
+    parser.add_argument("--output", "-o", help="Output file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    out = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for block in stream_export(args.format, args.device, args.sensor_type,
+                                   parse_time_arg(args.start), parse_time_arg(args.end),
+                                   args.cursor, header=not args.no_header):
+            out.write(block)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
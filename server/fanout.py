@@ -0,0 +1,190 @@
+# fanout.py
+# Difusión de lecturas de sensores a los dashboards por suscripción.
+# Cada cliente se suscribe a series (dispositivo, tipo de sensor) y se une a una
+# room de Socket.IO por suscripción. Las lecturas se acumulan por room (solo el
+# último valor de cada serie) y se envían en un único frame 'sensor_update' por
+# intervalo, respetando la frecuencia máxima que pidió cada cliente.
+
+import threading
+import time
+
+from flask_socketio import join_room, leave_room
+
+from database import add_ingest_listener
+from logs import get_logger
+from metrics import SOCKETIO_FRAMES, SOCKETIO_EMIT_SECONDS
+
+logger = get_logger("fanout")
+
+# --- CONFIGURACIÓN DEL FAN-OUT ---
+FANOUT_INTERVAL = 0.2          # Segundos entre frames (intervalo mínimo de cualquier suscripción)
+FANOUT_MAX_RATE = 5.0          # Frames por segundo máximos por suscripción de un cliente
+FANOUT_MIN_RATE = 0.1          # Frecuencia mínima que un cliente puede pedir
+FANOUT_MAX_SUBSCRIPTIONS = 16  # Suscripciones máximas por cliente
+WILDCARD = "*"                 # Comodín para dispositivo o tipo de sensor
+
+_socketio = None
+_lock = threading.Lock()
+_client_rooms = {}   # sid -> {room: (device, sensor_type)}
+_room_members = {}   # room -> número de clientes suscritos
+_room_series = {}    # room -> ((device, sensor_type), intervalo)
+_rooms_by_series = {} # (device o "*", sensor_type o "*") -> set de rooms
+_pending = {}        # room -> {(device, sensor_type): (value, ts)} pendientes de enviar
+_next_due = {}       # room -> instante (monotonic) del próximo frame
+_newest = {}         # (device, sensor_type) -> timestamp más reciente publicado
+_stats = {"published": 0, "frames": 0, "series_sent": 0}
+
+def _room_name(device, sensor_type, interval):
+    return f"sensor:{device}:{sensor_type}@{int(round(interval * 1000))}"
+
+def _interval_for(max_rate):
+    """
+    Convierte la frecuencia pedida (Hz) en un intervalo múltiplo de FANOUT_INTERVAL,
+    limitado a [FANOUT_MIN_RATE, FANOUT_MAX_RATE].
+    """
+    rate = FANOUT_MAX_RATE if max_rate is None else min(max(float(max_rate), FANOUT_MIN_RATE), FANOUT_MAX_RATE)
+    ticks = max(1, round((1.0 / rate) / FANOUT_INTERVAL))
+    return ticks * FANOUT_INTERVAL
+
+def subscribe(sid, series, max_rate=None):
+    """
+    Suscribe al cliente 'sid' a una lista de series [{"device": ..., "type": ...}]
+    (cualquiera de los dos puede ser "*"). Debe llamarse desde un handler de Socket.IO.
+    Lanza ValueError si la petición no es válida.
+    """
+    interval = _interval_for(max_rate)
+    with _lock:
+        rooms = _client_rooms.setdefault(sid, {})
+        for item in series:
+            if not isinstance(item, dict):
+                raise ValueError("Each subscription must be an object with 'device' and 'type'")
+            device = str(item.get("device") or WILDCARD)
+            sensor_type = str(item.get("type") or WILDCARD)
+            room = _room_name(device, sensor_type, interval)
+            if room in rooms:
+                continue
+            if len(rooms) >= FANOUT_MAX_SUBSCRIPTIONS:
+                raise ValueError(f"Too many subscriptions (max {FANOUT_MAX_SUBSCRIPTIONS})")
+            rooms[room] = (device, sensor_type)
+            _room_members[room] = _room_members.get(room, 0) + 1
+            _room_series[room] = ((device, sensor_type), interval)
+            _rooms_by_series.setdefault((device, sensor_type), set()).add(room)
+            join_room(room, sid=sid)
+
+def _release_room(room, pattern):
+    _room_members[room] -= 1
+    if _room_members[room] > 0:
+        return
+    # Room sin clientes: deja de acumular lecturas
+    del _room_members[room]
+    del _room_series[room]
+    _rooms_by_series[pattern].discard(room)
+    if not _rooms_by_series[pattern]:
+        del _rooms_by_series[pattern]
+    _pending.pop(room, None)
+    _next_due.pop(room, None)
+
+def unsubscribe(sid, series=None):
+    """
+    Cancela las suscripciones del cliente a las series dadas (en cualquier
+    frecuencia), o todas si 'series' es None.
+    """
+    with _lock:
+        rooms = _client_rooms.get(sid, {})
+        patterns = None if series is None else {
+            (str(item.get("device") or WILDCARD), str(item.get("type") or WILDCARD))
+            for item in series if isinstance(item, dict)}
+        for room, pattern in list(rooms.items()):
+            if patterns is None or pattern in patterns:
+                del rooms[room]
+                leave_room(room, sid=sid)
+                _release_room(room, pattern)
+        if not rooms:
+            _client_rooms.pop(sid, None)
+
+def client_disconnected(sid):
+    """
+    Libera las suscripciones de un cliente desconectado (Socket.IO ya lo sacó de sus rooms).
+    """
+    with _lock:
+        for room, pattern in _client_rooms.pop(sid, {}).items():
+            _release_room(room, pattern)
+
+def publish_readings(readings):
+    """
+    Acumula lecturas [(device, sensor_type, value, ts)] en las rooms suscritas a
+    sus series. Se registra como listener de la ingesta en database.py.
+    """
+    with _lock:
+        if not _rooms_by_series:
+            return
+        for device, sensor_type, value, ts in readings:
+            # Las lecturas atrasadas (lotes reenviados o lecturas de otros workers que
+            # llegan después) no deben sustituir en el dashboard a una más reciente
+            series = (device, sensor_type)
+            if ts < _newest.get(series, 0.0):
+                continue
+            _newest[series] = ts
+            for pattern in ((device, sensor_type), (device, WILDCARD), (WILDCARD, sensor_type), (WILDCARD, WILDCARD)):
+                rooms = _rooms_by_series.get(pattern)
+                if not rooms:
+                    continue
+                for room in rooms:
+                    _pending.setdefault(room, {})[(device, sensor_type)] = (value, ts)
+            _stats["published"] += 1
+
+def _collect_due_frames(now):
+    frames = []
+    with _lock:
+        for room in list(_pending):
+            if now < _next_due.get(room, 0.0):
+                continue
+            interval = _room_series[room][1]
+            by_device = {}
+            for (device, sensor_type), (value, ts) in _pending.pop(room).items():
+                by_device.setdefault(device, []).append({"type": sensor_type, "value": value, "timestamp": ts})
+            _next_due[room] = now + interval - FANOUT_INTERVAL / 2
+            frames.append((room, [{"device": device, "sensors": sensors} for device, sensors in by_device.items()]))
+            _stats["frames"] += 1
+            _stats["series_sent"] += sum(len(item["sensors"]) for item in frames[-1][1])
+    return frames
+
+def _fanout_loop():
+    while True:
+        _socketio.sleep(FANOUT_INTERVAL)
+        try:
+            frames = _collect_due_frames(time.monotonic())
+            if not frames:
+                continue
+            start = time.perf_counter()
+            for room, frame in frames:
+                # Solo a los clientes de este proceso: en modo multiproceso cada worker
+                # recibe todas las lecturas del clúster y atiende sus propias salas
+                _socketio.emit("sensor_update", frame, to=room, namespace="/", ignore_queue=True)
+            SOCKETIO_EMIT_SECONDS.since(start)
+            SOCKETIO_FRAMES.inc(len(frames))
+        except Exception as e:
+            logger.error("Error sending sensor frames: %s", e)
+
+def get_fanout_stats():
+    """
+    Retorna contadores del fan-out: lecturas publicadas, frames enviados, series
+    enviadas, rooms activas y clientes suscritos.
+    """
+    with _lock:
+        stats = dict(_stats)
+        stats["rooms"] = len(_room_members)
+        stats["clients"] = len(_client_rooms)
+    return stats
+
+def init_fanout(socketio):
+    """
+    Registra el fan-out como listener de la ingesta y arranca la tarea de envío
+    de frames sobre la instancia de SocketIO dada.
+    """
+    global _socketio
+    if _socketio is not None:
+        return
+    _socketio = socketio
+    add_ingest_listener(publish_readings)
+    socketio.start_background_task(_fanout_loop)
@@ -0,0 +1,113 @@
+# ipc.py
+# Canal de comunicación entre los procesos del modo multiproceso (cluster.py): mensajes
+# con prefijo de longitud sobre un socket TCP local. Al conectar, el cliente envía el
+# token compartido del clúster antes de cualquier mensaje; solo después se aceptan
+# objetos serializados con pickle. Usa sockets normales para que eventlet/gevent
+# puedan parchearlos (multiprocessing.connection lee el descriptor con os.read).
+
+import hmac
+import pickle
+import socket
+import struct
+import threading
+
+IPC_HOST = "127.0.0.1"
+IPC_MAX_MESSAGE = 64 * 1024 * 1024  # Bytes máximos de un mensaje
+IPC_CONNECT_TIMEOUT = 5.0           # Segundos máximos para conectar y autenticarse
+
+_HEADER = struct.Struct(">I")
+
+class Channel:
+    """
+    Conexión bidireccional: send()/send_bytes() son seguros entre hilos; recv() y
+    recv_bytes() deben llamarse desde un único hilo. Lanza EOFError al cerrarse.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self._send_lock = threading.Lock()
+
+    def send_bytes(self, data):
+        with self._send_lock:
+            self.sock.sendall(_HEADER.pack(len(data)) + data)
+
+    def send(self, obj):
+        self.send_bytes(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    def _recv_exact(self, size):
+        chunks = []
+        while size:
+            chunk = self.sock.recv(min(size, 1024 * 1024))
+            if not chunk:
+                raise EOFError("IPC connection closed")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def recv_bytes(self):
+        (size,) = _HEADER.unpack(self._recv_exact(_HEADER.size))
+        if size > IPC_MAX_MESSAGE:
+            raise EOFError(f"IPC message too large ({size} bytes)")
+        return self._recv_exact(size)
+
+    def recv(self):
+        return pickle.loads(self.recv_bytes())
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+def format_address(address):
+    return f"{address[0]}:{address[1]}"
+
+def parse_address(text):
+    """
+    Convierte "host:puerto" en (host, puerto). Lanza ValueError si no es válido.
+    """
+    host, sep, port = text.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError(f"Invalid IPC address '{text}' (expected host:port)")
+    return host or IPC_HOST, int(port)
+
+def listen(port=0, backlog=64):
+    """
+    Abre un socket de escucha en IPC_HOST (puerto 0 = libre). Retorna (socket, dirección).
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((IPC_HOST, port))
+    server.listen(backlog)
+    return server, server.getsockname()[:2]
+
+def accept(server, token):
+    """
+    Acepta una conexión y comprueba el token. Retorna el Channel, o None si el token
+    no coincide (la conexión se cierra sin leer nada más).
+    """
+    sock, _peer = server.accept()
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    channel = Channel(sock)
+    expected = token.encode()
+    try:
+        sock.settimeout(IPC_CONNECT_TIMEOUT)
+        received = channel._recv_exact(len(expected))
+        sock.settimeout(None)
+    except (EOFError, OSError):
+        channel.close()
+        return None
+    if not hmac.compare_digest(received, expected):
+        channel.close()
+        return None
+    return channel
+
+def connect(address, token):
+    """
+    Conecta con un proceso del clúster y se autentica con el token compartido.
+    """
+    sock = socket.create_connection(address, timeout=IPC_CONNECT_TIMEOUT)
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(token.encode())
+    return Channel(sock)
@@ -0,0 +1,75 @@
+# logs.py
+# Logging del servidor con niveles y límite de frecuencia. Sustituye a los print():
+# cada punto del código que loguea puede emitir como máximo LOG_RATE_LIMIT mensajes
+# por ventana de LOG_RATE_WINDOW segundos; el resto se cuenta y se resume después.
+# El nivel se elige con FLASKHS_LOG_LEVEL (DEBUG, INFO, WARNING, ERROR, OFF).
+
+import logging
+import os
+import threading
+import time
+
+LOG_LEVEL = os.environ.get("FLASKHS_LOG_LEVEL", "INFO").upper()
+LOG_RATE_LIMIT = 10     # Mensajes por punto de log y ventana
+LOG_RATE_WINDOW = 10.0  # Segundos de la ventana
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_configured = False
+_configure_lock = threading.Lock()
+
+class RateLimitFilter(logging.Filter):
+    """
+    Descarta los mensajes que superan LOG_RATE_LIMIT por (logger, línea) y ventana.
+    El primer mensaje de la ventana siguiente indica cuántos se descartaron.
+    """
+    def __init__(self, limit=LOG_RATE_LIMIT, window=LOG_RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._sites = {} # (logger, archivo, línea) -> [inicio de ventana, emitidos, descartados]
+
+    def filter(self, record):
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.window:
+                suppressed = site[2] if site else 0
+                site = self._sites[key] = [now, 0, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+            if site[1] >= self.limit:
+                site[2] += 1
+                return False
+            site[1] += 1
+        return True
+
+def setup_logging(level=None):
+    """
+    Configura el logger raíz 'flaskhs' (una sola vez): salida a stderr, nivel y límite de frecuencia.
+    """
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        logger = logging.getLogger("flaskhs")
+        level = (level or LOG_LEVEL).upper()
+        if level == "OFF": # Por encima de CRITICAL: los loggers hijos heredan el nivel efectivo
+            logger.setLevel(logging.CRITICAL + 1)
+        else:
+            logger.setLevel(getattr(logging, level, logging.INFO))
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler.addFilter(RateLimitFilter())
+        logger.addHandler(handler)
+        logger.propagate = False
+        _configured = True
+
+def get_logger(name):
+    """
+    Logger 'flaskhs.<name>' del módulo. En caminos calientes, comprobar antes
+    logger.isEnabledFor(logging.DEBUG) para no formatear mensajes descartados.
+    """
+    setup_logging()
+    return logging.getLogger(f"flaskhs.{name}")
@@ -0,0 +1,250 @@
+# metrics.py
+# Métricas internas del servidor en formato de texto de Prometheus (/metrics).
+# Los contadores e histogramas escriben en un shard por hilo, sin locks en el camino
+# caliente; los shards se suman solo al generar la respuesta. Con FLASKHS_METRICS=0
+# el registro de valores se desactiva por completo.
+
+import bisect
+import math
+import os
+import threading
+import time
+
+METRICS_ENABLED = os.environ.get("FLASKHS_METRICS", "1") != "0"
+METRICS_MAX_SHARDS = 256 # Shards vivos por métrica; por encima se usa uno compartido con lock
+
+# Límites de los histogramas de latencia (segundos)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_metrics = []
+_metrics_lock = threading.Lock()
+
+def _register(metric):
+    with _metrics_lock:
+        if any(existing.name == metric.name for existing in _metrics):
+            raise ValueError(f"Metric {metric.name} already registered")
+        _metrics.append(metric)
+    return metric
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _ShardedMetric:
+    """
+    Base de contadores e histogramas: cada hilo escribe en su propio diccionario
+    {labels: valor}. Al crear el shard de un hilo nuevo se fusionan en 'retired' los
+    de hilos ya terminados, así el número de shards sigue al de hilos vivos.
+    """
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []   # [(hilo, shard)]
+        self._retired = {}
+        self._shared = None # Shard compartido si hay demasiados hilos vivos
+        _register(self)
+
+    def _new_shard(self):
+        shard = {}
+        with self._lock:
+            alive = []
+            for thread, old in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, old))
+                else:
+                    self._merge(self._retired, old)
+            self._shards = alive
+            if len(alive) >= METRICS_MAX_SHARDS:
+                shard = None
+            else:
+                alive.append((threading.current_thread(), shard))
+        self._local.shard = shard
+        return shard
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            return self._new_shard()
+
+    def _snapshot(self):
+        total = {}
+        with self._lock:
+            self._merge(total, self._retired)
+            for _thread, shard in self._shards:
+                self._merge(total, dict(list(shard.items())))
+            if self._shared is not None:
+                self._merge(total, self._shared)
+        return total
+
+class Counter(_ShardedMetric):
+    """
+    Contador monótono, opcionalmente con etiquetas: COUNTER.inc(labels=("http", "200")).
+    """
+    type = "counter"
+
+    def inc(self, amount=1, labels=()):
+        if not METRICS_ENABLED:
+            return
+        shard = self._shard()
+        if shard is None:
+            with self._lock:
+                if self._shared is None:
+                    self._shared = {}
+                self._shared[labels] = self._shared.get(labels, 0) + amount
+            return
+        shard[labels] = shard.get(labels, 0) + amount
+
+    @staticmethod
+    def _merge(total, shard):
+        for labels, value in shard.items():
+            total[labels] = total.get(labels, 0) + value
+
+    def render(self):
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                for labels, value in sorted(self._snapshot().items())]
+
+class Histogram(_ShardedMetric):
+    """
+    Histograma acumulativo de Prometheus. observe() solo hace un bisect y tres sumas
+    en el shard del hilo actual.
+    """
+    type = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help_text, labelnames)
+
+    def observe(self, value, labels=()):
+        if not METRICS_ENABLED:
+            return
+        shard = self._shard()
+        if shard is None:
+            with self._lock:
+                if self._shared is None:
+                    self._shared = {}
+                self._observe(self._shared, value, labels)
+            return
+        self._observe(shard, value, labels)
+
+    def _observe(self, shard, value, labels):
+        data = shard.get(labels)
+        if data is None:
+            # [conteo por bucket..., conteo > último límite, suma]
+            data = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        data[bisect.bisect_left(self.buckets, value)] += 1
+        data[-1] += value
+
+    def since(self, start, labels=()):
+        """
+        Registra el tiempo transcurrido desde 'start' (time.perf_counter()).
+        """
+        self.observe(time.perf_counter() - start, labels)
+
+    @staticmethod
+    def _merge(total, shard):
+        for labels, data in shard.items():
+            current = total.get(labels)
+            if current is None:
+                total[labels] = list(data)
+            else:
+                for i, value in enumerate(data):
+                    current[i] += value
+
+    def render(self):
+        lines = []
+        for labels, data in sorted(self._snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), data[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(data[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class Gauge:
+    """
+    Valor instantáneo. Con 'callback' se calcula al generar /metrics (retorna un número o
+    {labels: número}); sin él se actualiza con set()/inc()/dec().
+    """
+    type = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), callback=None, metric_type="gauge"):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.type = metric_type # "counter" para totales que ya acumula otro subsistema
+        self._values = {}
+        self._lock = threading.Lock()
+        _register(self)
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def render(self):
+        if self.callback is None:
+            values = dict(self._values)
+        else:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                for labels, value in sorted(values.items()) if value is not None]
+
+def render_metrics():
+    """
+    Genera el texto de /metrics con todas las métricas registradas.
+    """
+    with _metrics_lock:
+        metrics = list(_metrics)
+    lines = []
+    for metric in metrics:
+        try:
+            samples = metric.render()
+        except Exception as e:
+            # Una métrica rota no debe tumbar el endpoint completo
+            lines.append(f"# {metric.name} unavailable: {e}")
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+# --- MÉTRICAS DEL SERVIDOR ---
+# Contadores e histogramas compartidos por run.py y run-mqtt.py. Los gauges que leen
+# el estado de un subsistema se declaran en su propio módulo con un callback.
+HTTP_INGEST_REQUESTS = Counter("flaskhs_http_ingest_requests_total", "Sensor ingest HTTP requests", ("endpoint", "status"))
+HTTP_INGEST_SECONDS = Histogram("flaskhs_http_ingest_seconds", "Sensor ingest HTTP request handling time", ("endpoint",))
+MQTT_EVENTS = Counter("flaskhs_mqtt_pipeline_events_total", "MQTT pipeline events: received/dropped/parsed/invalid messages, readings/ingest_dropped readings", ("event",))
+MQTT_PARSE_SECONDS = Histogram("flaskhs_mqtt_parse_seconds", "Time to parse, validate and enqueue one MQTT message")
+DB_CONNECT_SECONDS = Histogram("flaskhs_db_connect_seconds", "Time to check out a pooled database connection")
+DB_EXECUTE_SECONDS = Histogram("flaskhs_db_execute_seconds", "Database statement execution time (retries included)", ("operation",))
+DB_COMMIT_SECONDS = Histogram("flaskhs_db_commit_seconds", "Database commit time when a pooled connection is released")
+SOCKETIO_FRAMES = Counter("flaskhs_socketio_frames_total", "sensor_update frames emitted by the fan-out")
+SOCKETIO_EMIT_SECONDS = Histogram("flaskhs_socketio_emit_seconds", "Time to emit all due fan-out frames in one tick")
+SOCKETIO_CLIENTS = Gauge("flaskhs_socketio_clients", "Connected Socket.IO clients")
+DISPATCH_COMMANDS = Counter("flaskhs_dispatch_commands_total", "Device commands by outcome", ("result",))
+DISPATCH_SECONDS = Histogram("flaskhs_dispatch_seconds", "Device command round-trip time, retries included", ("result",))
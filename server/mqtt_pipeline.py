@@ -0,0 +1,202 @@
+# mqtt_pipeline.py
+# Pipeline de ingesta de mensajes MQTT por etapas:
+#   1. El callback de paho solo encola (topic, bytes, instante de recepción) en una cola acotada.
+#   2. Un pool de hilos parsea y valida el JSON (o el formato binario de codec.py).
+#   3. Las lecturas válidas pasan a la cola write-behind de database.py, que las escribe en lote.
+#   4. El fan-out (fanout.py) las envía agrupadas a los dashboards suscritos.
+# Así el hilo de red de paho nunca espera a la DB ni a Socket.IO.
+
+import json
+import queue
+import threading
+import time
+
+from database import insert_sensor_data, validate_reading
+from codec import MQTT_BINARY_SUFFIX, decode_readings
+from logs import get_logger
+from metrics import Gauge, MQTT_EVENTS, MQTT_PARSE_SECONDS
+
+logger = get_logger("mqtt_pipeline")
+
+# --- CONFIGURACIÓN DEL PIPELINE ---
+MQTT_RAW_QUEUE_MAXSIZE = 5000        # Mensajes sin parsear en espera
+MQTT_PARSER_WORKERS = 2              # Hilos que parsean y validan los mensajes
+MQTT_OVERFLOW_POLICY = "drop_oldest" # Cola llena: "drop_oldest", "drop_newest" o "block"
+MQTT_PUT_TIMEOUT = 1.0               # Segundos de espera con la política "block" antes de descartar
+MQTT_ERROR_REPORT_INTERVAL = 5.0     # Segundos mínimos entre avisos de error a la UI
+MQTT_SHUTDOWN_TIMEOUT = 5.0          # Segundos para vaciar la cola al detener el pipeline
+
+_raw_queue = queue.Queue(maxsize=MQTT_RAW_QUEUE_MAXSIZE)
+_workers = []
+_error_handler = None
+_last_error_report = 0.0
+_stats_lock = threading.Lock()
+_stats = {
+    "received": 0,      # Mensajes entregados por paho
+    "dropped": 0,       # Mensajes descartados por cola llena
+    "parsed": 0,        # Mensajes válidos
+    "invalid": 0,       # Mensajes con JSON o estructura inválidos
+    "readings": 0,      # Lecturas enviadas a la cola de ingesta
+    "ingest_dropped": 0 # Lecturas rechazadas por la cola de ingesta
+}
+
+def _count(key, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+    MQTT_EVENTS.inc(amount, (key,))
+
+def enqueue_message(topic, payload):
+    """
+    Encola un mensaje MQTT sin procesarlo. Pensado para el callback on_message de paho:
+    nunca bloquea más de MQTT_PUT_TIMEOUT. Retorna False si el mensaje se descartó.
+    """
+    item = (topic, bytes(payload), time.time())
+    _count("received")
+    try:
+        if MQTT_OVERFLOW_POLICY == "block":
+            _raw_queue.put(item, timeout=MQTT_PUT_TIMEOUT)
+        else:
+            _raw_queue.put_nowait(item)
+        return True
+    except queue.Full:
+        pass
+    if MQTT_OVERFLOW_POLICY == "drop_oldest":
+        # Priorizar los datos más recientes: sacar el mensaje más antiguo y reintentar una vez
+        try:
+            _raw_queue.get_nowait()
+            _count("dropped")
+        except queue.Empty:
+            pass
+        try:
+            _raw_queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+    _count("dropped")
+    return False
+
+def _device_from_topic(topic):
+    # 'sensors/<device>/data' o 'sensors/<device>/data/bin'
+    if topic.endswith(MQTT_BINARY_SUFFIX):
+        topic = topic[:-len(MQTT_BINARY_SUFFIX)]
+    parts = topic.split("/")
+    if len(parts) == 3 and parts[0] == "sensors" and parts[2] == "data":
+        return parts[1]
+    return None
+
+def _report_error(text):
+    """
+    Avisa a la UI de mensajes inválidos como máximo una vez cada MQTT_ERROR_REPORT_INTERVAL.
+    """
+    global _last_error_report
+    now = time.monotonic()
+    if _error_handler is None or now - _last_error_report < MQTT_ERROR_REPORT_INTERVAL:
+        return
+    _last_error_report = now
+    with _stats_lock:
+        invalid = _stats["invalid"]
+    try:
+        _error_handler(f"{text} ({invalid} invalid MQTT messages so far)")
+    except Exception as e:
+        logger.error("MQTT: Error reporting pipeline error: %s", e)
+
+def parse_message(topic, payload, received_at):
+    """
+    Valida un mensaje {"device": ..., "sensors": [{"type": ..., "value": ...}]} (o frames
+    binarios de codec.py si el tópico termina en MQTT_BINARY_SUFFIX) y retorna la lista de
+    lecturas (device, sensor_type, value, ts). En 'sensors/<device>/data' el dispositivo
+    es opcional en el payload. Lanza ValueError si el mensaje no es válido, si algún tipo
+    no es texto no vacío o algún valor no es un número finito.
+    """
+    if topic.endswith(MQTT_BINARY_SUFFIX):
+        return [validate_reading(*reading) for reading in decode_readings(payload, received_at, _device_from_topic(topic))]
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        raise ValueError("MQTT payload not valid JSON.")
+    if not isinstance(data, dict):
+        raise ValueError("MQTT payload invalid: expected a JSON object.")
+    device = data.get("device") or _device_from_topic(topic)
+    sensors = data.get("sensors")
+    if not device or not isinstance(sensors, list):
+        raise ValueError("MQTT payload invalid: missing device/sensors.")
+    device = str(device)
+    readings = []
+    for sensor in sensors:
+        if not isinstance(sensor, dict) or "type" not in sensor or "value" not in sensor:
+            raise ValueError("MQTT sensor item invalid: missing type/value.")
+        readings.append(validate_reading(device, sensor["type"], sensor["value"], received_at))
+    return readings
+
+def _parser_loop():
+    while True:
+        item = _raw_queue.get()
+        if item is None:
+            return
+        try:
+            _process_message(*item)
+        except Exception as e: # Un mensaje inesperado no puede terminar el worker
+            logger.error("MQTT: Error processing message: %s", e)
+            _count("invalid")
+            _report_error(f"MQTT message could not be processed: {e}")
+
+def _process_message(topic, payload, received_at):
+    start = time.perf_counter()
+    try:
+        readings = parse_message(topic, payload, received_at)
+    except ValueError as e:
+        _count("invalid")
+        _report_error(str(e))
+        return
+    _count("parsed")
+    dropped = 0
+    for device, sensor_type, value, ts in readings:
+        if not insert_sensor_data(device, sensor_type, value, ts):
+            dropped += 1
+    _count("readings", len(readings) - dropped)
+    if dropped:
+        _count("ingest_dropped", dropped)
+    MQTT_PARSE_SECONDS.since(start)
+
+Gauge("flaskhs_mqtt_queue_size", "MQTT messages waiting to be parsed", callback=lambda: _raw_queue.qsize())
+
+def get_pipeline_stats():
+    """
+    Retorna los contadores del pipeline y la ocupación de la cola de mensajes.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["queued"] = _raw_queue.qsize()
+    stats["workers"] = sum(1 for worker in _workers if worker.is_alive())
+    return stats
+
+def start_pipeline(error_handler=None):
+    """
+    Arranca los hilos parser. 'error_handler' recibe un texto cuando hay mensajes
+    inválidos (con límite de frecuencia).
+    """
+    global _error_handler
+    _error_handler = error_handler
+    if any(worker.is_alive() for worker in _workers):
+        return
+    _workers.clear()
+    for i in range(MQTT_PARSER_WORKERS):
+        worker = threading.Thread(target=_parser_loop, name=f"mqtt-parser-{i}", daemon=True)
+        worker.start()
+        _workers.append(worker)
+
+def stop_pipeline(timeout=MQTT_SHUTDOWN_TIMEOUT):
+    """
+    Procesa los mensajes pendientes y detiene los hilos parser. Llamar antes de
+    stop_ingest_writer() para que sus lecturas también se guarden.
+    """
+    deadline = time.monotonic() + timeout
+    for _ in _workers:
+        try:
+            _raw_queue.put(None, timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Full:
+            break
+    for worker in _workers:
+        worker.join(max(0.0, deadline - time.monotonic()))
+    if any(worker.is_alive() for worker in _workers):
+        logger.warning("MQTT: Pipeline stopped with %s messages still queued.", _raw_queue.qsize())
@@ -0,0 +1,148 @@
+# pubsub.py
+# Opciones de Flask-SocketIO para el modo multiproceso y cola de mensajes local.
+# Con FLASKHS_MESSAGE_QUEUE los workers web comparten el estado de Socket.IO (emits a
+# salas y broadcasts) a través de una cola de mensajes: redis://, amqp://, kafka://...
+# (los gestores de python-socketio) o local://host:puerto, un broker mínimo que corre
+# en el proceso supervisor de cluster.py y sirve para pruebas sin Redis ni RabbitMQ.
+
+import os
+import threading
+
+import socketio
+
+import ipc
+from logs import get_logger
+
+logger = get_logger("pubsub")
+
+# --- CONFIGURACIÓN (la fija cluster.py en el entorno de cada worker) ---
+ASYNC_MODE = os.environ.get("FLASKHS_ASYNC_MODE") or None           # eventlet, gevent, threading o None (auto)
+MESSAGE_QUEUE = os.environ.get("FLASKHS_MESSAGE_QUEUE", "")         # URL de la cola; vacío = un solo proceso
+WEBSOCKET_ONLY = os.environ.get("FLASKHS_WEBSOCKET_ONLY", "0") == "1"
+IPC_TOKEN = os.environ.get("FLASKHS_IPC_TOKEN", "")
+SOCKETIO_CHANNEL = "flask-socketio"
+LOCAL_QUEUE_SCHEME = "local://"
+_SUBSCRIBE = b"subscribe" # Primer mensaje de una conexión de escucha; las demás solo publican
+
+class LocalPubSubManager(socketio.PubSubManager):
+    """
+    Gestor de clientes de python-socketio que publica en el broker local de
+    start_broker(). Usa una conexión para publicar y otra para escuchar.
+    """
+    name = "local"
+
+    def __init__(self, url, channel=SOCKETIO_CHANNEL, write_only=False, logger=None, token=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.address = ipc.parse_address(url[len(LOCAL_QUEUE_SCHEME):])
+        self.token = IPC_TOKEN if token is None else token
+        self._publisher = None
+        self._publisher_lock = threading.Lock()
+
+    def _publish(self, data):
+        with self._publisher_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = ipc.connect(self.address, self.token)
+                    self._publisher.send(data)
+                    return
+                except OSError as e:
+                    # Reconectar una vez (el broker pudo reiniciarse); si falla de nuevo, se pierde el mensaje
+                    if self._publisher is not None:
+                        self._publisher.close()
+                    self._publisher = None
+                    if attempt:
+                        logger.error("Could not publish to local message queue %s: %s", ipc.format_address(self.address), e)
+
+    def _listen(self):
+        while True:
+            try:
+                channel = ipc.connect(self.address, self.token)
+                channel.send_bytes(_SUBSCRIBE)
+            except OSError as e:
+                logger.error("Could not connect to local message queue %s: %s", ipc.format_address(self.address), e)
+                self.server.sleep(1)
+                continue
+            try:
+                while True:
+                    yield channel.recv()
+            except (EOFError, OSError) as e:
+                logger.warning("Local message queue connection lost: %s", e)
+                channel.close()
+
+def socketio_options():
+    """
+    Argumentos de SocketIO(app, ...) según la configuración del proceso: modo asíncrono,
+    gestor de la cola de mensajes y transportes permitidos.
+    """
+    options = {}
+    if ASYNC_MODE:
+        options["async_mode"] = ASYNC_MODE
+    if MESSAGE_QUEUE.startswith(LOCAL_QUEUE_SCHEME):
+        options["client_manager"] = LocalPubSubManager(MESSAGE_QUEUE)
+    elif MESSAGE_QUEUE:
+        options["message_queue"] = MESSAGE_QUEUE
+        options["channel"] = SOCKETIO_CHANNEL
+    if WEBSOCKET_ONLY:
+        # Con SO_REUSEPORT no hay sesiones fijas: el long-polling repartiría las peticiones
+        # de un cliente entre workers, así que solo se acepta WebSocket (una conexión TCP)
+        options["transports"] = ["websocket"]
+    return options
+
+def client_transports():
+    """
+    Transportes que debe usar el cliente Socket.IO del dashboard.
+    """
+    return ["websocket"] if WEBSOCKET_ONLY else ["polling", "websocket"]
+
+# --- BROKER LOCAL ---
+
+_broker_subscribers = []
+_broker_lock = threading.Lock()
+
+def _broker_relay(channel):
+    # Reenvía cada mensaje sin deserializarlo a todos los suscriptores, incluido el worker
+    # emisor: PubSubManager entrega también sus propios mensajes a sus clientes locales
+    try:
+        while True:
+            data = channel.recv_bytes()
+            if data == _SUBSCRIBE:
+                with _broker_lock:
+                    _broker_subscribers.append(channel)
+                continue
+            with _broker_lock:
+                subscribers = list(_broker_subscribers)
+            for subscriber in subscribers:
+                try:
+                    subscriber.send_bytes(data)
+                except OSError:
+                    _broker_drop(subscriber)
+    except (EOFError, OSError):
+        pass
+    _broker_drop(channel)
+
+def _broker_drop(channel):
+    with _broker_lock:
+        if channel in _broker_subscribers:
+            _broker_subscribers.remove(channel)
+    channel.close()
+
+def _broker_accept_loop(server, token):
+    while True:
+        try:
+            channel = ipc.accept(server, token)
+        except OSError:
+            return # Socket de escucha cerrado
+        if channel is None:
+            logger.warning("Rejected local message queue connection with an invalid token.")
+            continue
+        threading.Thread(target=_broker_relay, args=(channel,), name="mq-relay", daemon=True).start()
+
+def start_broker(token, port=0):
+    """
+    Arranca el broker local en segundo plano. Retorna la URL local://host:puerto para FLASKHS_MESSAGE_QUEUE.
+    """
+    server, address = ipc.listen(port)
+    threading.Thread(target=_broker_accept_loop, args=(server, token), name="mq-broker", daemon=True).start()
+    logger.info("Local message queue listening on %s", ipc.format_address(address))
+    return LOCAL_QUEUE_SCHEME + ipc.format_address(address)
@@ -0,0 +1,262 @@
+# registry.py
+# Registro en memoria de los dispositivos. Los heartbeats (/api/register-device y las
+# lecturas de sensores) solo actualizan un diccionario; un hilo guarda periódicamente
+# los dispositivos modificados con un UPSERT en lote y detecta los que dejan de
+# responder con una rueda de temporizadores (timer wheel), sin recorrer todo el registro.
+
+import atexit
+import calendar
+import math
+import threading
+import time
+
+from database import get_all_devices, upsert_devices, add_ingest_listener
+from logs import get_logger
+from metrics import Gauge
+
+logger = get_logger("registry")
+
+# --- CONFIGURACIÓN DEL REGISTRO ---
+DEVICE_OFFLINE_AFTER = 30.0   # Segundos sin heartbeat tras los que un dispositivo pasa a offline
+DEVICE_WHEEL_TICK = 1.0       # Resolución de la rueda de temporizadores (segundos)
+DEVICE_FLUSH_INTERVAL = 5.0   # Segundos entre escrituras en lote de los dispositivos modificados
+
+_WHEEL_SLOTS = int(math.ceil(DEVICE_OFFLINE_AFTER / DEVICE_WHEEL_TICK)) + 1
+
+_lock = threading.Lock()
+_devices = {}         # name -> {"ip", "type", "last_seen" (epoch), "online"}
+_dirty = set()        # Dispositivos con cambios pendientes de guardar
+_loaded = False
+_wheel = [set() for _ in range(_WHEEL_SLOTS)]  # Slot -> nombres cuyo plazo vence en ese tick
+_wheel_slot = {}      # name -> slot en el que está programado
+_wheel_tick = 0       # Tick actual de la rueda
+_status_listeners = []
+_thread = None
+_stop = threading.Event()
+
+def _format_last_seen(ts):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts))
+
+def _parse_last_seen(text):
+    try:
+        return calendar.timegm(time.strptime(text[:19], "%Y-%m-%d %H:%M:%S"))
+    except (TypeError, ValueError):
+        return 0.0
+
+def _ensure_loaded():
+    """
+    Carga los dispositivos de la DB la primera vez que se usa el registro.
+    Se llama con _lock tomado.
+    """
+    global _loaded
+    if _loaded:
+        return
+    now = time.time()
+    for name, ip, device_type, last_seen in get_all_devices():
+        seen = _parse_last_seen(last_seen)
+        online = now - seen < DEVICE_OFFLINE_AFTER
+        _devices[name] = {"ip": ip, "type": device_type, "last_seen": seen, "online": online}
+        if online:
+            _schedule(name, seen)
+    _loaded = True
+
+def _schedule(name, last_seen):
+    """
+    Programa (o reprograma) la expiración de un dispositivo en la rueda: O(1).
+    """
+    ticks = max(1, int(math.ceil((last_seen + DEVICE_OFFLINE_AFTER - time.time()) / DEVICE_WHEEL_TICK)))
+    slot = (_wheel_tick + min(ticks, _WHEEL_SLOTS - 1)) % _WHEEL_SLOTS
+    old = _wheel_slot.get(name)
+    if old == slot:
+        return
+    if old is not None:
+        _wheel[old].discard(name)
+    _wheel[slot].add(name)
+    _wheel_slot[name] = slot
+
+def _notify_status(changes):
+    for name, online, last_seen in changes:
+        for listener in _status_listeners:
+            try:
+                listener(name, online, last_seen)
+            except Exception as e:
+                logger.error("Error in device status listener for %s: %s", name, e)
+
+def heartbeat(name, ip=None, device_type=None, seen_at=None):
+    """
+    Marca un dispositivo como visto. Si se indican 'ip' y 'device_type' lo registra o
+    actualiza; sin ellos solo actualiza dispositivos ya registrados. Retorna False si
+    el dispositivo no está registrado y no se puede crear.
+    """
+    now = time.time() if seen_at is None else seen_at
+    changes = []
+    with _lock:
+        _ensure_loaded()
+        device = _devices.get(name)
+        if device is None:
+            if ip is None or device_type is None:
+                return False
+            device = _devices[name] = {"ip": ip, "type": device_type, "last_seen": now, "online": False}
+        elif ip is not None and device_type is not None:
+            device["ip"], device["type"] = ip, device_type
+        device["last_seen"] = max(device["last_seen"], now)
+        _dirty.add(name)
+        if not device["online"]:
+            device["online"] = True
+            changes.append((name, True, device["last_seen"]))
+        _schedule(name, device["last_seen"])
+    _notify_status(changes)
+    return True
+
+def merge_devices(rows):
+    """
+    Incorpora dispositivos [(name, ip, type, last_seen)] guardados por otro proceso del
+    clúster. No los marca como modificados: ya los guardó el proceso que los recibió.
+    """
+    now = time.time()
+    changes = []
+    with _lock:
+        _ensure_loaded()
+        for name, ip, device_type, last_seen in rows:
+            seen = min(_parse_last_seen(last_seen), now)
+            device = _devices.get(name)
+            if device is None:
+                device = _devices[name] = {"ip": ip, "type": device_type, "last_seen": seen, "online": False}
+            else:
+                device["ip"], device["type"] = ip, device_type
+                device["last_seen"] = max(device["last_seen"], seen)
+            if not device["online"] and now - device["last_seen"] < DEVICE_OFFLINE_AFTER:
+                device["online"] = True
+                changes.append((name, True, device["last_seen"]))
+            if device["online"]:
+                _schedule(name, device["last_seen"])
+    _notify_status(changes)
+
+def register_device(name, ip, device_type):
+    """
+    Registra o actualiza un dispositivo en memoria; se guarda en el siguiente flush.
+    """
+    heartbeat(name, ip, device_type)
+
+def _touch_from_readings(readings):
+    # Una lectura de sensor también cuenta como heartbeat de un dispositivo registrado
+    seen = {}
+    for device, _sensor_type, _value, ts in readings:
+        if ts > seen.get(device, 0.0):
+            seen[device] = ts
+    now = time.time()
+    for device, ts in seen.items():
+        # Las lecturas antiguas (backfill de lotes) no dicen nada de la conexión actual
+        if device in _devices and now - ts < DEVICE_OFFLINE_AFTER:
+            heartbeat(device, seen_at=min(ts, now))
+
+def get_devices():
+    """
+    Lista [(name, ip, type, last_seen)] como get_all_devices(), servida desde memoria
+    y ordenada por 'last_seen' descendente.
+    """
+    with _lock:
+        _ensure_loaded()
+        items = sorted(_devices.items(), key=lambda item: item[1]["last_seen"], reverse=True)
+        return [(name, d["ip"], d["type"], _format_last_seen(d["last_seen"])) for name, d in items]
+
+def get_device_status():
+    """
+    Lista [{"name", "ip", "type", "last_seen" (epoch s), "online"}] de todos los dispositivos.
+    """
+    with _lock:
+        _ensure_loaded()
+        return [{"name": name, "ip": d["ip"], "type": d["type"], "last_seen": d["last_seen"], "online": d["online"]}
+                for name, d in _devices.items()]
+
+def _count_by_status():
+    with _lock:
+        online = sum(1 for device in _devices.values() if device["online"])
+        return {("online",): online, ("offline",): len(_devices) - online}
+
+Gauge("flaskhs_devices", "Registered devices by liveness status", ("status",), callback=_count_by_status)
+
+def add_status_listener(listener):
+    """
+    Registra una función que recibe (name, online, last_seen) cuando un dispositivo
+    pasa a online u offline. Se llama fuera del lock del registro.
+    """
+    if listener not in _status_listeners:
+        _status_listeners.append(listener)
+
+def _advance_wheel():
+    """
+    Avanza un tick y marca offline los dispositivos cuyo plazo venció en ese slot.
+    """
+    global _wheel_tick
+    now = time.time()
+    changes = []
+    with _lock:
+        _wheel_tick = (_wheel_tick + 1) % _WHEEL_SLOTS
+        expiring = _wheel[_wheel_tick]
+        _wheel[_wheel_tick] = set()
+        for name in expiring:
+            del _wheel_slot[name]
+            device = _devices.get(name)
+            if device is None:
+                continue
+            if now - device["last_seen"] >= DEVICE_OFFLINE_AFTER - DEVICE_WHEEL_TICK / 2:
+                device["online"] = False
+                changes.append((name, False, device["last_seen"]))
+            else:
+                _schedule(name, device["last_seen"])
+    _notify_status(changes)
+
+def flush_devices():
+    """
+    Guarda en un único UPSERT en lote los dispositivos modificados desde el último flush.
+    """
+    with _lock:
+        if not _dirty:
+            return True
+        names = list(_dirty)
+        _dirty.clear()
+        rows = [(name, _devices[name]["ip"], _devices[name]["type"], _format_last_seen(_devices[name]["last_seen"]))
+                for name in names]
+    if upsert_devices(rows):
+        return True
+    with _lock:
+        _dirty.update(names) # Reintentar en el siguiente flush
+    return False
+
+def _registry_loop():
+    next_flush = time.monotonic() + DEVICE_FLUSH_INTERVAL
+    next_tick = time.monotonic() + DEVICE_WHEEL_TICK
+    while not _stop.wait(max(0.0, next_tick - time.monotonic())):
+        try:
+            _advance_wheel()
+            if time.monotonic() >= next_flush:
+                flush_devices()
+                next_flush = time.monotonic() + DEVICE_FLUSH_INTERVAL
+        except Exception as e:
+            logger.error("Error in device registry loop: %s", e)
+        next_tick += DEVICE_WHEEL_TICK
+
+def start_registry():
+    """
+    Carga el registro, lo engancha a la ingesta de sensores y arranca el hilo que
+    avanza la rueda de temporizadores y guarda los cambios.
+    """
+    global _thread
+    with _lock:
+        _ensure_loaded()
+    if _thread is not None and _thread.is_alive():
+        return
+    add_ingest_listener(_touch_from_readings)
+    _stop.clear()
+    _thread = threading.Thread(target=_registry_loop, name="device-registry", daemon=True)
+    _thread.start()
+
+def stop_registry():
+    """
+    Detiene el hilo del registro y guarda los cambios pendientes.
+    """
+    _stop.set()
+    flush_devices()
+
+atexit.register(stop_registry)
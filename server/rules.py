@@ -0,0 +1,445 @@
+# rules.py
+# Motor de reglas incremental sobre el flujo de lecturas. Cada regla observa una serie
+# (dispositivo o "*", sensor), calcula un agregado sobre una ventana deslizante de N
+# segundos y, cuando la condición se cumple, cambia los LEDs o envía una alerta:
+#
+#   {"rules": [
+#     {"name": "dark-room", "device": "ESP32", "type": "light", "window": 30,
+#      "aggregate": "avg", "op": "<", "threshold": 200,
+#      "action": {"led": {"ledRed": 1}}, "reset": {"led": {"ledRed": 0}}},
+#     {"name": "noise", "device": "*", "type": "sound", "window": 10,
+#      "aggregate": "count_above", "level": 800, "op": ">=", "threshold": 3,
+#      "action": {"alert": "Noise peaks on {device}"}, "cooldown": 60}
+#   ]}
+#
+# Las lecturas llegan por el listener de ingesta (HTTP y MQTT pasan por el mismo camino),
+# el estado de cada ventana se actualiza en O(1) amortizado y solo se evalúan las reglas
+# indexadas por la serie de la lectura. Las acciones se disparan por flanco (al empezar a
+# cumplirse la condición), respetan un cooldown y los cambios de LEDs se agrupan durante
+# RULES_ACTION_DEBOUNCE antes de enviar un único comando. El archivo se recarga en
+# caliente al cambiar (ver RULES_PATH).
+
+import json
+import operator
+import os
+import threading
+import time
+from collections import deque
+
+from database import add_ingest_listener
+from logs import get_logger
+
+logger = get_logger("rules")
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# --- CONFIGURACIÓN DEL MOTOR DE REGLAS ---
+RULES_PATH = os.environ.get("FLASKHS_RULES_PATH", os.path.join(SERVER_DIR, "rules.json"))
+RULES_ENABLED = os.environ.get("FLASKHS_RULES", "1") != "0" # cluster.py solo las evalúa en un worker
+RULES_RELOAD_INTERVAL = 2.0    # Segundos entre comprobaciones de cambios en el archivo de reglas
+RULES_ACTION_DEBOUNCE = 0.5    # Segundos que se agrupan los cambios de LEDs antes de enviar un comando
+RULES_DEFAULT_COOLDOWN = 10.0  # Segundos mínimos entre dos disparos de una regla para un mismo dispositivo
+RULES_MAX_WINDOW = 3600.0      # Ventana máxima (s)
+RULES_MAX_RULES = 500
+WILDCARD = "*"
+
+AGGREGATES = ("avg", "sum", "min", "max", "count", "last", "count_above", "count_below")
+OPERATORS = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge,
+             "==": operator.eq, "!=": operator.ne}
+LED_FIELDS = ("ledRed", "ledGreen")
+
+_lock = threading.Lock()
+_rules = []           # Reglas cargadas (_Rule)
+_index = {}           # (device o "*", sensor_type) -> [reglas]
+_series_rules = {}    # (device, sensor_type) -> reglas aplicables (exactas + comodín), resuelto una vez por serie
+_windows = {}         # (device, sensor_type) -> {segundos: _Window}
+_state = {}           # (nombre de regla, device) -> [activa, desde (ts), último disparo (ts)]
+_pending_leds = {}    # destino (None = todos, o tupla de dispositivos) -> {campo: valor}
+_pending_alerts = []  # Textos de alerta pendientes de enviar
+_leds_due = None      # Instante (monotonic) en que se envían los cambios de LEDs agrupados
+_loaded_signature = None
+_led_handler = None
+_alert_handler = None
+_thread = None
+_stop = threading.Event()
+_wake = threading.Event()
+_stats = {"evaluated": 0, "fired": 0, "led_commands": 0, "alerts": 0, "reloads": 0, "late": 0}
+
+class _Window:
+    """
+    Ventana deslizante de una serie: suma acumulada, colas monótonas para mínimo y
+    máximo y contadores por umbral. Cada lectura entra y sale una sola vez (O(1) amortizado).
+    """
+    __slots__ = ("seconds", "items", "total", "mins", "maxs", "above", "below")
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.items = deque()   # (ts, value) en orden de llegada
+        self.total = 0.0
+        self.mins = deque()    # Entradas con valores crecientes (la primera es el mínimo)
+        self.maxs = deque()    # Entradas con valores decrecientes (la primera es el máximo)
+        self.above = {}        # umbral -> lecturas con valor > umbral
+        self.below = {}        # umbral -> lecturas con valor < umbral
+
+    def push(self, ts, value):
+        """
+        Añade una lectura y expulsa las que salen de la ventana. Retorna False si la
+        lectura es anterior a la última (las lecturas atrasadas no se evalúan).
+        """
+        items = self.items
+        if items and ts < items[-1][0]:
+            return False
+        entry = (ts, value)
+        items.append(entry)
+        self.total += value
+        while self.mins and self.mins[-1][1] >= value:
+            self.mins.pop()
+        self.mins.append(entry)
+        while self.maxs and self.maxs[-1][1] <= value:
+            self.maxs.pop()
+        self.maxs.append(entry)
+        for level in self.above:
+            if value > level:
+                self.above[level] += 1
+        for level in self.below:
+            if value < level:
+                self.below[level] += 1
+
+        limit = ts - self.seconds
+        while items[0][0] <= limit:
+            old = items.popleft()
+            self.total -= old[1]
+            if self.mins[0] is old:
+                self.mins.popleft()
+            if self.maxs[0] is old:
+                self.maxs.popleft()
+            for level in self.above:
+                if old[1] > level:
+                    self.above[level] -= 1
+            for level in self.below:
+                if old[1] < level:
+                    self.below[level] -= 1
+        if len(items) == 1:
+            self.total = value # Evita que los errores de redondeo de la suma se acumulen
+        return True
+
+    def aggregate(self, kind, level=None):
+        items = self.items
+        if kind == "avg":
+            return self.total / len(items)
+        if kind == "sum":
+            return self.total
+        if kind == "min":
+            return self.mins[0][1]
+        if kind == "max":
+            return self.maxs[0][1]
+        if kind == "count":
+            return len(items)
+        if kind == "last":
+            return items[-1][1]
+        if kind == "count_above":
+            return self.above[level]
+        return self.below[level]
+
+class _Rule:
+    __slots__ = ("name", "device", "sensor_type", "window", "aggregate", "level", "compare", "op",
+                 "threshold", "min_count", "hold", "cooldown", "action", "reset")
+
+def _parse_action(action, name, key):
+    if action is None:
+        return None
+    if not isinstance(action, dict) or not ("led" in action or "alert" in action):
+        raise ValueError(f"rule '{name}': '{key}' must be an object with 'led' and/or 'alert'")
+    parsed = {"led": None, "alert": None, "target": action.get("target", "all")}
+    led = action.get("led")
+    if led is not None:
+        if not isinstance(led, dict) or not led or any(k not in LED_FIELDS or v not in (0, 1) for k, v in led.items()):
+            raise ValueError(f"rule '{name}': '{key}.led' must map {', '.join(LED_FIELDS)} to 0 or 1")
+        parsed["led"] = {k: int(v) for k, v in led.items()}
+    alert = action.get("alert")
+    if alert is not None:
+        if not isinstance(alert, str):
+            raise ValueError(f"rule '{name}': '{key}.alert' must be a string")
+        try:
+            alert.format(rule=name, device="", type="", value=0.0)
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f"rule '{name}': invalid placeholder in '{key}.alert': {e}")
+        parsed["alert"] = alert
+    target = parsed["target"]
+    if not (target in ("all", "source") or (isinstance(target, list) and all(isinstance(d, str) for d in target))):
+        raise ValueError(f"rule '{name}': '{key}.target' must be 'all', 'source' or a list of device names")
+    return parsed
+
+def _parse_rule(spec, position):
+    if not isinstance(spec, dict):
+        raise ValueError(f"rule #{position} must be an object")
+    rule = _Rule()
+    rule.name = spec.get("name") or f"rule-{position}"
+    name = rule.name
+    rule.device = spec.get("device", WILDCARD)
+    rule.sensor_type = spec.get("type")
+    if not isinstance(rule.device, str) or not isinstance(rule.sensor_type, str) or not rule.sensor_type:
+        raise ValueError(f"rule '{name}': 'device' and 'type' must be strings")
+    try:
+        rule.window = float(spec.get("window", 0))
+        rule.threshold = float(spec["threshold"])
+        rule.min_count = int(spec.get("min_count", 1))
+        rule.hold = float(spec.get("for", 0))
+        rule.cooldown = float(spec.get("cooldown", RULES_DEFAULT_COOLDOWN))
+        rule.level = float(spec["level"]) if "level" in spec else None
+    except KeyError as e:
+        raise ValueError(f"rule '{name}': missing {e}")
+    except (TypeError, ValueError):
+        raise ValueError(f"rule '{name}': 'window', 'threshold', 'level', 'min_count', 'for' and 'cooldown' must be numbers")
+    if not 0 < rule.window <= RULES_MAX_WINDOW:
+        raise ValueError(f"rule '{name}': 'window' must be between 0 and {RULES_MAX_WINDOW:g} seconds")
+    if rule.min_count < 1 or rule.hold < 0 or rule.cooldown < 0:
+        raise ValueError(f"rule '{name}': 'min_count' must be at least 1 and 'for'/'cooldown' non-negative")
+    rule.aggregate = spec.get("aggregate", "avg")
+    if rule.aggregate not in AGGREGATES:
+        raise ValueError(f"rule '{name}': 'aggregate' must be one of {', '.join(AGGREGATES)}")
+    if rule.aggregate in ("count_above", "count_below") and rule.level is None:
+        raise ValueError(f"rule '{name}': '{rule.aggregate}' needs a 'level'")
+    rule.op = spec.get("op", ">")
+    if rule.op not in OPERATORS:
+        raise ValueError(f"rule '{name}': 'op' must be one of {' '.join(OPERATORS)}")
+    rule.compare = OPERATORS[rule.op]
+    rule.action = _parse_action(spec.get("action"), name, "action")
+    if rule.action is None:
+        raise ValueError(f"rule '{name}': missing 'action'")
+    rule.reset = _parse_action(spec.get("reset"), name, "reset")
+    return rule
+
+def parse_rules(document):
+    """
+    Valida el contenido del archivo de reglas ({"rules": [...]}) y retorna la lista de
+    reglas. Lanza ValueError con un mensaje legible si algo no es válido.
+    """
+    if not isinstance(document, dict) or not isinstance(document.get("rules"), list):
+        raise ValueError("expected an object with a 'rules' list")
+    specs = document["rules"]
+    if len(specs) > RULES_MAX_RULES:
+        raise ValueError(f"too many rules ({len(specs)} > {RULES_MAX_RULES})")
+    rules = [_parse_rule(spec, position) for position, spec in enumerate(specs, 1)]
+    names = [rule.name for rule in rules]
+    if len(set(names)) != len(names):
+        raise ValueError("rule names must be unique")
+    return rules
+
+def set_rules(rules):
+    """
+    Sustituye las reglas activas. Las ventanas y el estado de las reglas empiezan de
+    cero: tras una recarga cada regla espera a llenar su ventana con lecturas nuevas.
+    """
+    global _rules, _index
+    index = {}
+    for rule in rules:
+        index.setdefault((rule.device, rule.sensor_type), []).append(rule)
+    with _lock:
+        _rules = list(rules)
+        _index = index
+        _series_rules.clear()
+        _windows.clear()
+        _state.clear()
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def reload_rules(force=False):
+    """
+    Recarga el archivo de reglas si cambió desde la última carga. Si el archivo nuevo no
+    es válido se mantienen las reglas anteriores. Retorna True si se recargaron.
+    """
+    global _loaded_signature
+    signature = _signature(RULES_PATH)
+    if signature == _loaded_signature and not force:
+        return False
+    _loaded_signature = signature
+    if signature is None:
+        if _rules:
+            logger.info("Rules file %s removed, rules disabled.", RULES_PATH)
+        set_rules([])
+        return True
+    try:
+        with open(RULES_PATH, encoding="utf-8") as f:
+            rules = parse_rules(json.load(f))
+    except (OSError, ValueError) as e: # json.JSONDecodeError es un ValueError
+        logger.error("Invalid rules file %s, keeping the previous rules: %s", RULES_PATH, e)
+        return False
+    set_rules(rules)
+    with _lock:
+        _stats["reloads"] += 1
+    logger.info("Loaded %s rule(s) from %s", len(rules), RULES_PATH)
+    return True
+
+# --- EVALUACIÓN INCREMENTAL ---
+
+def _rules_for(series):
+    """
+    Reglas y ventanas de una serie; se resuelven la primera vez que llega una lectura
+    suya. Se llama con _lock tomado.
+    """
+    rules = _series_rules.get(series)
+    if rules is None:
+        rules = _index.get(series, []) + _index.get((WILDCARD, series[1]), [])
+        _series_rules[series] = rules
+        if rules:
+            windows = _windows[series] = {}
+            for rule in rules:
+                window = windows.get(rule.window)
+                if window is None:
+                    window = windows[rule.window] = _Window(rule.window)
+                if rule.aggregate == "count_above":
+                    window.above.setdefault(rule.level, 0)
+                elif rule.aggregate == "count_below":
+                    window.below.setdefault(rule.level, 0)
+    return rules
+
+def _fire(action, rule, device, sensor_type, value):
+    # Se llama con _lock tomado: solo acumula, el hilo del motor envía los comandos
+    global _leds_due
+    if action["led"] is not None:
+        target = action["target"]
+        key = None if target == "all" else (device,) if target == "source" else tuple(target)
+        _pending_leds.setdefault(key, {}).update(action["led"])
+        if _leds_due is None:
+            _leds_due = time.monotonic() + RULES_ACTION_DEBOUNCE
+    if action["alert"] is not None:
+        value = float("nan") if value is None else value # Al desactivarse con la ventana sin lecturas suficientes
+        _pending_alerts.append(action["alert"].format(rule=rule.name, device=device, type=sensor_type, value=value))
+    _stats["fired"] += 1
+    _wake.set()
+
+def _evaluate(rule, window, device, ts):
+    state = _state.get((rule.name, device))
+    if state is None:
+        state = _state[(rule.name, device)] = [False, None, None]
+    value = window.aggregate(rule.aggregate, rule.level) if len(window.items) >= rule.min_count else None
+    _stats["evaluated"] += 1
+    if value is not None and rule.compare(value, rule.threshold):
+        if state[0]:
+            return
+        if state[1] is None:
+            state[1] = ts
+        if ts - state[1] < rule.hold or (state[2] is not None and ts - state[2] < rule.cooldown):
+            return
+        state[0] = True
+        state[2] = ts
+        _fire(rule.action, rule, device, rule.sensor_type, value)
+    else:
+        state[1] = None
+        if state[0]:
+            state[0] = False
+            if rule.reset is not None:
+                _fire(rule.reset, rule, device, rule.sensor_type, value)
+
+def _on_readings(readings):
+    """
+    Listener de ingesta: actualiza las ventanas de cada serie con reglas y evalúa solo esas reglas.
+    """
+    if not _index:
+        return
+    with _lock:
+        for device, sensor_type, value, ts in readings:
+            series = (device, sensor_type)
+            rules = _series_rules.get(series)
+            if rules is None:
+                rules = _rules_for(series)
+            if not rules:
+                continue
+            windows = _windows[series]
+            late = False
+            for window in windows.values():
+                late = not window.push(ts, value) or late
+            if late:
+                _stats["late"] += 1
+                continue
+            for rule in rules:
+                _evaluate(rule, windows[rule.window], device, ts)
+
+# --- ENVÍO DE ACCIONES Y RECARGA ---
+
+def _flush_actions(force=False):
+    global _leds_due, _pending_leds
+    with _lock:
+        alerts = _pending_alerts[:]
+        del _pending_alerts[:]
+        leds = None
+        if _pending_leds and (force or time.monotonic() >= _leds_due):
+            leds, _pending_leds, _leds_due = _pending_leds, {}, None
+            _stats["led_commands"] += len(leds)
+        _stats["alerts"] += len(alerts)
+    for text in alerts:
+        try:
+            if _alert_handler is not None:
+                _alert_handler(text)
+        except Exception as e:
+            logger.error("Error sending rule alert: %s", e)
+    for target, changes in (leds or {}).items():
+        try:
+            if _led_handler is not None:
+                _led_handler(changes, list(target) if target is not None else None)
+        except Exception as e:
+            logger.error("Error applying rule LED command %s: %s", changes, e)
+
+def _rules_loop():
+    next_reload = time.monotonic() + RULES_RELOAD_INTERVAL
+    while not _stop.is_set():
+        now = time.monotonic()
+        timeout = next_reload - now
+        if _leds_due is not None:
+            timeout = min(timeout, _leds_due - now)
+        _wake.wait(max(0.0, timeout))
+        _wake.clear()
+        _flush_actions()
+        if time.monotonic() >= next_reload:
+            try:
+                reload_rules()
+            except Exception as e:
+                logger.error("Error reloading rules: %s", e)
+            next_reload = time.monotonic() + RULES_RELOAD_INTERVAL
+    _flush_actions(force=True)
+
+def get_rules_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["rules"] = len(_rules)
+        stats["series"] = len(_windows)
+        stats["active"] = sum(1 for state in _state.values() if state[0])
+    return stats
+
+def init_rules(led_handler, alert_handler=None):
+    """
+    Carga las reglas y empieza a evaluarlas con cada lectura ingerida. led_handler(changes,
+    devices) aplica un cambio de LEDs agrupado ({"ledRed": 1}, devices None = todos) y
+    alert_handler(text) notifica una alerta.
+    """
+    global _led_handler, _alert_handler, _thread
+    if not RULES_ENABLED:
+        logger.info("Rules engine disabled in this process.")
+        return
+    _led_handler = led_handler
+    _alert_handler = alert_handler
+    if _thread is not None:
+        return
+    reload_rules(force=True)
+    add_ingest_listener(_on_readings)
+    _stop.clear()
+    _thread = threading.Thread(target=_rules_loop, name="rules", daemon=True)
+    _thread.start()
+
+def stop_rules():
+    """
+    Detiene el hilo del motor enviando las acciones pendientes.
+    """
+    global _thread
+    if _thread is None:
+        return
+    _stop.set()
+    _wake.set()
+    _thread.join()
+    _thread = None
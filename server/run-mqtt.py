@@ -1,20 +1,33 @@
 # run-mqtt.py
 # Servidor Flask con integración MQTT para recibir datos de sensores y controlar LEDs.
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, g
 from flask_socketio import SocketIO, emit
-import requests
-import paho.mqtt.client as mqtt
 import json
+import os
 import time # Posible reintento de conexión MQTT
 
-from database import init_db, get_led_state, update_led_state, insert_sensor_data
+from database import init_db, insert_sensor_data, stop_ingest_writer, get_sensor_snapshot, start_maintenance, ACTUATOR_ALL_DEVICES
+from database import start_spool_replayer, stop_spool_replayer, validate_reading
+from fanout import init_fanout, subscribe, unsubscribe, client_disconnected
+from dispatcher import init_dispatcher, dispatch_command
+from registry import start_registry, stop_registry, get_device_status, add_status_listener
+from mqtt_pipeline import enqueue_message, start_pipeline, stop_pipeline
+from codec import BINARY_CONTENT_TYPE, MQTT_BINARY_SUFFIX, decode_readings
+from pubsub import socketio_options, client_transports
+from rules import init_rules, stop_rules
+from actuators import init_actuators, stop_actuators, set_outputs, get_led_state
+from backfill import get_backfill, parse_range as parse_backfill_range
+from logs import get_logger
+from metrics import render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE, HTTP_INGEST_REQUESTS, HTTP_INGEST_SECONDS, SOCKETIO_CLIENTS
+
+logger = get_logger("run_mqtt")
 
 app = Flask(__name__)
-socketio = SocketIO(app)
+socketio = SocketIO(app, **socketio_options()) # Modo multiproceso: ver cluster.py
 
 # --- CONFIGURACIÓN DE PARÁMETROS ---
-# IP del microcontrolador (usado para control directo de LEDs via HTTP)
+# IP del microcontrolador (control directo de LEDs via HTTP si no hay dispositivos registrados)
 # ¡IMPORTANTE: Reemplaza con la IP real de tu microcontrolador!
 MICRO_IP = "http://192.168.1.100"
 
@@ -22,7 +35,14 @@ MICRO_IP = "http://192.168.1.100"
 MQTT_BROKER_URL = "localhost" # O la IP de tu broker MQTT (ej. "192.168.1.100")
 MQTT_BROKER_PORT = 1883
 MQTT_PUB_TOPIC = "commands/esp32" # Tópico para enviar comandos al ESP32 (ej. LEDs)
-MQTT_SUB_TOPIC = "sensors/data"   # Tópico donde el ESP32 publica los datos de sensores
+# Tópicos donde los dispositivos publican datos de sensores: el tópico común y uno por dispositivo
+# (con el sufijo MQTT_BINARY_SUFFIX, el payload usa el formato binario de codec.py)
+MQTT_SUB_TOPICS = ["sensors/data", "sensors/+/data"]
+MQTT_SUB_TOPICS += [topic + MQTT_BINARY_SUFFIX for topic in MQTT_SUB_TOPICS]
+MQTT_SUB_QOS = 1 # QoS 1: el broker reenvía los mensajes que no confirmamos
+# Grupo de suscripción compartida ($share/<grupo>/<tópico>, MQTT 5 / extensión de Mosquitto y EMQX):
+# varias instancias del servidor con el mismo grupo se reparten los mensajes. Vacío = suscripción normal.
+MQTT_SHARED_GROUP = os.environ.get("FLASKHS_MQTT_SHARED_GROUP", "")
 
 # Cliente MQTT global
 mqtt_client = None
@@ -32,62 +52,44 @@ mqtt_client = None
 def on_connect(client, userdata, flags, rc):
     """Callback que se ejecuta cuando el cliente MQTT se conecta al broker."""
     if rc == 0:
-        print(f"MQTT: Conectado al broker en {MQTT_BROKER_URL}:{MQTT_BROKER_PORT}")
-        client.subscribe(MQTT_SUB_TOPIC)
-        print(f"MQTT: Suscrito al tópico '{MQTT_SUB_TOPIC}'")
+        logger.info("MQTT: Conectado al broker en %s:%s", MQTT_BROKER_URL, MQTT_BROKER_PORT)
+        topics = [f"$share/{MQTT_SHARED_GROUP}/{topic}" if MQTT_SHARED_GROUP else topic for topic in MQTT_SUB_TOPICS]
+        client.subscribe([(topic, MQTT_SUB_QOS) for topic in topics])
+        logger.info("MQTT: Suscrito a los tópicos %s (QoS %s)", topics, MQTT_SUB_QOS)
         # Emitir un mensaje a la UI si está conectada
         socketio.emit("server_message", {"type": "info", "text": "MQTT client connected."}, namespace="/")
     else:
-        print(f"MQTT: Fallo al conectar, código de retorno: {rc}")
+        logger.error("MQTT: Fallo al conectar, código de retorno: %s", rc)
         socketio.emit("server_message", {"type": "error", "text": f"MQTT connection failed (code {rc})."}, namespace="/")
 
 def on_message(client, userdata, msg):
-    """Callback que se ejecuta cuando se recibe un mensaje MQTT."""
-    print(f"MQTT: Mensaje recibido en '{msg.topic}': {msg.payload.decode()}")
-    try:
-        data = json.loads(msg.payload.decode())
-
-        # Validar la estructura del payload MQTT, similar al endpoint HTTP
-        if not all(k in data for k in ("device", "sensors")):
-            print("MQTT Error: Missing required sensor data fields (device, sensors) in payload.")
-            socketio.emit("server_message", {"type": "error", "text": "MQTT payload invalid: missing device/sensors."}, namespace="/")
-            return
-
-        device = data["device"]
-        sensors = data["sensors"]
-
-        for sensor in sensors:
-            if not all(k in sensor for k in ("type", "value")):
-                print("MQTT Error: Each sensor must have 'type' and 'value' fields.")
-                socketio.emit("server_message", {"type": "error", "text": "MQTT sensor item invalid: missing type/value."}, namespace="/")
-                return
-            
-            # Insertar los datos en la base de datos
-            insert_sensor_data(device, sensor["type"], sensor["value"])
-
-        # Emitir los datos a todos los clientes de Socket.IO conectados
-        socketio.emit("sensor_update", data, namespace="/")
-
-    except json.JSONDecodeError:
-        print(f"MQTT Error: Could not decode JSON from message: {msg.payload.decode()}")
-        socketio.emit("server_message", {"type": "error", "text": "MQTT payload not valid JSON."}, namespace="/")
-    except Exception as e:
-        print(f"MQTT Error processing message: {e}")
-        socketio.emit("server_message", {"type": "error", "text": f"MQTT message processing error: {e}"}, namespace="/")
+    """
+    Callback que se ejecuta cuando se recibe un mensaje MQTT. Corre en el hilo de red
+    de paho, así que solo encola los bytes; el parseo y la escritura ocurren en el pipeline.
+    """
+    enqueue_message(msg.topic, msg.payload)
+
+def _report_pipeline_error(text):
+    """Avisa a la UI de mensajes MQTT inválidos (el pipeline limita la frecuencia)."""
+    logger.error("MQTT Error: %s", text)
+    socketio.emit("server_message", {"type": "error", "text": text}, namespace="/")
 
 # --- Configuración y Conexión MQTT ---
 
 def setup_mqtt_client():
     global mqtt_client
     try:
-        mqtt_client = mqtt.Client(client_id="flask_server_app") # ID único para el cliente
+        import paho.mqtt.client as mqtt # Solo al conectar: no retrasa la importación del servidor
+        # ID único por instancia: con suscripciones compartidas corren varios servidores a la vez
+        client_id = f"flask_server_app-{os.getpid()}" if MQTT_SHARED_GROUP else "flask_server_app"
+        mqtt_client = mqtt.Client(client_id=client_id)
         mqtt_client.on_connect = on_connect
         mqtt_client.on_message = on_message
         mqtt_client.connect_async(MQTT_BROKER_URL, MQTT_BROKER_PORT, 60) # Conexión asíncrona
         mqtt_client.loop_start() # Inicia el hilo de bucle en segundo plano
-        print(f"MQTT: Trying to connect to Broker with path {MQTT_BROKER_URL}:{MQTT_BROKER_PORT}...")
+        logger.info("MQTT: Trying to connect to Broker with path %s:%s...", MQTT_BROKER_URL, MQTT_BROKER_PORT)
     except Exception as e:
-        print(f"MQTT Error:Can not config or connect MQTT client: {e}")
+        logger.error("MQTT Error:Can not config or connect MQTT client: %s", e)
         socketio.emit("server_message", {"type": "error", "text": f"MQTT setup failed: {e}"}, namespace="/")
         mqtt_client = None 
 
@@ -96,55 +98,123 @@ def setup_mqtt_client():
 @app.route("/")
 def index():
     """Sirve el dashboard web."""
-    return render_template("index.html")
+    return render_template("index.html", socketio_transports=client_transports())
 
 # --- Socket.IO Event Handlers ---
 
 @socketio.on("connect")
 def on_connect_socketio():
     """Se ejecuta cuando un cliente de Socket.IO se conecta."""
-    print("Socket.IO: Cliente conectado.")
-    state = get_led_state() # Obtener el estado actual de los LEDs de la DB
+    logger.debug("Socket.IO: Cliente conectado.")
+    SOCKETIO_CLIENTS.inc()
+    state = get_led_state() # Estado actual de los LEDs en memoria (actuators.py)
     emit("led_update", state) 
+    snapshot = get_sensor_snapshot() # Últimos valores de sensores en memoria
+    if snapshot:
+        emit("sensor_update", snapshot)
+    emit("device_status", get_device_status())
+
+@socketio.on("subscribe")
+def on_subscribe(data):
+    """
+    Suscribe al cliente a series de sensores:
+    {"series": [{"device": "ESP32", "type": "temperature"}, ...], "max_rate": 2}.
+    "*" sirve de comodín para dispositivo o tipo; max_rate son frames por segundo.
+    """
+    try:
+        if not isinstance(data, dict) or not isinstance(data.get("series"), list):
+            raise ValueError("Expected {'series': [{'device': ..., 'type': ...}], 'max_rate': ...}")
+        subscribe(request.sid, data["series"], data.get("max_rate"))
+    except (TypeError, ValueError) as e:
+        emit("server_message", {"type": "error", "text": f"Invalid subscription: {e}"})
+
+@socketio.on("history_backfill")
+def on_history_backfill(data):
+    """
+    Envía al cliente el histórico reciente submuestreado de un tipo de sensor para
+    rellenar su gráfico: {"type": "light", "range": 3600} (ver backfill.py).
+    """
+    try:
+        if not isinstance(data, dict) or not isinstance(data.get("type"), str):
+            raise ValueError("Expected {'type': ..., 'range': ...}")
+        emit("history_backfill", get_backfill(data["type"], parse_backfill_range(data.get("range"))))
+    except ValueError as e:
+        emit("server_message", {"type": "error", "text": f"Invalid history request: {e}"})
+
+@socketio.on("unsubscribe")
+def on_unsubscribe(data=None):
+    """
+    Cancela suscripciones: {"series": [...]} o todas si no se indican series.
+    """
+    series = data.get("series") if isinstance(data, dict) else None
+    unsubscribe(request.sid, series if isinstance(series, list) else None)
+
+@socketio.on("disconnect")
+def on_disconnect():
+    SOCKETIO_CLIENTS.dec()
+    client_disconnected(request.sid)
 
 @socketio.on("control_led")
 def on_control_led(data):
     """
-    Recibe comandos de control de LED desde el dashboard y los envía al ESP32
-    y al broker MQTT.
+    Recibe comandos de control de LED desde el dashboard: {"ledRed": 1, "ledGreen": 0},
+    opcionalmente con "devices": [...]. actuators.py combina los comandos repetidos y,
+    si el estado cambia, lo envía al ESP32 y al broker MQTT con _send_actuator_state.
     """
-    update_led_state(data)
-    
-    # 1. Enviar comando al ESP32 vía HTTP (alternativa si MQTT no está listo)
+    if not isinstance(data, dict):
+        logger.warning("Invalid LED control data received: %s", data)
+        return
+    devices = data.get("devices")
+    outputs = {key: value for key, value in data.items() if key not in ("devices", "version")}
     try:
-        requests.post(f"{ESP32_IP}/api/control-led", json=data)
-        print(f"HTTP: Enviado control de LED a ESP32 ({ESP32_IP}): {data}")
-    except Exception as e:
-        print(f"HTTP: Fallo al contactar al ESP32 ({ESP32_IP}): {e}")
-        # Emitir error al frontend si la conexión HTTP falla
-        emit("server_message", {"type": "error", "text": f"Failed to control ESP32 via HTTP: {e}"}, namespace="/")
+        set_outputs(outputs, devices if isinstance(devices, list) else None)
+    except ValueError as e:
+        emit("server_message", {"type": "error", "text": f"Invalid LED command: {e}"}, namespace="/")
+
+def _send_actuator_state(device, state, version):
+    """
+    Envía el nuevo estado de un dispositivo ("*": todos) por HTTP y por MQTT y lo emite
+    a todos los clientes. actuators.py solo lo llama si algo cambió.
+    """
+    devices = None if device == ACTUATOR_ALL_DEVICES else [device]
+
+    # 1. Enviar comando vía HTTP en segundo plano a los dispositivos registrados
+    #    (alternativa si MQTT no está listo); los resultados llegan como 'server_message'
+    if not dispatch_command("/api/control-led", state, devices):
+        logger.info("No devices available to receive the LED command via HTTP.")
 
     # 2. Publicar comando en MQTT (opción preferida si MQTT está configurado)
     if mqtt_client and mqtt_client.is_connected():
         try:
             # Puedes enviar un payload más específico si el ESP32 lo espera así
             # Por ejemplo, {"red": 1} o {"command": "toggle_red_led"}
-            mqtt_payload = {
-                "ledRed": data.get("ledRed"),
-                "ledGreen": data.get("ledGreen")
-            }
+            mqtt_payload = dict(state)
+            if devices:
+                mqtt_payload["device"] = device
             mqtt_client.publish(MQTT_PUB_TOPIC, json.dumps(mqtt_payload))
-            print(f"MQTT: Publicado comando de LED en '{MQTT_PUB_TOPIC}': {mqtt_payload}")
+            logger.debug("MQTT: Publicado comando de LED en '%s': %s", MQTT_PUB_TOPIC, mqtt_payload)
         except Exception as e:
-            print(f"MQTT: Failed to publish command via MQTT: {e}")
-            emit("server_message", {"type": "error", "text": f"Failed to publish LED command via MQTT: {e}"}, namespace="/")
+            logger.error("MQTT: Failed to publish command via MQTT: %s", e)
+            socketio.emit("server_message", {"type": "error", "text": f"Failed to publish LED command via MQTT: {e}"}, namespace="/")
+    else:
+        logger.warning("MQTT: MQTT client not connected, LED command sent via HTTP only.")
+
+    # Emitir el estado actualizado a todos los clientes de Socket.IO
+    if devices:
+        socketio.emit("actuator_update", {"device": device, "state": state, "version": version}, namespace="/")
     else:
-        print("MQTT: MQTT client not connected, could not publish LED command.")
-        emit("server_message", {"type": "info", "text": "MQTT not connected, LED command sent via HTTP only."}, namespace="/")
+        socketio.emit("led_update", dict(state, version=version), namespace="/")
 
+def _emit_rule_alert(text):
+    socketio.emit("server_message", {"type": "warning", "text": text}, namespace="/")
 
-    # Emitir el estado actualizado de los LEDs a todos los clientes de Socket.IO
-    emit("led_update", data, broadcast=True)
+def _report_command_result(device, ok, text):
+    """Notifica a todos los clientes el resultado de un comando HTTP enviado a un dispositivo."""
+    socketio.emit("server_message", {"type": "info" if ok else "error", "text": text}, namespace="/")
+
+def _emit_device_status(name, online, last_seen):
+    """Notifica a los clientes de este proceso que un dispositivo pasó a online u offline."""
+    socketio.emit("device_status", [{"name": name, "online": online, "last_seen": last_seen}], namespace="/", ignore_queue=True)
 
 # --- HTTP Endpoint para recibir datos de sensores (Alternativa/Respaldo) ---
 
@@ -153,40 +223,115 @@ def update_sensor_data_http():
     """
     Endpoint HTTP para que los microcontroladores envíen datos de sensores.
     Esto sirve como respaldo si la publicación MQTT falla o no se usa en el ESP32.
+    Acepta JSON o el formato binario de codec.py (Content-Type application/x-flaskhs-sensor).
     """
     try:
-        data = request.get_json()
-        # Validar la estructura del payload
-        if not all(k in data for k in ("device", "sensors")):
-            return jsonify({"status": "error", "message": "Missing required sensor data fields (device, sensors)"}), 400
-            
-        device = data["device"]
-        sensors = data["sensors"]
-        
-        for sensor in sensors:
-            if not all(k in sensor for k in ("type","value")):
-                return jsonify({"status": "error", "message": "Each sensor must have 'type' and 'value' fields"}), 400
-            # Insertar los datos en la base de datos
-            insert_sensor_data(device, sensor["type"], sensor["value"])
-
-        # Emitir los datos a todos los clientes de Socket.IO conectados
-        socketio.emit("sensor_update", data, namespace="/")
+        now = time.time()
+        if request.mimetype == BINARY_CONTENT_TYPE:
+            try:
+                # Timestamps base fuera de rango, NaN o infinitos se rechazan antes de encolar nada
+                readings = [validate_reading(*reading) for reading in decode_readings(request.get_data(cache=False), now)]
+            except ValueError as e:
+                return jsonify({"status": "error", "message": str(e)}), 400
+        else:
+            data = request.get_json()
+            # Validar la estructura del payload
+            if not all(k in data for k in ("device", "sensors")):
+                return jsonify({"status": "error", "message": "Missing required sensor data fields (device, sensors)"}), 400
+
+            readings = []
+            for sensor in data["sensors"]:
+                if not all(k in sensor for k in ("type","value")):
+                    return jsonify({"status": "error", "message": "Each sensor must have 'type' and 'value' fields"}), 400
+                try:
+                    # Valores no numéricos, NaN o infinitos se rechazan antes de encolar nada
+                    readings.append(validate_reading(data["device"], sensor["type"], sensor["value"], now))
+                except ValueError as e:
+                    return jsonify({"status": "error", "message": str(e)}), 400
+
+        # Encolar los datos para su escritura en lote (write-behind)
+        dropped = 0
+        for device, sensor_type, value, ts in readings:
+            if not insert_sensor_data(device, sensor_type, value, ts):
+                dropped += 1
+
+        # Las lecturas llegan a los dashboards suscritos a través del fan-out
+        if dropped:
+            # Cola de ingesta llena: avisar al dispositivo para que reintente más tarde
+            return jsonify({"status": "error", "message": f"Server busy, {dropped} sensor readings dropped."}), 503
         return jsonify({"status": "success", "message": "Sensor data received and processed."}), 200
     except Exception as e:
-        print(f"Error processing sensor data via HTTP: {e}")
+        logger.error("Error processing sensor data via HTTP: %s", e)
         return jsonify({"status": "error", "message": f"Error processing sensor data via HTTP: {e}"}), 500
 
+# --- MÉTRICAS ---
+INGEST_ENDPOINTS = ("update_sensor_data_http",)
+
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def _record_ingest_metrics(response):
+    if request.endpoint in INGEST_ENDPOINTS:
+        HTTP_INGEST_SECONDS.since(g.request_start, (request.path,))
+        HTTP_INGEST_REQUESTS.inc(labels=(request.path, str(response.status_code)))
+    return response
+
+@app.route("/metrics")
+def metrics():
+    """
+    Métricas del servidor en formato de texto de Prometheus.
+    """
+    return Response(render_metrics(), mimetype=METRICS_CONTENT_TYPE)
+
 # --- Inicio de la Aplicación ---
 
+def start_services():
+    """
+    Arranca los servicios en segundo plano y el cliente MQTT. Se usa tanto al ejecutar
+    run-mqtt.py directamente como en cada worker de cluster.py (con FLASKHS_MQTT_SHARED_GROUP).
+    """
+    init_fanout(socketio) # Envío agrupado de lecturas a los clientes suscritos
+    init_dispatcher(_report_command_result, MICRO_IP)
+    add_status_listener(_emit_device_status)
+    start_registry() # Registro de dispositivos en memoria y detección de offline
+    init_actuators(_send_actuator_state) # Estado de LEDs en memoria con guardado en lote
+    init_rules(set_outputs, _emit_rule_alert) # Reglas sobre las lecturas (rules.json)
+    start_pipeline(_report_pipeline_error) # Hilos que parsean los mensajes MQTT
+    setup_mqtt_client() # Configurar y conectar el cliente MQTT
+
+def stop_services():
+    """
+    Desconecta el cliente MQTT y vacía el pipeline y la cola de ingesta.
+    """
+    if mqtt_client:
+        mqtt_client.loop_stop()
+        mqtt_client.disconnect()
+        logger.info("MQTT: Cliente MQTT desconectado.")
+
+    # Procesar los mensajes MQTT pendientes y vaciar la cola de ingesta antes de salir
+    stop_pipeline()
+    stop_rules()
+    stop_actuators()
+    stop_registry()
+    stop_ingest_writer()
+    stop_spool_replayer()
+
 if __name__ == "__main__":
     init_db() 
-    setup_mqtt_client() # Configurar y conectar el cliente MQTT
+    # Con debug=True el reloader de Werkzeug ejecuta el servidor en un proceso hijo
+    # (WERKZEUG_RUN_MAIN); MQTT y los hilos de fondo solo se arrancan ahí para que el
+    # proceso padre no tome el spool ni abra una segunda conexión MQTT.
+    serving = os.environ.get("WERKZEUG_RUN_MAIN") == "true"
+    if serving:
+        start_maintenance() # Retención y vacuum incremental en segundo plano
+        start_spool_replayer() # Lecturas guardadas en disco cuando la base de datos no estaba disponible
+        start_services()
 
     # Iniciar el servidor Flask-SocketIO
     socketio.run(app, host="0.0.0.0", port=5000, debug=True)
 
-    # Cuando el servidor se detenga, detener el bucle de MQTT
-    if mqtt_client:
-        mqtt_client.loop_stop()
-        mqtt_client.disconnect()
-        print("MQTT: Cliente MQTT desconectado.")
+    # Cuando el servidor se detenga, detener MQTT y guardar lo pendiente
+    if serving:
+        stop_services()
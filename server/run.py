@@ -1,29 +1,70 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g
 from flask_socketio import SocketIO, emit
-import requests # Para enviar comandos al microcontrolador
 import json 
+import math
+import os
+import time
 
 from database import (
     init_db,
-    get_led_state,
-    update_led_state,
+    start_maintenance,
     get_latest_sensor_data,
+    get_sensor_snapshot,
+    get_sensor_history,
+    HISTORY_DEFAULT_POINTS,
     insert_sensor_data,
-    register_device, 
-    get_all_devices 
+    insert_sensor_data_batch,
+    stop_ingest_writer,
+    start_spool_replayer,
+    stop_spool_replayer,
+    parse_timestamp,
+    validate_reading,
+    INGEST_MIN_TIMESTAMP,
+    INGEST_MAX_FUTURE_SKEW,
+    ACTUATOR_ALL_DEVICES
 )
+from analytics import (
+    numpy_available,
+    get_series_stats,
+    STATS_DEFAULT_PERCENTILES,
+    STATS_DEFAULT_MA_WINDOW,
+    STATS_DEFAULT_MA_POINTS,
+    STATS_MAX_MA_POINTS
+)
+from export import EXPORT_FORMATS, stream_export, parse_time_arg
+from fanout import init_fanout, subscribe, unsubscribe, client_disconnected
+from dispatcher import init_dispatcher, dispatch_command
+from codec import BINARY_CONTENT_TYPE, iter_frames, frame_readings, decode_readings
+from registry import start_registry, stop_registry, register_device, get_device_status, add_status_listener
+from pubsub import socketio_options, client_transports
+from rules import init_rules, stop_rules
+from actuators import init_actuators, stop_actuators, set_outputs, get_led_state
+from backfill import get_backfill, parse_range as parse_backfill_range
+from logs import get_logger
+from metrics import render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE, HTTP_INGEST_REQUESTS, HTTP_INGEST_SECONDS, SOCKETIO_CLIENTS
+
+logger = get_logger("run")
 
 app = Flask(__name__)
 
-# Configuración de Flask-SocketIO 
-socketio = SocketIO(app)
+# Configuración de Flask-SocketIO (modo asíncrono y cola de mensajes en modo multiproceso, ver cluster.py)
+socketio = SocketIO(app, **socketio_options())
 #socketio = SocketIO(app, async_mode='eventlet') # Asegurar el modo asíncrono si se usa eventlet
 
 # --- CONFIGURACIÓN DE LA APLICACIÓN ---
 # Considerar externalizar estas configuraciones (ej. en un archivo config.py o variables de entorno)
 # Para este ejemplo, dejaremos un placeholder y una nota para el futuro.
 MICROCONTROLLER_DEFAULT_URL = "http://192.168.1.100" 
-# Nota: En un sistema más robusto, la URL se obtendría del registro de dispositivos.
+# Nota: Los comandos van a los dispositivos de la tabla 'devices'; esta URL solo se usa si no hay ninguno registrado.
+
+# Límites del endpoint de ingesta masiva /api/sensor/batch (el rango de timestamps
+# aceptado es el de toda la ingesta: INGEST_MIN_TIMESTAMP e INGEST_MAX_FUTURE_SKEW)
+SENSOR_BATCH_MAX_READINGS = 50000       # Lecturas máximas por petición
+
+# Límites del endpoint de histórico /api/sensor/history
+HISTORY_DEFAULT_RANGE = 24 * 3600       # Rango por defecto (s) si no se indica 'from'
+HISTORY_MAX_POINTS = 10000              # Máximo de puntos que un cliente puede pedir
+STATS_MAX_RANGE = 366 * 86400           # Rango máximo (s) de /api/sensor/stats
 
 # --- RUTAS DE FLASK ---
 @app.route("/")
@@ -31,7 +72,7 @@ def index():
     """
     Renderiza la plantilla principal del dashboard.
     """
-    return render_template("index.html")
+    return render_template("index.html", socketio_transports=client_transports())
 
 @app.route("/api/register-device", methods=["POST"])
 def register_device_api():
@@ -44,20 +85,23 @@ def register_device_api():
         if not all(k in data for k in ("name", "ip", "type")):
             return jsonify({"status": "error", "message": "Missing required fields (name, ip, type)"}), 400
 
-        # Llama a la función de la base de datos para registrar/actualizar el dispositivo
+        # Registra el dispositivo en memoria (también cuenta como heartbeat); se guarda en lote
         register_device(data["name"], data["ip"], data["type"])
 
         return jsonify({"status": "registered", "message": f"Device {data['name']} registered/updated."}), 200
     except Exception as e:
-        print(f"Error registering device: {e}")
+        logger.error("Error registering device: %s", e)
         return jsonify({"status": "error", "message": f"Could not register device: {e}"}), 500
 
 @app.route("/api/sensor", methods=["POST"])
 def update_sensor_data():
     """
     Endpoint para que los microcontroladores envíen datos de sensores.
-    Los datos esperados son {"device": "ESP32", "sensors": [{"type": "light", "value": 23.7}, ...]}.    
+    Los datos esperados son {"device": "ESP32", "sensors": [{"type": "light", "value": 23.7}, ...]},
+    o el formato binario de codec.py con Content-Type application/x-flaskhs-sensor.
     """
+    if request.mimetype == BINARY_CONTENT_TYPE:
+        return _update_sensor_data_binary()
     try:
         data = request.get_json()
         # Validar la estructura del payload
@@ -67,75 +111,459 @@ def update_sensor_data():
         device = data["device"]
         sensors = data["sensors"]
         
+        now = time.time()
+        readings = []
         for sensor in sensors:
             if not all(k in sensor for k in ("type","value")):
                 return jsonify({"status": "error", "message": "Each sensor must have 'type' and 'value' fields"}), 400
-        # Insertar los datos en la base de datos
+            try:
+                # Valores no numéricos, NaN o infinitos se rechazan antes de encolar nada
+                readings.append(validate_reading(device, sensor["type"], sensor["value"], now))
+            except ValueError as e:
+                return jsonify({"status": "error", "message": str(e)}), 400
+        # Encolar los datos para su escritura en lote (write-behind)
         # Se asume que 'device' en el payload es el 'device_name'
-            insert_sensor_data(device, sensor["type"], sensor["value"])
+        dropped = 0
+        for reading in readings:
+            if not insert_sensor_data(*reading):
+                dropped += 1
 
-        # Emitir los datos a todos los clientes de Socket.IO conectados
-        socketio.emit("sensor_update", data, namespace="/")
+        # Las lecturas llegan a los dashboards suscritos a través del fan-out
+        if dropped:
+            # Cola de ingesta llena: avisar al dispositivo para que reintente más tarde
+            return jsonify({"status": "error", "message": f"Server busy, {dropped} sensor readings dropped."}), 503
         return jsonify({"status": "success", "message": "Sensor data received and processed."}), 200
     except Exception as e:
-        print(f"Error processing sensor data: {e}")
+        logger.error("Error processing sensor data: %s", e)
         return jsonify({"status": "error", "message": f"Error processing sensor data: {e}"}), 500
 
+def _update_sensor_data_binary():
+    """
+    Variante binaria de /api/sensor: decodifica los frames sin copiar el cuerpo y encola las lecturas.
+    Si alguna lectura no es válida (p. ej. timestamp base fuera de rango) no se encola ninguna.
+    """
+    try:
+        readings = [validate_reading(*reading) for reading in decode_readings(request.get_data(cache=False), time.time())]
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    dropped = 0
+    for device, sensor_type, value, ts in readings:
+        if not insert_sensor_data(device, sensor_type, value, ts):
+            dropped += 1
+    if dropped:
+        return jsonify({"status": "error", "message": f"Server busy, {dropped} sensor readings dropped."}), 503
+    return jsonify({"status": "success", "message": "Sensor data received and processed."}), 200
+
+def _expand_binary_batch():
+    """
+    Lecturas de un cuerpo binario de /api/sensor/batch: cada frame debe llevar dispositivo
+    y timestamp base. Retorna (readings, rejected) con los rechazos por índice de frame.
+    """
+    readings = []
+    rejected = []
+    now = time.time()
+    for index, (device, base_ts, flags, records) in enumerate(iter_frames(request.get_data(cache=False))):
+        try:
+            if not device:
+                raise ValueError("Missing device name")
+            if base_ts is None:
+                raise ValueError("Missing 'timestamp'")
+            frame = frame_readings(device, base_ts, flags, records)
+            if any(ts < INGEST_MIN_TIMESTAMP or ts > now + INGEST_MAX_FUTURE_SKEW for _, _, _, ts in frame):
+                raise ValueError("Timestamp out of range")
+            readings.extend(frame)
+        except ValueError as e:
+            rejected.append({"index": index, "error": str(e)})
+        if len(readings) > SENSOR_BATCH_MAX_READINGS:
+            break
+    return readings, rejected
+
+def _iter_batch_items():
+    """
+    Itera los elementos de una petición a /api/sensor/batch, ya sea un array JSON
+    (o {"readings": [...]}) o un flujo NDJSON (una lectura JSON por línea).
+    Los elementos que no se pueden decodificar se entregan como excepción.
+    """
+    mimetype = request.mimetype
+    if mimetype in ("application/x-ndjson", "application/ndjson", "application/jsonl"):
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield e
+        return
+
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get("readings")
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array of readings or an NDJSON stream")
+    yield from data
+
+def _expand_batch_item(item):
+    """
+    Valida un elemento del lote y lo convierte en lecturas (device, type, value, ts).
+    Acepta lecturas planas {"device", "type", "value", "timestamp"} o el formato de
+    /api/sensor con timestamp: {"device", "timestamp", "sensors": [{"type", "value"[, "timestamp"]}]}.
+    Lanza ValueError con el motivo del rechazo.
+    """
+    if isinstance(item, Exception):
+        raise ValueError(f"Invalid JSON: {item}")
+    if not isinstance(item, dict):
+        raise ValueError("Each reading must be a JSON object")
+    device = item.get("device")
+    if not isinstance(device, str) or not device:
+        raise ValueError("Missing or invalid 'device'")
+
+    sensors = item["sensors"] if "sensors" in item else [item]
+    if not isinstance(sensors, list):
+        raise ValueError("'sensors' must be a list")
+
+    now = time.time()
+    readings = []
+    for sensor in sensors:
+        if not isinstance(sensor, dict) or not all(k in sensor for k in ("type", "value")):
+            raise ValueError("Each sensor must have 'type' and 'value' fields")
+        sensor_type, value = sensor["type"], sensor["value"]
+        if not isinstance(sensor_type, str) or not sensor_type:
+            raise ValueError("Invalid sensor 'type'")
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f"Invalid value for sensor '{sensor_type}'")
+        raw_ts = sensor.get("timestamp", item.get("timestamp"))
+        if raw_ts is None:
+            raise ValueError("Missing 'timestamp'")
+        ts = parse_timestamp(raw_ts)
+        if ts < INGEST_MIN_TIMESTAMP or ts > now + INGEST_MAX_FUTURE_SKEW:
+            raise ValueError(f"Timestamp out of range: {raw_ts}")
+        readings.append((device, sensor_type, float(value), ts))
+    return readings
+
+@app.route("/api/sensor/batch", methods=["POST"])
+def update_sensor_data_batch():
+    """
+    Endpoint de ingesta masiva para que los microcontroladores reenvíen lecturas
+    almacenadas mientras estaban sin conexión. Cada lectura lleva su propio timestamp
+    (epoch en s/ms o ISO 8601). Acepta un array JSON, NDJSON (Content-Type:
+    application/x-ndjson) o frames binarios de codec.py (un frame por índice).
+    Las lecturas válidas se insertan en una sola transacción y se responde con la
+    lista de rechazos por índice.
+    """
+    readings = []
+    rejected = []
+    try:
+        if request.mimetype == BINARY_CONTENT_TYPE:
+            readings, rejected = _expand_binary_batch()
+            if len(readings) > SENSOR_BATCH_MAX_READINGS:
+                return jsonify({"status": "error", "message": f"Too many readings (max {SENSOR_BATCH_MAX_READINGS})"}), 413
+        else:
+            for index, item in enumerate(_iter_batch_items()):
+                if index >= SENSOR_BATCH_MAX_READINGS:
+                    return jsonify({"status": "error", "message": f"Too many readings (max {SENSOR_BATCH_MAX_READINGS})"}), 413
+                try:
+                    readings.extend(_expand_batch_item(item))
+                except ValueError as e:
+                    rejected.append({"index": index, "error": str(e)})
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    if not readings:
+        return jsonify({"status": "error", "message": "No valid readings", "accepted": 0, "rejected": rejected}), 400
+
+    if not insert_sensor_data_batch(readings):
+        return jsonify({"status": "error", "message": "Could not store sensor readings, retry later."}), 503
+
+    return jsonify({"status": "success", "accepted": len(readings), "rejected": rejected}), 200
+
+def _query_timestamp(name, default):
+    """
+    Lee un timestamp de la query string (epoch en s/ms o ISO 8601). Lanza ValueError
+    si no es válido, incluidos 'nan', 'inf' o números que desbordan un float.
+    """
+    raw = request.args.get(name)
+    if raw is None or raw == "":
+        return default
+    try:
+        ts = parse_timestamp(float(raw))
+    except ValueError:
+        ts = parse_timestamp(raw)
+    if not math.isfinite(ts):
+        raise ValueError(f"Invalid '{name}' timestamp: {raw}")
+    return ts
+
+@app.route("/api/sensor/history", methods=["GET"])
+def sensor_history():
+    """
+    Histórico de un sensor: /api/sensor/history?device=&type=&from=&to=&resolution=&points=
+    'resolution' puede ser auto (por defecto), raw, 1m, 1h o 1d; en modo auto se usa
+    el rollup adecuado para no superar 'points' puntos.
+    """
+    device = request.args.get("device")
+    sensor_type = request.args.get("type")
+    if not device or not sensor_type:
+        return jsonify({"status": "error", "message": "Missing required parameters (device, type)"}), 400
+    try:
+        end = _query_timestamp("to", time.time())
+        start = _query_timestamp("from", end - HISTORY_DEFAULT_RANGE)
+        points = min(int(request.args.get("points", HISTORY_DEFAULT_POINTS)), HISTORY_MAX_POINTS)
+        if start > end or points <= 0:
+            raise ValueError("Invalid range or point count")
+        resolution, rows = get_sensor_history(device, sensor_type, start, end,
+                                              request.args.get("resolution", "auto"), points)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    return jsonify({
+        "device": device,
+        "type": sensor_type,
+        "from": start,
+        "to": end,
+        "resolution": resolution,
+        "points": [
+            {"t": t, "min": vmin, "max": vmax, "avg": avg, "count": count, "last": last}
+            for t, vmin, vmax, avg, count, last in rows
+        ],
+    }), 200
+
+@app.route("/api/sensor/stats", methods=["GET"])
+def sensor_stats():
+    """
+    Estadísticas de una serie: /api/sensor/stats?device=&type=&from=&to=&percentiles=50,90,99
+    &window=&points=&correlate=<tipo>&correlate_device=&bucket=
+    Devuelve media, desviación, mínimo, máximo, percentiles, tasa de cambio y media móvil
+    (de 'window' lecturas, submuestreada a 'points'); con 'correlate' añade la correlación
+    con otro sensor (del mismo dispositivo salvo que se indique 'correlate_device').
+    Sin 'to' la ventana son los últimos HISTORY_DEFAULT_RANGE segundos (o hasta 'from').
+    """
+    if not numpy_available():
+        return jsonify({"status": "error", "message": "Sensor statistics need NumPy (pip install numpy)"}), 503
+    device = request.args.get("device")
+    sensor_type = request.args.get("type")
+    if not device or not sensor_type:
+        return jsonify({"status": "error", "message": "Missing required parameters (device, type)"}), 400
+    try:
+        relative = None
+        if request.args.get("to") in (None, ""):
+            # Ventana relativa al momento actual: se cachea por duración
+            end = time.time()
+            start = _query_timestamp("from", end - HISTORY_DEFAULT_RANGE)
+            relative = round(end - start, 3)
+        else:
+            end = _query_timestamp("to", None)
+            start = _query_timestamp("from", end - HISTORY_DEFAULT_RANGE)
+        if start > end or end - start > STATS_MAX_RANGE:
+            raise ValueError(f"Invalid range (maximum {STATS_MAX_RANGE} s)")
+        raw_percentiles = request.args.get("percentiles")
+        percentiles = (tuple(float(p) for p in raw_percentiles.split(",") if p.strip())
+                       if raw_percentiles else STATS_DEFAULT_PERCENTILES)
+        if not percentiles or any(not 0 <= p <= 100 for p in percentiles): # También rechaza NaN
+            raise ValueError("Percentiles must be between 0 and 100")
+        window = int(request.args.get("window", STATS_DEFAULT_MA_WINDOW))
+        points = min(int(request.args.get("points", STATS_DEFAULT_MA_POINTS)), STATS_MAX_MA_POINTS)
+        if window <= 0 or points <= 0:
+            raise ValueError("'window' and 'points' must be positive")
+        correlate_with = None
+        if request.args.get("correlate"):
+            correlate_with = (request.args.get("correlate_device") or device, request.args["correlate"])
+        bucket = float(request.args["bucket"]) if request.args.get("bucket") else None
+        if bucket is not None and (not math.isfinite(bucket) or bucket <= 0):
+            raise ValueError("'bucket' must be a positive number")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    result, cached = get_series_stats(device, sensor_type, start, end, percentiles, window, points,
+                                      correlate_with, bucket, relative)
+    return jsonify(dict(result, cached=cached)), 200
+
+@app.route("/api/sensor/export", methods=["GET"])
+def sensor_export():
+    """
+    Exportación en streaming: /api/sensor/export?format=csv|ndjson&device=&type=&from=&to=&cursor=
+    Las filas se envían en orden de tiempo con memoria constante. Para reanudar una
+    descarga interrumpida se pasa cursor="<ts>,<device>,<type>" de la última fila recibida.
+    """
+    fmt = request.args.get("format", "csv")
+    try:
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format '{fmt}'")
+        cursor = request.args.get("cursor")
+        blocks = stream_export(fmt, request.args.get("device"), request.args.get("type"),
+                               parse_time_arg(request.args.get("from")), parse_time_arg(request.args.get("to")),
+                               cursor, header=not cursor)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return Response(stream_with_context(blocks), mimetype=EXPORT_FORMATS[fmt],
+                    headers={"Content-Disposition": f"attachment; filename=sensor_data.{fmt}"})
+
+# --- MÉTRICAS ---
+INGEST_ENDPOINTS = ("update_sensor_data", "update_sensor_data_batch")
+
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def _record_ingest_metrics(response):
+    if request.endpoint in INGEST_ENDPOINTS:
+        HTTP_INGEST_SECONDS.since(g.request_start, (request.path,))
+        HTTP_INGEST_REQUESTS.inc(labels=(request.path, str(response.status_code)))
+    return response
+
+@app.route("/metrics")
+def metrics():
+    """
+    Métricas del servidor en formato de texto de Prometheus.
+    """
+    return Response(render_metrics(), mimetype=METRICS_CONTENT_TYPE)
+
 # --- EVENTOS DE SOCKET.IO ---
 @socketio.on("connect")
 def on_connect():
     """
     Se ejecuta cuando un cliente de Socket.IO se conecta.
-    Envía el estado actual de los LEDs al cliente.
+    Envía el estado actual de los LEDs (desde memoria) y el último valor de cada sensor al cliente.
     """
+    SOCKETIO_CLIENTS.inc()
     state = get_led_state()
     emit("led_update", state)
-    print("Client connected, LED state sent:", state)
+    # Enviar de inmediato los últimos valores en memoria de todos los sensores
+    snapshot = get_sensor_snapshot()
+    if snapshot:
+        emit("sensor_update", snapshot)
+    emit("device_status", get_device_status())
+    logger.debug("Client connected, LED state sent: %s", state)
+
+@socketio.on("subscribe")
+def on_subscribe(data):
+    """
+    Suscribe al cliente a series de sensores:
+    {"series": [{"device": "ESP32", "type": "temperature"}, ...], "max_rate": 2}.
+    "*" sirve de comodín para dispositivo o tipo; max_rate son frames por segundo.
+    """
+    try:
+        if not isinstance(data, dict) or not isinstance(data.get("series"), list):
+            raise ValueError("Expected {'series': [{'device': ..., 'type': ...}], 'max_rate': ...}")
+        subscribe(request.sid, data["series"], data.get("max_rate"))
+    except (TypeError, ValueError) as e:
+        emit("server_message", {"type": "error", "text": f"Invalid subscription: {e}"})
+
+@socketio.on("history_backfill")
+def on_history_backfill(data):
+    """
+    Envía al cliente el histórico reciente submuestreado de un tipo de sensor para
+    rellenar su gráfico: {"type": "light", "range": 3600} (ver backfill.py).
+    """
+    try:
+        if not isinstance(data, dict) or not isinstance(data.get("type"), str):
+            raise ValueError("Expected {'type': ..., 'range': ...}")
+        emit("history_backfill", get_backfill(data["type"], parse_backfill_range(data.get("range"))))
+    except ValueError as e:
+        emit("server_message", {"type": "error", "text": f"Invalid history request: {e}"})
+
+@socketio.on("unsubscribe")
+def on_unsubscribe(data=None):
+    """
+    Cancela suscripciones: {"series": [...]} o todas si no se indican series.
+    """
+    series = data.get("series") if isinstance(data, dict) else None
+    unsubscribe(request.sid, series if isinstance(series, list) else None)
+
+@socketio.on("disconnect")
+def on_disconnect():
+    SOCKETIO_CLIENTS.dec()
+    client_disconnected(request.sid)
 
 @socketio.on("control_led")
 def on_control_led(data):
     """
-    Maneja los comandos de control de LEDs desde el frontend.
-    Actualiza el estado en la DB, envía la petición al microcontrolador y emite el estado actualizado.
+    Maneja los comandos de control de LEDs (u otras salidas) desde el frontend:
+    {"ledRed": 1, "ledGreen": 0} para todos los dispositivos o con "devices": [...].
+    El estado se actualiza en memoria (actuators.py), que combina los comandos repetidos,
+    descarta los que no cambian nada y envía el resultado con _send_actuator_state.
     """
-    if not isinstance(data, dict) or "ledRed" not in data or "ledGreen" not in data:
-        print("Invalid LED control data received:", data)
+    if not isinstance(data, dict):
+        logger.warning("Invalid LED control data received: %s", data)
         return
+    devices = data.get("devices")
+    outputs = {key: value for key, value in data.items() if key not in ("devices", "version")}
+    try:
+        set_outputs(outputs, devices if isinstance(devices, list) else None)
+    except ValueError as e:
+        logger.warning("Invalid LED control data received: %s", data)
+        emit("server_message", {"type": "error", "text": f"Invalid LED command: {e}"})
 
-    update_led_state(data) # Actualiza el estado en la base de datos
+def _send_actuator_state(device, state, version):
+    """
+    Envía el nuevo estado de un dispositivo ("*": todos) a los microcontroladores en
+    segundo plano y a todos los clientes. actuators.py solo lo llama si algo cambió.
+    """
+    if device == ACTUATOR_ALL_DEVICES:
+        if not dispatch_command("/api/control-led", state):
+            _report_command_result(None, False, "No devices available to receive the LED command.")
+        socketio.emit("led_update", dict(state, version=version), namespace="/")
+    else:
+        if not dispatch_command("/api/control-led", state, [device]):
+            _report_command_result(device, False, f"Device {device} is not registered, LED command not sent.")
+        socketio.emit("actuator_update", {"device": device, "state": state, "version": version}, namespace="/")
 
-    # Contactar al microcontrolador para actualizar el estado físico de los LEDs
-    # En un sistema multi-dispositivo, se debería buscar la IP del dispositivo específico
-    # en la tabla 'devices'. Para este PoC, se usa una URL por defecto.
-    target_ip = MICROCONTROLLER_DEFAULT_URL # Usar la URL configurable
+def _emit_rule_alert(text):
+    socketio.emit("server_message", {"type": "warning", "text": text}, namespace="/")
 
-    try:
-        # Asegurarse de que la URL termina en /api/control-led para el ESP32
-        requests.post(f"{target_ip}/api/control-led", json=data)
-        print(f"Command sent to ESP32: {target_ip}/api/control-led, data: {data}")
-    except requests.exceptions.ConnectionError as e:
-        print(f"Failed to contact microcontrollers at {target_ip}: {e}")
-        # Considerar emitir un evento de error al frontend para notificar al usuario.
-        emit("server_message", {"type": "error", "text": f"Failed to contact microcontrollers: {e}"}, broadcast=True)
-    except Exception as e:
-        print(f"An unexpected error occurred while sending LED command: {e}")
-        emit("server_message", {"type": "error", "text": f"Unexpected error controlling LED: {e}"}, broadcast=True)
+def _report_command_result(device, ok, text):
+    """
+    Notifica a todos los clientes el resultado de un comando enviado a un dispositivo.
+    """
+    socketio.emit("server_message", {"type": "info" if ok else "error", "text": text}, namespace="/")
 
+def _emit_device_status(name, online, last_seen):
+    """
+    Notifica a los clientes de este proceso que un dispositivo pasó a online u offline
+    (en modo multiproceso cada worker detecta las transiciones por su cuenta).
+    """
+    socketio.emit("device_status", [{"name": name, "online": online, "last_seen": last_seen}], namespace="/", ignore_queue=True)
 
-    # Emitir la actualización a todos los clientes de Socket.IO conectados
-    emit("led_update", data, broadcast=True)
+def start_services():
+    """
+    Arranca los servicios en segundo plano del servidor web. Se usa tanto al ejecutar
+    run.py directamente como en cada worker de cluster.py.
+    """
+    init_fanout(socketio) # Envío agrupado de lecturas a los clientes suscritos
+    init_dispatcher(_report_command_result, MICROCONTROLLER_DEFAULT_URL)
+    add_status_listener(_emit_device_status)
+    start_registry() # Registro de dispositivos en memoria y detección de offline
+    init_actuators(_send_actuator_state) # Estado de LEDs en memoria con guardado en lote
+    init_rules(set_outputs, _emit_rule_alert) # Reglas sobre las lecturas (rules.json)
 
+def stop_services():
+    """
+    Detiene los servicios de start_services() guardando el estado pendiente.
+    """
+    stop_rules()
+    stop_actuators()
+    stop_registry()
+    stop_ingest_writer()
+    stop_spool_replayer()
 
 # --- FUNCIÓN PRINCIPAL DE EJECUCIÓN ---
 if __name__ == "__main__":
     # Inicializa la base de datos al inicio de la aplicación
-    print("Initializing database...")
+    logger.info("Initializing database...")
     init_db()
-    print("Database initialized.")
+    logger.info("Database initialized.")
+    # Con debug=True el reloader de Werkzeug ejecuta el servidor en un proceso hijo
+    # (WERKZEUG_RUN_MAIN); los servicios solo se arrancan ahí para que el proceso
+    # padre no tome el spool ni duplique los hilos de fondo.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_maintenance() # Retención y vacuum incremental en segundo plano
+        start_spool_replayer() # Lecturas guardadas en disco cuando la base de datos no estaba disponible
+        start_services()
 
     # Inicia el servidor Flask-SocketIO
     # ¡ADVERTENCIA! debug=True NO DEBE USARSE EN PRODUCCIÓN por razones de seguridad y rendimiento.
-    print("Starting Flask-SocketIO server...")
+    # Para producción: python start.py serve --workers N (varios procesos, ver cluster.py).
+    logger.info("Starting Flask-SocketIO server...")
 # 'allow_unsafe_werkzeug=True' será necesario para ejecutar Werkzeug en 0.0.0.0 en entornos como Termux
 # pero igualmente NO DEBE USARSE EN PRODUCCIÓN.
 #   socketio.run(app, host="0.0.0.0", port=5000, debug=True, allow_unsafe_werkzeug=True)
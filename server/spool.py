@@ -0,0 +1,349 @@
+# spool.py
+# Spool de ingesta: log binario en disco, de solo escritura al final, donde se guardan
+# las lecturas que no se pudieron escribir en SQLite (base de datos bloqueada, llena o
+# en migración) o todas las lecturas si la ingesta va primero al spool. Un hilo de
+# database.py lo vacía en SQLite en transacciones grandes.
+#
+# El log se divide en segmentos <secuencia>.seg de hasta SPOOL_SEGMENT_BYTES. Cada
+# append es un registro:
+#
+#   cabecera  <II     longitud del contenido, CRC32 del contenido
+#   contenido <I      número de lecturas
+#   lectura   <ddHH   timestamp (epoch s), valor, longitud del dispositivo y del tipo
+#             UTF-8   dispositivo y tipo de sensor
+#
+# El archivo 'checkpoint' guarda (segmento, offset) de la primera lectura aún no
+# escrita en la base de datos y se sustituye de forma atómica. Los segmentos anteriores
+# se borran. Un registro truncado o con CRC incorrecto (corte a mitad de escritura)
+# termina su segmento. La entrega es "al menos una vez": si el proceso muere entre el
+# commit de un lote y el checkpoint, ese lote se vuelve a escribir (las filas crudas se
+# reemplazan y los rollups no vuelven a contar las lecturas ya escritas).
+#
+# Las lecturas que la base de datos rechaza por sus datos (no por estar bloqueada) se
+# apartan con quarantine() al archivo 'quarantine' del directorio, con el mismo formato
+# de registros, para no bloquear el resto del spool; no se vuelven a reproducir.
+
+import os
+import struct
+import threading
+import zlib
+
+from logs import get_logger
+
+try:
+    import fcntl
+except ImportError: # Sin fcntl (Windows) no se protege el directorio frente a otro proceso
+    fcntl = None
+
+logger = get_logger("spool")
+
+# --- CONFIGURACIÓN DEL SPOOL ---
+SPOOL_SEGMENT_BYTES = 16 * 1024 * 1024   # Tamaño a partir del cual se empieza un segmento nuevo
+SPOOL_MAX_BYTES = 512 * 1024 * 1024      # Espacio máximo pendiente en disco; por encima se rechazan lecturas
+SPOOL_FSYNC = os.environ.get("FLASKHS_SPOOL_FSYNC", "0") == "1" # fsync en cada append (sobrevive a cortes de luz, más lento)
+
+_HEADER = struct.Struct("<II")
+_COUNT = struct.Struct("<I")
+_READING = struct.Struct("<ddHH")
+_SEGMENT_SUFFIX = ".seg"
+_CHECKPOINT = "checkpoint"
+_QUARANTINE = "quarantine"
+
+_lock = threading.Lock()
+_dir = None
+_lock_file = None
+_segment = None      # Archivo del segmento activo (abierto para añadir)
+_segment_seq = 0     # Secuencia del segmento activo
+_segment_size = 0    # Bytes escritos (y volcados al SO) en el segmento activo
+_checkpoint = None   # (secuencia, offset) de la primera lectura pendiente
+_pending_bytes = 0
+_stats = {"appended": 0, "replayed": 0, "rejected": 0, "corrupt": 0, "quarantined": 0, "segments": 0}
+
+def _segment_path(seq):
+    return os.path.join(_dir, f"{seq:012d}{_SEGMENT_SUFFIX}")
+
+def _list_segments():
+    seqs = []
+    for name in os.listdir(_dir):
+        if name.endswith(_SEGMENT_SUFFIX) and name[:-len(_SEGMENT_SUFFIX)].isdigit():
+            seqs.append(int(name[:-len(_SEGMENT_SUFFIX)]))
+    return sorted(seqs)
+
+def _write_checkpoint(seq, offset):
+    path = os.path.join(_dir, _CHECKPOINT)
+    with open(path + ".tmp", "w") as f:
+        f.write(f"{seq} {offset}\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+def _read_checkpoint():
+    try:
+        with open(os.path.join(_dir, _CHECKPOINT)) as f:
+            seq, offset = f.read().split()
+            return int(seq), int(offset)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.error("Invalid spool checkpoint in %s, replaying from the first segment: %s", _dir, e)
+        return None
+
+def _start_segment(seq):
+    # Se llama con _lock tomado
+    global _segment, _segment_seq, _segment_size
+    if _segment is not None:
+        _segment.close()
+        _segment = None
+    _segment = open(_segment_path(seq), "ab")
+    _segment_seq = seq
+    _segment_size = _segment.tell()
+    _stats["segments"] += 1
+
+def open_spool(directory):
+    """
+    Abre (o crea) el spool en 'directory' y empieza un segmento nuevo; los segmentos de
+    una ejecución anterior quedan pendientes de reproducir. Solo un proceso puede usar un
+    directorio a la vez. Retorna False si no se pudo abrir.
+    """
+    global _dir, _lock_file, _checkpoint, _pending_bytes
+    with _lock:
+        if _dir is not None:
+            return True
+        try:
+            os.makedirs(directory, exist_ok=True)
+            lock_file = open(os.path.join(directory, "lock"), "w")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    logger.error("Spool directory %s is in use by another process; spool disabled.", directory)
+                    return False
+            _dir, _lock_file = directory, lock_file
+            seqs = _list_segments()
+            checkpoint = _read_checkpoint()
+            if checkpoint is None or (seqs and checkpoint[0] < seqs[0]):
+                checkpoint = (seqs[0] if seqs else 1, 0)
+            pending = [seq for seq in seqs if seq >= checkpoint[0]]
+            _pending_bytes = sum(os.path.getsize(_segment_path(seq)) for seq in pending) - (checkpoint[1] if pending else 0)
+            for seq in seqs:
+                if seq < checkpoint[0]: # Ya reproducidos (el proceso terminó antes de borrarlos)
+                    os.remove(_segment_path(seq))
+            _start_segment(max(seqs + [checkpoint[0] - 1]) + 1)
+            if not pending:
+                checkpoint = (_segment_seq, 0)
+            _checkpoint = checkpoint
+            _write_checkpoint(*checkpoint)
+        except OSError as e:
+            logger.error("Could not open ingest spool at %s: %s", directory, e)
+            _dir = None
+            return False
+    if _pending_bytes:
+        logger.warning("Ingest spool at %s has %s bytes of readings pending from a previous run.", directory, _pending_bytes)
+    return True
+
+def close_spool():
+    global _dir, _segment, _lock_file
+    with _lock:
+        if _segment is not None:
+            _segment.close()
+            _segment = None
+        if _lock_file is not None:
+            _lock_file.close()
+            _lock_file = None
+        _dir = None
+
+def _encode(readings):
+    parts = [_COUNT.pack(len(readings))]
+    for device_name, sensor_type, value, ts in readings:
+        device_bytes = device_name.encode("utf-8")
+        type_bytes = sensor_type.encode("utf-8")
+        parts.append(_READING.pack(ts, value, len(device_bytes), len(type_bytes)))
+        parts.append(device_bytes)
+        parts.append(type_bytes)
+    payload = b"".join(parts)
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+def append(readings):
+    """
+    Añade un lote de lecturas (device_name, sensor_type, value, ts) al segmento activo
+    como un único registro y lo vuelca al sistema operativo. Retorna False si el spool
+    no está abierto, está lleno o la escritura falla.
+    """
+    global _pending_bytes, _segment_size
+    if not readings:
+        return True
+    try:
+        record = _encode(readings)
+    except (struct.error, AttributeError, UnicodeError) as e:
+        logger.error("Could not spool %s sensor readings: %s", len(readings), e)
+        return False
+    with _lock:
+        if _segment is None:
+            return False
+        if _pending_bytes + len(record) > SPOOL_MAX_BYTES:
+            _stats["rejected"] += len(readings)
+            return False
+        try:
+            if _segment_size >= SPOOL_SEGMENT_BYTES:
+                _start_segment(_segment_seq + 1)
+            _segment.write(record)
+            _segment.flush()
+            if SPOOL_FSYNC:
+                os.fsync(_segment.fileno())
+        except OSError as e:
+            logger.error("Error writing to ingest spool: %s", e)
+            try:
+                _start_segment(_segment_seq + 1) # El registro pudo quedar a medias: no se añade nada detrás
+            except OSError:
+                pass
+            return False
+        _segment_size += len(record)
+        _pending_bytes += len(record)
+        _stats["appended"] += len(readings)
+    return True
+
+def quarantine(readings):
+    """
+    Guarda en el archivo de cuarentena lecturas del spool que no se pueden escribir en la
+    base de datos. Retorna False si el spool no está abierto o la escritura falla.
+    """
+    if not readings:
+        return True
+    try:
+        record = _encode(readings)
+    except (struct.error, AttributeError, UnicodeError) as e:
+        logger.error("Could not quarantine %s spooled sensor readings: %s", len(readings), e)
+        return False
+    with _lock:
+        if _dir is None:
+            return False
+        try:
+            with open(os.path.join(_dir, _QUARANTINE), "ab") as f:
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            logger.error("Error writing to ingest spool quarantine: %s", e)
+            return False
+        _stats["quarantined"] += len(readings)
+    return True
+
+def _decode(payload):
+    (count,) = _COUNT.unpack_from(payload, 0)
+    pos = _COUNT.size
+    readings = []
+    for _ in range(count):
+        ts, value, device_len, type_len = _READING.unpack_from(payload, pos)
+        pos += _READING.size
+        device_name = payload[pos:pos + device_len].decode("utf-8")
+        pos += device_len
+        sensor_type = payload[pos:pos + type_len].decode("utf-8")
+        pos += type_len
+        readings.append((device_name, sensor_type, value, ts))
+    return readings
+
+def _read_records(seq, offset, limit, readings, max_readings):
+    """
+    Añade a 'readings' las lecturas de los registros del segmento 'seq' desde 'offset'
+    hasta 'limit' (None: hasta el final del archivo). Retorna el offset tras el último
+    registro leído. Lanza ValueError si encuentra un registro truncado o corrupto.
+    """
+    with open(_segment_path(seq), "rb") as f:
+        f.seek(offset)
+        while len(readings) < max_readings and (limit is None or offset < limit):
+            header = f.read(_HEADER.size)
+            if not header:
+                break
+            if len(header) < _HEADER.size:
+                raise ValueError(f"truncated record header at offset {offset}")
+            length, crc = _HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                raise ValueError(f"truncated or corrupt record at offset {offset}")
+            readings.extend(_decode(payload))
+            offset += _HEADER.size + length
+    return offset
+
+def read_pending(max_readings):
+    """
+    Lee desde el checkpoint registros completos hasta reunir al menos 'max_readings'
+    lecturas (o agotar el spool). Retorna (lecturas, posición tras la última leída),
+    con posición None si no hay nada nuevo. La posición se confirma con commit()
+    una vez escritas las lecturas.
+    """
+    with _lock:
+        if _checkpoint is None:
+            return [], None
+        seq, offset = _checkpoint
+        active_seq, active_size = _segment_seq, _segment_size
+    readings = []
+    position = None
+    while True:
+        limit = active_size if seq == active_seq else None
+        try:
+            end = _read_records(seq, offset, limit, readings, max_readings)
+        except FileNotFoundError:
+            end = offset
+        except (OSError, ValueError, struct.error, UnicodeError) as e:
+            with _lock:
+                _stats["corrupt"] += 1
+            logger.error("Skipping rest of spool segment %s: %s", seq, e)
+            end = active_size if seq == active_seq else None
+        if end is not None and end != offset:
+            position = (seq, end)
+        if seq >= active_seq or (end is not None and len(readings) >= max_readings):
+            break
+        # Segmento cerrado agotado (o corrupto): se continúa en el siguiente
+        seq, offset = seq + 1, 0
+        position = (seq, 0)
+    return readings, position
+
+def commit(position, replayed=0):
+    """
+    Avanza el checkpoint hasta 'position' (de read_pending) y borra los segmentos ya
+    reproducidos. Si se alcanzó el final del segmento activo se empieza otro para
+    poder borrarlo.
+    """
+    global _checkpoint, _pending_bytes
+    with _lock:
+        if _checkpoint is None or position is None:
+            return
+        seq, offset = position
+        if seq == _segment_seq and offset >= _segment_size and _segment_size:
+            _start_segment(_segment_seq + 1)
+            seq, offset = _segment_seq, 0
+        first = _checkpoint[0]
+        _checkpoint = (seq, offset)
+        _write_checkpoint(seq, offset)
+        for old in range(first, seq):
+            try:
+                os.remove(_segment_path(old))
+            except FileNotFoundError:
+                pass
+        _pending_bytes = _size_from(seq, offset)
+        _stats["replayed"] += replayed
+
+def _size_from(seq, offset):
+    # Se llama con _lock tomado
+    total = -offset
+    for current in range(seq, _segment_seq + 1):
+        total += _segment_size if current == _segment_seq else _file_size(current)
+    return max(total, 0)
+
+def _file_size(seq):
+    try:
+        return os.path.getsize(_segment_path(seq))
+    except OSError:
+        return 0
+
+def pending_bytes():
+    with _lock:
+        return _pending_bytes
+
+def get_spool_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["pending_bytes"] = _pending_bytes
+        stats["open"] = _dir is not None
+    return stats
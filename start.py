@@ -1,25 +1,71 @@
+import argparse
 import os
 import subprocess
 import sys
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
-venv_path = os.path.join(script_dir, "webenv", "bin", "activate")
-run_py_path = os.path.join(script_dir, "server", "run.py")
+# Se ejecuta directamente el intérprete del entorno virtual, sin 'source activate' ni shell
+venv_dir = os.path.join(script_dir, "webenv")
+if os.name == "nt":
+    venv_python = os.path.join(venv_dir, "Scripts", "python.exe")
+else:
+    venv_python = os.path.join(venv_dir, "bin", "python")
+server_dir = os.path.join(script_dir, "server")
+dev_scripts = {"http": "run.py", "mqtt": "run-mqtt.py"}
 
-if not os.path.exists(venv_path):
-    print(f"Error: Virtual environment not found at {venv_path}")
-    sys.exit(1)
+parser = argparse.ArgumentParser(description="Start the flaskHS server.")
+commands = parser.add_subparsers(dest="command")
+
+# dev: un solo proceso con el servidor de desarrollo (comportamiento por defecto)
+dev_parser = commands.add_parser("dev", help="Single development process with debug mode (default)")
+dev_parser.add_argument("--app", choices=sorted(dev_scripts), default="http", help="http: run.py, mqtt: run-mqtt.py")
+
+# serve: varios workers y un proceso escritor único para producción (server/cluster.py)
+serve_parser = commands.add_parser("serve", help="Production mode: several worker processes and a single database writer")
+serve_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Web worker processes (default: CPU count)")
+serve_parser.add_argument("--host", default="0.0.0.0")
+serve_parser.add_argument("--port", type=int, default=5000)
+serve_parser.add_argument("--app", choices=sorted(dev_scripts), default="http", help="http: run.py, mqtt: run-mqtt.py")
+serve_parser.add_argument("--async-mode", choices=("eventlet", "gevent", "threading"), default="eventlet")
+serve_parser.add_argument("--message-queue", default="",
+                          help="Socket.IO message queue (redis://, amqp://...) or local:// for the built-in broker")
 
-if not os.path.exists(run_py_path):
-    print(f"Error: Run.py not found at {run_py_path}")
+args = parser.parse_args()
+
+if not os.path.exists(venv_python):
+    print(f"Error: Virtual environment not found at {venv_dir}")
     sys.exit(1)
 
-command = f"source {venv_path} && python {run_py_path}"
+if args.command == "serve":
+    script_path = os.path.join(server_dir, "cluster.py")
+    script_args = ["--workers", str(args.workers), "--host", args.host, "--port", str(args.port),
+                   "--app", args.app, "--async-mode", args.async_mode]
+    if args.message_queue:
+        script_args += ["--message-queue", args.message_queue]
+else:
+    script_path = os.path.join(server_dir, dev_scripts[getattr(args, "app", "http")])
+    script_args = []
 
-try:
-    subprocess.run(command, shell=True, executable="/bin/bash", check=True)
-except subprocess.CalledProcessError as e:
-    print(f"Error executing command: {e}")
+if not os.path.exists(script_path):
+    print(f"Error: {os.path.basename(script_path)} not found at {script_path}")
     sys.exit(1)
 
+argv = [venv_python, script_path] + script_args
+os.environ["VIRTUAL_ENV"] = venv_dir # Lo que haría 'activate' para los procesos hijos
+os.environ["PATH"] = os.path.dirname(venv_python) + os.pathsep + os.environ.get("PATH", "")
+
+if os.name == "nt":
+    # En Windows os.execv crea otro proceso en lugar de reemplazar este
+    try:
+        sys.exit(subprocess.run(argv).returncode)
+    except KeyboardInterrupt:
+        pass # El servidor recibe la misma señal y se detiene por su cuenta
+else:
+    # El servidor reemplaza a este proceso: mismo PID, recibe las señales directamente
+    # y no quedan bash ni este intérprete en memoria
+    try:
+        os.execv(venv_python, argv)
+    except OSError as e:
+        print(f"Error executing {venv_python}: {e}")
+        sys.exit(1)